@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from .tokens import VERSION_CLAIM, auth_version, user_role
+
+
+def auth_version_cache_key(user_id):
+    return f"auth:user:{user_id}:version"
+
+
+def invalidate_auth_cache(user_id):
+    cache.delete(auth_version_cache_key(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that trusts the token's user claims while they are
+    current, instead of loading the user on every request.
+
+    The user's current auth version is cached for AUTH_USER_CACHE_TTL
+    seconds and dropped whenever the user or profile is saved. A token
+    whose claims match it resolves to a lightweight User (id, is_staff,
+    is_active; other fields load on first access) with no query. Anything
+    else takes the regular database path, which refreshes the cache. Both
+    paths set ``user.role``.
+    """
+    def get_user(self, validated_token):
+        if api_settings.CHECK_REVOKE_TOKEN:
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        claimed = validated_token.get(VERSION_CLAIM)
+        if claimed is not None and cache.get(auth_version_cache_key(user_id)) == claimed:
+            return self.token_user(user_id, validated_token)
+
+        user = (
+            User.objects.select_related('profile')
+            .filter(**{api_settings.USER_ID_FIELD: user_id})
+            .first()
+        )
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        user.role = user_role(user)
+        cache.set(auth_version_cache_key(user_id), auth_version(user, user.role), settings.AUTH_USER_CACHE_TTL)
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        return user
+
+    @staticmethod
+    def token_user(user_id, validated_token):
+        # A real, saved User so it works in filters and foreign keys. The
+        # claim may hold the id as a string, so give it the pk's type.
+        user = User.from_db(
+            DEFAULT_DB_ALIAS, ['id', 'is_staff', 'is_active'],
+            [User._meta.pk.to_python(user_id), validated_token['is_staff'], validated_token['is_active']]
+        )
+        user.role = validated_token['role']
+        return user
@@ -0,0 +1,16 @@
+# Generated by Django 6.0 on 2026-10-18 17:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0002_userprofile'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='OTP',
+        ),
+    ]
@@ -0,0 +1,62 @@
+from django.db import IntegrityError, migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+INDEX_EXPRESSION = "(NULLIF(LOWER(email), ''))"
+
+
+def check_case_duplicates(apps, schema_editor):
+    # Accounts whose emails differ only by case must be merged by hand first
+    User = apps.get_model('auth', 'User')
+    users = User.objects.using(schema_editor.connection.alias).exclude(email='').annotate(email_key=Lower('email'))
+    keys = list(
+        users.values('email_key').annotate(count=Count('id')).filter(count__gt=1)
+        .order_by('email_key').values_list('email_key', flat=True)[:20]
+    )
+    if not keys:
+        return
+    clashes = {}
+    for email_key, pk in users.filter(email_key__in=keys).order_by('email_key', 'pk').values_list('email_key', 'pk'):
+        clashes.setdefault(email_key, []).append(str(pk))
+    listing = '; '.join(f"{email_key} (user ids {', '.join(ids)})" for email_key, ids in clashes.items())
+    raise IntegrityError(
+        f"Cannot create auth_user_email_key_uniq: these emails belong to several users: {listing}"
+    )
+
+
+def create_email_index(apps, schema_editor):
+    check_case_duplicates(apps, schema_editor)
+    if schema_editor.connection.vendor == 'postgresql':
+        # Built without blocking writes. A failed build leaves an invalid
+        # index behind, so drop that before trying again.
+        schema_editor.execute("DROP INDEX CONCURRENTLY IF EXISTS auth_user_email_key_uniq")
+        schema_editor.execute(
+            f"CREATE UNIQUE INDEX CONCURRENTLY auth_user_email_key_uniq ON auth_user ({INDEX_EXPRESSION})"
+        )
+    else:
+        schema_editor.execute(f"CREATE UNIQUE INDEX auth_user_email_key_uniq ON auth_user ({INDEX_EXPRESSION})")
+
+
+def drop_email_index(apps, schema_editor):
+    concurrently = ' CONCURRENTLY' if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute(f"DROP INDEX{concurrently} IF EXISTS auth_user_email_key_uniq")
+
+
+class Migration(migrations.Migration):
+    """
+    Case-insensitive unique index on auth_user.email for email lookups.
+    Blank emails (users created without one) index as NULL, which is never
+    a duplicate. The migration stops and names the users if existing
+    emails differ only by case.
+    """
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('authentication', '0003_delete_otp'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_email_index, drop_email_index),
+    ]
@@ -1,7 +1,10 @@
-from django.db import models
+from functools import partial
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from .authentication import invalidate_auth_cache
 
 class UserProfile(models.Model):
     ROLE_CHOICES = (
@@ -21,21 +24,57 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.email}'s Profile"
 
-class OTP(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='otp')
-    otp_code = models.CharField(max_length=6)
-    created_at = models.DateTimeField(auto_now_add=True)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = instance._editable_values()
+        return instance
 
-    def __str__(self):
-        return f"{self.user.email} - {self.otp_code}"
+    def _editable_values(self):
+        return {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.editable and not field.primary_key and field.attname in self.__dict__
+        }
+
+    def changed_fields(self):
+        """
+        Names of fields modified since the profile was loaded or saved.
+        """
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return None
+        return [name for name, value in self._editable_values().items() if loaded.get(name) != value]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = self._editable_values()
 
 # Signals to create UserProfile automatically
 @receiver(post_save, sender=User)
-def create_user_profile(sender, instance, created, **kwargs):
-    if created:
-        UserProfile.objects.get_or_create(user=instance)
+def create_user_profile(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UserProfile.objects.create(user=instance)
+
+@receiver(post_save, sender=User)
+def save_user_profile(sender, instance, created, raw=False, **kwargs):
+    # Persist a profile edited through the user, and only what changed
+    if created or raw or not User.profile.is_cached(instance):
+        return
+    profile = instance.profile
+    changed = profile.changed_fields()
+    if changed is None:
+        profile.save()
+    elif changed:
+        profile.save(update_fields=[*changed, 'updated_at'])
 
+# Cached auth versions must not outlive a change to the user or profile.
+# Dropped after commit, so a request racing the save cannot cache the old row.
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    if hasattr(instance, 'profile'):
-        instance.profile.save()
+@receiver(post_delete, sender=User)
+def invalidate_user_auth(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(invalidate_auth_cache, instance.pk), using=using)
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_profile_auth(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(invalidate_auth_cache, instance.user_id), using=using)
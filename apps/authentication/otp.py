@@ -0,0 +1,90 @@
+"""
+One-time codes kept in Redis instead of the database.
+
+Each email has at most one live code: an HMAC of it plus a counter of
+wrong guesses, in a hash that expires after OTP_TTL seconds. Checking a
+code is one Lua call that consumes it on a match and burns it after
+OTP_MAX_ATTEMPTS wrong guesses. Issuing resets that counter, so an email
+gets at most OTP_ISSUE_LIMIT codes per OTP_ISSUE_WINDOW seconds.
+"""
+import hashlib
+import hmac
+
+from django.conf import settings
+from apps.core.redis import get_redis
+from .utils import generate_otp
+
+# 1: matched and consumed, 0: wrong code, -1: no live code, -2: too many tries
+CHECK_SCRIPT = """
+local stored = redis.call('HGET', KEYS[1], 'code')
+if not stored then
+    return -1
+end
+if stored == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+local attempts = redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+if attempts >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[1])
+    return -2
+end
+return 0
+"""
+
+
+class IssueLimitReached(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Too many codes requested for this email")
+        self.retry_after = retry_after
+
+
+def _normalize(email):
+    return email.strip().lower()
+
+
+def otp_key(email):
+    # Hashed so addresses do not show up in Redis key names
+    return f"otp:{hashlib.sha256(_normalize(email).encode('utf-8')).hexdigest()}"
+
+
+def issued_key(email):
+    return f"{otp_key(email)}:issued"
+
+
+def _digest(email, code):
+    message = f"{_normalize(email)}|{code}".encode('utf-8')
+    return hmac.new(settings.SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def issue(email):
+    """
+    Creates a fresh code for `email`, replacing any live one, and returns it.
+    Raises IssueLimitReached once the email has had OTP_ISSUE_LIMIT codes
+    in the current window.
+    """
+    counter = issued_key(email)
+    pipe = get_redis().pipeline()
+    pipe.set(counter, 0, ex=settings.OTP_ISSUE_WINDOW, nx=True)
+    pipe.incr(counter)
+    pipe.ttl(counter)
+    _, issued, ttl = pipe.execute()
+    if issued > settings.OTP_ISSUE_LIMIT:
+        raise IssueLimitReached(max(ttl, 1))
+
+    code = generate_otp()
+    key = otp_key(email)
+    pipe = get_redis().pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={'code': _digest(email, code), 'attempts': 0})
+    pipe.expire(key, settings.OTP_TTL)
+    pipe.execute()
+    return code
+
+
+def verify(email, code):
+    """
+    Returns True and consumes the code when it matches the live one.
+    """
+    script = get_redis().register_script(CHECK_SCRIPT)
+    return script(keys=[otp_key(email)], args=[_digest(email, code), settings.OTP_MAX_ATTEMPTS]) == 1
@@ -1,8 +1,13 @@
 import random
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import OTP, UserProfile
-from .utils import generate_otp, send_otp_email
+from django.db import IntegrityError, transaction
+from . import otp
+from .models import UserProfile
+from .utils import normalize_email, send_otp_email, users_by_email
+
+# Usernames tried before a registration gives up on clashes
+USERNAME_ATTEMPTS = 5
 
 class UserProfileSerializer(serializers.ModelSerializer):
     class Meta:
@@ -16,6 +21,23 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name', 'profile']
 
+    def validate_email(self, value):
+        value = normalize_email(value)
+        clashes = users_by_email(value)
+        if self.instance is not None:
+            clashes = clashes.exclude(pk=self.instance.pk)
+        if clashes.exists():
+            raise serializers.ValidationError("A user with this email already exists.")
+        return value
+
+    def update(self, instance, validated_data):
+        try:
+            with transaction.atomic():
+                return super().update(instance, validated_data)
+        except IntegrityError:
+            # A concurrent change took the email first
+            raise serializers.ValidationError({'email': ["A user with this email already exists."]})
+
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
     name = serializers.CharField(write_only=True)
@@ -25,30 +47,44 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         fields = ['name', 'email', 'password']
 
     def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
+        value = normalize_email(value)
+        if users_by_email(value).exists():
             raise serializers.ValidationError("A user with this email already exists.")
         return value
 
+    @transaction.atomic
     def create(self, validated_data):
+        # The user and the queued email are committed together
         name = validated_data.pop('name')
         email = validated_data['email']
         password = validated_data.pop('password')
         
-        username = email.split('@')[0]
+        base_username = email.split('@')[0]
+        username = base_username
         if User.objects.filter(username=username).exists():
-            username = f"{username}_{random.randint(100, 999)}"
+            username = f"{base_username}_{random.randint(100, 999)}"
 
-        user = User.objects.create_user(
-            username=username,
-            email=email,
-            password=password,
-            first_name=name,
-            is_active=False
-        )
+        for attempt in range(USERNAME_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    user = User.objects.create_user(
+                        username=username,
+                        email=email,
+                        password=password,
+                        first_name=name,
+                        is_active=False
+                    )
+                break
+            except IntegrityError:
+                if users_by_email(email).exists():
+                    # A concurrent registration won the unique email index
+                    raise serializers.ValidationError({'email': ["A user with this email already exists."]})
+                if attempt == USERNAME_ATTEMPTS - 1:
+                    raise
+                # The username was taken meanwhile; try another suffix
+                username = f"{base_username}_{random.randint(100, 999)}"
         
-        otp_code = generate_otp()
-        OTP.objects.create(user=user, otp_code=otp_code)
-        send_otp_email(email, otp_code)
+        send_otp_email(email, otp.issue(email))
         
         return user
 
@@ -1,3 +1,333 @@
-from django.test import TestCase
+import io
+import re
+from datetime import timedelta
+from importlib import import_module
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from apps.core.models import OutgoingEmail
+from apps.core.outbox import send_batch
+from apps.core.redis import get_redis
+from apps.core.testing import LOCMEM_CACHES, uses_test_redis
+from apps.products.models import Category, Product
+from . import otp
+from .authentication import CachedJWTAuthentication
+from .models import UserProfile
+from .tokens import UserRefreshToken
+from .utils import bulk_create_users, users_by_email
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class OTPEmailOutboxTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    @patch('apps.authentication.otp.issue', return_value='123456')
+    def test_registration_queues_the_otp_email(self, mock_issue):
+        response = self.client.post('/api/register/', {'name': 'New', 'email': 'new@example.com', 'password': 'secret-pass'})
+        self.assertEqual(response.status_code, 201)
+        # Nothing is sent inside the request
+        self.assertEqual(mail.outbox, [])
+        queued = OutgoingEmail.objects.get()
+        self.assertEqual((queued.to, queued.status), (['new@example.com'], 'pending'))
+
+        out = io.StringIO()
+        call_command('send_emails', stdout=out)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Your OTP for verification is: 123456', mail.outbox[0].body)
+        mock_issue.assert_called_once_with('new@example.com')
+        self.assertEqual(OutgoingEmail.objects.get().status, 'sent')
+        self.assertIn('Sent 1 email(s), 0 failed.', out.getvalue())
+
+
+@uses_test_redis
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class RedisOTPTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.email = 'otp-user@example.com'
+        self.user = User.objects.create_user(
+            username='otp-user', email=self.email, password='old-password', is_active=False
+        )
+
+    def _sent_code(self):
+        send_batch()
+        return re.search(r'\d{6}', mail.outbox[-1].body).group()
+
+    def test_code_expires_and_is_stored_hashed(self):
+        code = otp.issue(self.email)
+        key = otp.otp_key(self.email)
+        self.assertTrue(0 < get_redis().ttl(key) <= 600)
+        self.assertNotIn(code, get_redis().hgetall(key).values())
+
+    def test_verify_activates_in_three_queries(self):
+        self.client.post('/api/resend-otp/', {'email': self.email})
+        code = self._sent_code()
+
+        # The code is checked in Redis: one user lookup, then the two writes
+        with self.assertNumQueries(3):
+            response = self.client.post('/api/verify-otp/', {'email': self.email, 'otp_code': code})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
+        self.assertTrue(self.user.profile.is_email_verified)
+
+        # A code works once
+        response = self.client.post('/api/verify-otp/', {'email': self.email, 'otp_code': code})
+        self.assertEqual(response.status_code, 400)
+
+    def test_code_is_burned_after_too_many_guesses(self):
+        self.client.post('/api/forgot-password/', {'email': self.email})
+        code = self._sent_code()
+        wrong = '000000' if code != '000000' else '111111'
+        for _ in range(5):
+            self.client.post('/api/reset-password/', {'email': self.email, 'otp_code': wrong, 'new_password': 'new-password'})
+
+        response = self.client.post(
+            '/api/reset-password/', {'email': self.email, 'otp_code': code, 'new_password': 'new-password'}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('old-password'))
+
+
+    @override_settings(OTP_ISSUE_LIMIT=2)
+    def test_codes_per_email_are_rate_limited(self):
+        for _ in range(2):
+            response = self.client.post('/api/forgot-password/', {'email': self.email})
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/api/forgot-password/', {'email': self.email})
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response['Retry-After']) <= 3600)
+        self.assertEqual(self.client.post('/api/resend-otp/', {'email': self.email}).status_code, 429)
+        self.assertEqual(OutgoingEmail.objects.count(), 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='password'
+        )
+        response = APIClient().post('/api/login/', {'email': 'buyer@example.com', 'password': 'password'})
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/orders/')
+        self.assertEqual(response.status_code, 200)
+        return [q['sql'] for q in queries.captured_queries if 'FROM "auth_user"' in q['sql']]
+
+    def test_warm_cache_skips_user_query(self):
+        self.assertEqual(len(self.user_queries()), 1)
+        self.assertEqual(self.user_queries(), [])
+
+    def test_user_save_invalidates_claims(self):
+        self.user_queries()
+        self.user.is_staff = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        # The token still says non-staff, so the user is read from the database
+        self.assertEqual(len(self.user_queries()), 1)
+        self.assertEqual(len(self.user_queries()), 1)
+
+    def test_profile_save_invalidates_claims(self):
+        self.user_queries()
+        self.user.profile.role = 'admin'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.save()
+        self.assertEqual(len(self.user_queries()), 1)
+
+    def test_claims_are_dropped_only_after_commit(self):
+        self.user_queries()
+        self.user.is_staff = True
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.user.save()
+            # Still inside the saving transaction: the cached version stands
+            self.assertEqual(self.user_queries(), [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(self.user_queries()), 1)
+
+    def test_both_paths_set_the_role(self):
+        UserProfile.objects.filter(user=self.user).update(role='admin')
+        token = UserRefreshToken.for_user(User.objects.get(pk=self.user.pk)).access_token
+        authentication = CachedJWTAuthentication()
+        cache.clear()
+        self.assertEqual(authentication.get_user(token).role, 'admin')
+        with self.assertNumQueries(0):
+            self.assertEqual(authentication.get_user(token).role, 'admin')
+
+    def test_cached_user_matches_the_database_user(self):
+        token = UserRefreshToken.for_user(self.user).access_token
+        authentication = CachedJWTAuthentication()
+        authentication.get_user(token)
+        with self.assertNumQueries(0):
+            cached = authentication.get_user(token)
+        self.assertEqual(cached.pk, self.user.pk)
+        self.assertEqual(cached, self.user)
+
+        # Warm cache: the new order's owner id is still serialized as an int
+        self.user_queries()
+        category = Category.objects.create(name='General')
+        product = Product.objects.create(
+            category=category, name='Mug', sku='MUG-1', description='Mug', price=10, stock=5, image='products/mug.jpg'
+        )
+        response = self.client.post('/api/orders/', {
+            'items': [{'product': product.pk, 'product_name': 'Mug', 'quantity': 1, 'price': '10'}],
+            'total': 10,
+            'paymentProvider': 'stripe',
+            'shippingAddress': {'street': '1 St', 'city': 'City', 'state': 'State', 'zip': '1', 'country': 'Country'},
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['userId'], self.user.pk)
+
+    def test_deactivated_user_is_rejected(self):
+        self.user_queries()
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.client.get('/api/orders/').status_code, 401)
+
+    def test_profile_view_returns_full_user(self):
+        self.user_queries()
+        response = self.client.get('/api/profile/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['email'], 'buyer@example.com')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EmailLookupTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='buyer', email='buyer@example.com', password='password'
+        )
+
+    def test_login_is_case_insensitive_and_reads_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/login/', {'email': 'Buyer@Example.COM', 'password': 'password'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['user']['id'], self.user.pk)
+        user_reads = [q for q in queries.captured_queries if q['sql'].startswith('SELECT') and 'auth_user' in q['sql']]
+        self.assertEqual(len(user_reads), 1)
+
+    def test_login_rejects_wrong_password_and_unverified_account(self):
+        response = self.client.post('/api/login/', {'email': 'buyer@example.com', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.post('/api/login/', {'email': 'buyer@example.com', 'password': 'password'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_registration_rejects_case_variant(self):
+        response = self.client.post('/api/register/', {
+            'name': 'Buyer', 'email': 'BUYER@example.com', 'password': 'password'
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.data)
+
+    def test_index_enforces_case_insensitive_uniqueness(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create_user(username='other', email='BUYER@example.com')
+        # Users without an email are not constrained
+        User.objects.create_user(username='a')
+        User.objects.create_user(username='b')
+
+    @skipUnless(connection.vendor == 'sqlite', 'Query plan check is SQLite specific')
+    def test_lookup_uses_index(self):
+        sql, params = users_by_email('buyer@example.com').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('auth_user_email_key_uniq', plan)
+
+    def test_profile_update_normalizes_and_rejects_taken_email(self):
+        other = User.objects.create_user(username='other', email='other@example.com', password='password')
+        self.client.force_authenticate(user=self.user)
+        response = self.client.patch('/api/profile/', {'email': ' Other@Example.com '})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.data)
+
+        # Re-saving your own address in another case is fine
+        response = self.client.patch('/api/profile/', {'email': 'Buyer@Example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, 'buyer@example.com')
+        other.refresh_from_db()
+        self.assertEqual(other.email, 'other@example.com')
+
+    @patch('apps.authentication.otp.issue', return_value='123456')
+    def test_registration_retries_a_taken_username(self, mock_issue):
+        User.objects.create_user(username='new')
+        User.objects.create_user(username='new_500')
+        with patch('apps.authentication.serializers.random.randint', side_effect=[500, 501]):
+            response = self.client.post('/api/register/', {
+                'name': 'New', 'email': 'new@example.com', 'password': 'password'
+            })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(users_by_email('new@example.com').get().username, 'new_501')
+
+    def test_migration_names_case_duplicates(self):
+        migration = import_module('apps.authentication.migrations.0004_auth_user_email_key_uniq')
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX auth_user_email_key_uniq')
+        duplicate = User.objects.create_user(username='shouty', email='BUYER@example.com')
+
+        with self.assertRaisesMessage(IntegrityError, f'buyer@example.com (user ids {self.user.pk}, {duplicate.pk})'):
+            migration.check_case_duplicates(django_apps, SimpleNamespace(connection=connection))
+
+
+class ProfileWriteTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='password')
+
+    def profile_writes(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        return [q for q in queries.captured_queries if q['sql'].startswith('UPDATE "authentication_userprofile"')]
+
+    def test_user_save_skips_unchanged_profile(self):
+        user = User.objects.select_related('profile').get(pk=self.user.pk)
+        user.first_name = 'Buyer'
+        self.assertEqual(self.profile_writes(user), [])
+        # An unloaded profile is never touched
+        self.assertEqual(self.profile_writes(User.objects.get(pk=self.user.pk)), [])
+
+    def test_user_save_writes_only_changed_profile_fields(self):
+        user = User.objects.select_related('profile').get(pk=self.user.pk)
+        user.profile.role = 'admin'
+        writes = self.profile_writes(user)
+        self.assertEqual(len(writes), 1)
+        self.assertNotIn('"phone_number"', writes[0]['sql'])
+        self.assertEqual(User.objects.get(pk=self.user.pk).profile.role, 'admin')
+        self.assertEqual(self.profile_writes(user), [])
+
+    def test_create_user_makes_one_profile_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            user = User.objects.create_user(username='other', email='other@example.com')
+        self.assertEqual(len([q for q in queries.captured_queries if 'authentication_userprofile' in q['sql']]), 1)
+        self.assertEqual(user.profile.role, 'user')
+
+    def test_bulk_create_users(self):
+        users = [User(username=f"bulk{i}", email=f"bulk{i}@example.com") for i in range(5)]
+        users[0].profile = UserProfile(role='admin')
+        with self.assertNumQueries(4):
+            # Savepoint, two inserts, release
+            created = bulk_create_users(users)
+        self.assertTrue(all(user.pk for user in created))
+        self.assertEqual(UserProfile.objects.filter(user__in=created).count(), 5)
+        self.assertEqual(UserProfile.objects.get(user=created[0]).role, 'admin')
@@ -1,12 +1,49 @@
-import random
-from django.core.mail import send_mail
+import secrets
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import CharField, Func
+from apps.core.outbox import enqueue_email
+from .models import UserProfile
 
 def generate_otp():
-    return str(random.randint(100000, 999999))
+    return str(100000 + secrets.randbelow(900000))
 
 def send_otp_email(email, otp, subject="Email Verification OTP"):
-    message = f"Your OTP for verification is: {otp}. It will expire in 10 minutes."
+    # Queued in the outbox; the send_emails worker delivers it
+    message = f"Your OTP for verification is: {otp}. It will expire in {settings.OTP_TTL // 60} minutes."
     email_from = settings.EMAIL_HOST_USER
     recipient_list = [email]
-    send_mail(subject, message, email_from, recipient_list)
+    enqueue_email(subject, message, recipient_list, from_email=email_from)
+
+def normalize_email(email):
+    return email.strip().lower()
+
+class EmailKey(Func):
+    """
+    The expression behind the auth_user_email_key_uniq index. Lookups must
+    use it verbatim for the index to apply; blank emails map to NULL.
+    """
+    template = "NULLIF(LOWER(%(expressions)s), '')"
+    output_field = CharField()
+
+def users_by_email(email, queryset=None):
+    queryset = User.objects.all() if queryset is None else queryset
+    return queryset.alias(email_key=EmailKey('email')).filter(email_key=normalize_email(email))
+
+def find_user_by_email(email, queryset=None):
+    return users_by_email(email, queryset).first()
+
+@transaction.atomic
+def bulk_create_users(users, batch_size=500):
+    """
+    Inserts unsaved User instances and their profiles in batches. Signals
+    do not fire, so hash passwords (set_password) and set any profile
+    fields on user.profile beforehand.
+    """
+    profiles = [getattr(user, 'profile', None) or UserProfile() for user in users]
+    users = User.objects.bulk_create(users, batch_size=batch_size)
+    for user, profile in zip(users, profiles):
+        profile.user = user
+    UserProfile.objects.bulk_create(profiles, batch_size=batch_size)
+    return users
@@ -2,11 +2,10 @@ from rest_framework import viewsets, status, generics
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.decorators import action
-from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from rest_framework_simplejwt.tokens import RefreshToken
-from .models import OTP
-from .utils import generate_otp, send_otp_email
+from .tokens import UserRefreshToken
+from . import otp
+from .utils import find_user_by_email, send_otp_email, users_by_email
 from .serializers import (
     UserRegistrationSerializer, 
     VerifyOTPSerializer, 
@@ -16,6 +15,13 @@ from .serializers import (
     LoginSerializer
 )
 
+def _too_many_codes(exc):
+    return Response(
+        {"error": "Too many OTP requests. Please try again later."},
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={'Retry-After': str(exc.retry_after)},
+    )
+
 class RegisterViewSet(viewsets.GenericViewSet):
     permission_classes = [AllowAny]
     serializer_class = UserRegistrationSerializer
@@ -36,21 +42,18 @@ class VerifyOTPViewSet(viewsets.GenericViewSet):
         if serializer.is_valid():
             email = serializer.validated_data['email']
             otp_code = serializer.validated_data['otp_code']
-            try:
-                user = User.objects.get(email=email)
-                otp_obj = OTP.objects.get(user=user, otp_code=otp_code)
-                user.is_active = True
-                user.save()
-                
-                # Update profile verification status
-                if hasattr(user, 'profile'):
-                    user.profile.is_email_verified = True
-                    user.profile.save()
-                    
-                otp_obj.delete()
-                return Response({"message": "Account activated successfully."}, status=status.HTTP_200_OK)
-            except (User.DoesNotExist, OTP.DoesNotExist):
+            # The code is checked and consumed in Redis before the user is loaded
+            user = find_user_by_email(email, User.objects.select_related('profile')) if otp.verify(email, otp_code) else None
+            if user is None:
                 return Response({"error": "Invalid OTP or Email."}, status=status.HTTP_400_BAD_REQUEST)
+            user.is_active = True
+
+            # Update profile verification status; saving the user writes it
+            if hasattr(user, 'profile'):
+                user.profile.is_email_verified = True
+            user.save(update_fields=['is_active'])
+
+            return Response({"message": "Account activated successfully."}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class LoginViewSet(viewsets.GenericViewSet):
@@ -63,21 +66,20 @@ class LoginViewSet(viewsets.GenericViewSet):
         
         email = serializer.validated_data['email']
         password = serializer.validated_data['password']
-        try:
-            user_obj = User.objects.get(email=email)
-            user = authenticate(username=user_obj.username, password=password)
-            if user:
-                if not user.is_active:
-                    return Response({"error": "Account not verified. Please verify OTP."}, status=status.HTTP_403_FORBIDDEN)
-                refresh = RefreshToken.for_user(user)
-                return Response({
-                    'refresh': str(refresh),
-                    'access': str(refresh.access_token),
-                    'user': UserSerializer(user).data
-                })
-            return Response({"error": "Invalid credentials."}, status=status.HTTP_401_UNAUTHORIZED)
-        except User.DoesNotExist:
+        # One indexed query; the profile comes along for the token and response
+        user = find_user_by_email(email, User.objects.select_related('profile'))
+        if user is None:
             return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+        if not user.check_password(password):
+            return Response({"error": "Invalid credentials."}, status=status.HTTP_401_UNAUTHORIZED)
+        if not user.is_active:
+            return Response({"error": "Account not verified. Please verify OTP."}, status=status.HTTP_403_FORBIDDEN)
+        refresh = UserRefreshToken.for_user(user)
+        return Response({
+            'refresh': str(refresh),
+            'access': str(refresh.access_token),
+            'user': UserSerializer(user).data
+        })
 
 class ForgotPasswordViewSet(viewsets.GenericViewSet):
     permission_classes = [AllowAny]
@@ -87,14 +89,14 @@ class ForgotPasswordViewSet(viewsets.GenericViewSet):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
             email = serializer.validated_data['email']
-            try:
-                user = User.objects.get(email=email)
-                otp_code = generate_otp()
-                OTP.objects.update_or_create(user=user, defaults={'otp_code': otp_code})
-                send_otp_email(email, otp_code, subject="Password Reset OTP")
-                return Response({"message": "Reset OTP sent to your email."}, status=status.HTTP_200_OK)
-            except User.DoesNotExist:
+            if not users_by_email(email).exists():
                 return Response({"error": "User with this email not found."}, status=status.HTTP_404_NOT_FOUND)
+            try:
+                code = otp.issue(email)
+            except otp.IssueLimitReached as exc:
+                return _too_many_codes(exc)
+            send_otp_email(email, code, subject="Password Reset OTP")
+            return Response({"message": "Reset OTP sent to your email."}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class PasswordResetVerifyViewSet(viewsets.GenericViewSet):
@@ -107,21 +109,17 @@ class PasswordResetVerifyViewSet(viewsets.GenericViewSet):
             email = serializer.validated_data['email']
             otp_code = serializer.validated_data['otp_code']
             new_password = serializer.validated_data['new_password']
-            try:
-                user = User.objects.get(email=email)
-                otp_obj = OTP.objects.get(user=user, otp_code=otp_code)
-                user.set_password(new_password)
-                user.save()
-                
-                # Also ensure verified if they reset password successfully
-                if hasattr(user, 'profile'):
-                    user.profile.is_email_verified = True
-                    user.profile.save()
-                    
-                otp_obj.delete()
-                return Response({"message": "Password reset successfully."}, status=status.HTTP_200_OK)
-            except (User.DoesNotExist, OTP.DoesNotExist):
+            user = find_user_by_email(email, User.objects.select_related('profile')) if otp.verify(email, otp_code) else None
+            if user is None:
                 return Response({"error": "Invalid OTP or Email."}, status=status.HTTP_400_BAD_REQUEST)
+            user.set_password(new_password)
+
+            # Also ensure verified if they reset password successfully
+            if hasattr(user, 'profile'):
+                user.profile.is_email_verified = True
+            user.save(update_fields=['password'])
+
+            return Response({"message": "Password reset successfully."}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class ResendOTPViewSet(viewsets.GenericViewSet):
@@ -129,20 +127,22 @@ class ResendOTPViewSet(viewsets.GenericViewSet):
 
     def create(self, request):
         email = request.data.get('email')
-        try:
-            user = User.objects.get(email=email)
-            if user.is_active:
-                return Response({"message": "Account already active."}, status=status.HTTP_400_BAD_REQUEST)
-            otp_code = generate_otp()
-            OTP.objects.update_or_create(user=user, defaults={'otp_code': otp_code})
-            send_otp_email(email, otp_code)
-            return Response({"message": "New OTP sent to your email."}, status=status.HTTP_200_OK)
-        except User.DoesNotExist:
+        user = find_user_by_email(email) if email else None
+        if user is None:
             return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+        if user.is_active:
+            return Response({"message": "Account already active."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            code = otp.issue(email)
+        except otp.IssueLimitReached as exc:
+            return _too_many_codes(exc)
+        send_otp_email(email, code)
+        return Response({"message": "New OTP sent to your email."}, status=status.HTTP_200_OK)
 
 class UserProfileView(generics.RetrieveUpdateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = UserSerializer
 
     def get_object(self):
-        return self.request.user
+        # request.user may be a lightweight token user; load the full record
+        return User.objects.select_related('profile').get(pk=self.request.user.pk)
@@ -0,0 +1,46 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+def normalize_query(query_params):
+    """
+    Returns a canonical query string: keys and repeated values are sorted
+    and empty values are dropped, so equivalent requests compare equal.
+    """
+    pairs = []
+    for key in sorted(query_params.keys()):
+        for value in sorted(query_params.getlist(key)):
+            if value != '':
+                pairs.append((key, value))
+    return urlencode(pairs)
+
+
+def make_etag(*parts):
+    """
+    Builds a strong ETag from the given validator parts.
+    """
+    raw = '|'.join(str(part) for part in parts)
+    return quote_etag(hashlib.md5(raw.encode('utf-8')).hexdigest())
+
+
+def add_validators(response, etag, last_modified=None):
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def not_modified_response(request, etag, last_modified=None):
+    """
+    Evaluates If-None-Match / If-Modified-Since against the validators.
+
+    Returns a 304 (or 412) carrying the validators when the client's copy is
+    current, or None when the full body has to be produced.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        add_validators(response, etag, last_modified)
+    return response
@@ -0,0 +1,135 @@
+"""
+Idempotency-Key support for unsafe endpoints.
+
+The first request with a given key claims it in the cache and runs the view.
+A successful response is stored under the key for
+``settings.IDEMPOTENCY_KEY_TTL`` seconds, and repeats are answered from it
+with one cache read. A duplicate that arrives while the first request is
+still running gets a 409. Reusing a key with a different body gets a 422.
+Failed responses are not stored, so the client can retry with the same key.
+"""
+import hashlib
+import inspect
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+
+def _principal(request):
+    # Key space is per caller; API key clients are told apart by their header
+    if request.user and request.user.is_authenticated:
+        return f"user:{request.user.pk}"
+    authorization = request.headers.get('Authorization', '')
+    return 'anon:' + hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+
+
+def idempotency_cache_key(scope, request, key):
+    digest = hashlib.sha256(f"{_principal(request)}|{key}".encode('utf-8')).hexdigest()
+    return f"idempotency:{scope}:{digest}"
+
+
+def _begin(scope, request):
+    """
+    Claims the key for this request. Returns ``(cache_key, fingerprint,
+    early)`` where `early` is ``(data, status, headers)`` when the view
+    must not run.
+    """
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if len(key) > MAX_KEY_LENGTH:
+        return None, None, (
+            {'detail': f'{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters.'},
+            status.HTTP_400_BAD_REQUEST, None
+        )
+
+    cache_key = idempotency_cache_key(scope, request, key)
+    fingerprint = hashlib.sha256(request.body).hexdigest()
+
+    stored = cache.get(cache_key)
+    if stored is None:
+        claim = {'state': 'processing', 'fingerprint': fingerprint}
+        if not cache.add(cache_key, claim, settings.IDEMPOTENCY_LOCK_TIMEOUT):
+            # Lost the race to a concurrent duplicate
+            stored = cache.get(cache_key) or claim
+
+    if stored is None:
+        return cache_key, fingerprint, None
+    if stored['fingerprint'] != fingerprint:
+        return cache_key, fingerprint, (
+            {'detail': f'{IDEMPOTENCY_HEADER} was already used with a different request body.'},
+            status.HTTP_422_UNPROCESSABLE_ENTITY, None
+        )
+    if stored['state'] == 'processing':
+        return cache_key, fingerprint, (
+            {'detail': 'A request with this Idempotency-Key is still being processed.'},
+            status.HTTP_409_CONFLICT, {'Retry-After': '1'}
+        )
+    return cache_key, fingerprint, (stored['data'], stored['status'], {REPLAYED_HEADER: 'true'})
+
+
+def _finish(cache_key, fingerprint, response):
+    if status.is_success(response.status_code):
+        # DRF responses carry their data; plain JSON responses their body
+        data = response.data if hasattr(response, 'data') else json.loads(response.content)
+        cache.set(cache_key, {
+            'state': 'done',
+            'fingerprint': fingerprint,
+            'status': response.status_code,
+            'data': data,
+        }, settings.IDEMPOTENCY_KEY_TTL)
+    else:
+        # Let the client retry the same key after an error
+        cache.delete(cache_key)
+
+
+def idempotent(scope):
+    """
+    Decorates a view handler ``(self, request, *args, **kwargs)`` so that
+    requests carrying an Idempotency-Key run at most once per key.
+    Coroutine handlers are supported and answered with JsonResponse.
+    """
+    def decorator(handler):
+        if inspect.iscoroutinefunction(handler):
+            @wraps(handler)
+            async def async_wrapper(self, request, *args, **kwargs):
+                if not request.headers.get(IDEMPOTENCY_HEADER):
+                    return await handler(self, request, *args, **kwargs)
+                cache_key, fingerprint, early = await sync_to_async(_begin)(scope, request)
+                if early is not None:
+                    data, code, headers = early
+                    return JsonResponse(data, status=code, headers=headers, safe=False)
+                try:
+                    response = await handler(self, request, *args, **kwargs)
+                except BaseException:
+                    await cache.adelete(cache_key)
+                    raise
+                await sync_to_async(_finish)(cache_key, fingerprint, response)
+                return response
+            return async_wrapper
+
+        @wraps(handler)
+        def wrapper(self, request, *args, **kwargs):
+            if not request.headers.get(IDEMPOTENCY_HEADER):
+                return handler(self, request, *args, **kwargs)
+            cache_key, fingerprint, early = _begin(scope, request)
+            if early is not None:
+                data, code, headers = early
+                return Response(data, status=code, headers=headers)
+            try:
+                response = handler(self, request, *args, **kwargs)
+            except BaseException:
+                cache.delete(cache_key)
+                raise
+            _finish(cache_key, fingerprint, response)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,39 @@
+"""
+Short-lived cache locks that only their holder can release.
+
+``acquire`` stores a random token under the lock key; ``release`` deletes
+the key only while it still holds that token. A holder that overran the
+lock timeout therefore cannot remove a lock another worker took since.
+"""
+import secrets
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django_redis.cache import RedisCache
+
+# Compare-and-delete in one step on the Redis server
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def acquire(key, timeout):
+    """
+    Returns the lock's token, or None when someone else holds it.
+    """
+    # django-redis stores ints unpickled, so the script can compare them
+    token = secrets.randbits(62)
+    return token if cache.add(key, token, timeout) else None
+
+
+def release(key, token):
+    backend = caches[DEFAULT_CACHE_ALIAS]
+    if isinstance(backend, RedisCache):
+        client = backend.client.get_client(write=True)
+        client.eval(RELEASE_SCRIPT, 1, backend.client.make_key(key), str(token))
+    elif cache.get(key) == token:
+        # Other backends (e.g. locmem in tests) are not shared between
+        # processes, so a check then delete is enough there
+        cache.delete(key)
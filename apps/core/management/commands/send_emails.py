@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from apps.core.outbox import purge_emails, send_batch
+
+# Seconds between purges of old rows while running with --interval
+PURGE_EVERY = 60 * 60
+
+
+class Command(BaseCommand):
+    help = 'Sends queued emails from the outbox in batches over one SMTP connection and purges old ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Emails claimed per batch')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep running, polling every N seconds when the outbox is empty (default: drain once)'
+        )
+
+    def handle(self, *args, **options):
+        purged_at = None
+        while True:
+            if purged_at is None or time.monotonic() - purged_at >= PURGE_EVERY:
+                purged = purge_emails()
+                purged_at = time.monotonic()
+                if purged:
+                    self.stdout.write(f'Purged {purged} old email(s).')
+            sent, failed = send_batch(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f'Sent {sent} email(s), {failed} failed.')
+            if sent:
+                continue
+            # Idle, or only failures left: their retries are scheduled with backoff
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,133 @@
+"""
+Email outbox: requests queue mail in the database and return, and the
+send_emails command delivers it.
+
+A batch is claimed with SKIP LOCKED so several workers can run side by
+side, then sent over a single SMTP connection. Each message is marked
+sent as soon as the server accepts it, and its body (which may hold a
+one-time code) is blanked. A failed message is retried with exponential
+backoff until EMAIL_OUTBOX_MAX_ATTEMPTS, after which it is parked as
+failed. Sent and parked rows are deleted after EMAIL_OUTBOX_RETENTION
+seconds by purge_emails.
+"""
+import logging
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+# SMTP replies that reject one message without ending the session
+MESSAGE_REFUSED = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+def enqueue_email(subject, body, to, from_email=None):
+    """
+    Queues an email. Inside a transaction it is only sent if that commits.
+    """
+    return OutgoingEmail.objects.create(
+        subject=subject, body=body, to=list(to), from_email=from_email or settings.DEFAULT_FROM_EMAIL
+    )
+
+
+def release_stale_claims():
+    cutoff = timezone.now() - timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+    return OutgoingEmail.objects.filter(status='sending', locked_at__lt=cutoff).update(status='pending')
+
+
+def claim_batch(batch_size):
+    with transaction.atomic():
+        ids = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=timezone.now())
+            .order_by('next_attempt_at', 'id')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        OutgoingEmail.objects.filter(pk__in=ids).update(status='sending', locked_at=timezone.now())
+    return list(OutgoingEmail.objects.filter(pk__in=ids).order_by('next_attempt_at', 'id'))
+
+
+def retry_delay(attempts):
+    return min(settings.EMAIL_OUTBOX_BACKOFF_MAX, settings.EMAIL_OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)))
+
+
+def mark_failed(email, error):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = 'failed'
+    else:
+        email.status = 'pending'
+        email.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(email.attempts))
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+
+
+def purge_emails():
+    """
+    Deletes sent and parked emails older than EMAIL_OUTBOX_RETENTION
+    seconds. Returns how many were removed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.EMAIL_OUTBOX_RETENTION)
+    deleted, _ = OutgoingEmail.objects.filter(
+        Q(status='sent', sent_at__lt=cutoff) | Q(status='failed', created_at__lt=cutoff)
+    ).delete()
+    return deleted
+
+
+def send_batch(batch_size=50):
+    """
+    Claims and sends one batch. Returns ``(sent, failed)`` counts.
+    """
+    release_stale_claims()
+    emails = claim_batch(batch_size)
+    if not emails:
+        return 0, 0
+
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as exc:
+        logger.warning("Could not connect to the mail server", exc_info=True)
+        for email in emails:
+            mark_failed(email, exc)
+        return 0, len(emails)
+
+    try:
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, email.from_email or None, email.to)
+            try:
+                connection.send_messages([message])
+            except MESSAGE_REFUSED as exc:
+                # The server turned this message down; the session is fine
+                logger.warning("Email %s was refused", email.pk, exc_info=True)
+                mark_failed(email, exc)
+                failed += 1
+            except Exception as exc:
+                logger.warning("Could not send email %s", email.pk, exc_info=True)
+                mark_failed(email, exc)
+                failed += 1
+                # The session may be broken; start a fresh one for the rest
+                connection.close()
+                connection.open()
+            else:
+                # Recorded at once, so a worker dying later cannot resend it
+                email.status = 'sent'
+                OutgoingEmail.objects.filter(pk=email.pk).update(status='sent', sent_at=timezone.now(), body='')
+                sent += 1
+    except Exception as exc:
+        # Lost the server mid-batch: what was not sent goes back for retry
+        logger.warning("Mail server went away", exc_info=True)
+        for email in emails:
+            if email.status == 'sending':
+                mark_failed(email, exc)
+                failed += 1
+    finally:
+        connection.close()
+    return sent, failed
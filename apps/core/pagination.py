@@ -0,0 +1,144 @@
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, _reverse_ordering
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination that seeks on the full ordering tuple.
+
+    DRF's CursorPagination positions on the first ordering field only and
+    skips ties with an OFFSET. Here the primary key is always appended as a
+    tiebreaker and the cursor stores every ordering value, so each page is a
+    single indexed range scan and page N costs the same as page 1. No count
+    query is ever issued.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-created_at'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if not any(field.lstrip('-') in ('pk', 'id') for field in ordering):
+            # Match the direction of the leading field so a composite
+            # (field, id) index can serve the scan in either direction.
+            tiebreaker = '-pk' if ordering[0].startswith('-') else 'pk'
+            ordering = ordering + (tiebreaker,)
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+
+        if self.cursor is not None and self.cursor.position is not None:
+            values = self._decode_position(self.cursor.position, queryset)
+            queryset = queryset.filter(self._keyset_filter(ordering, values))
+
+        # Fetch one extra row to find out whether another page follows
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+
+        if self.page:
+            self.previous_position = self._get_position_from_instance(self.page[0], self.ordering)
+            self.next_position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            # An empty page keeps pointing at the position it was asked for
+            position = self.cursor.position if self.cursor else None
+            self.previous_position = self.next_position = position
+            if reverse:
+                self.has_next = position is not None
+
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.next_position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.previous_position))
+
+    def _keyset_filter(self, ordering, values):
+        """
+        Expands a row-value comparison `(a, b, c) > (x, y, z)` into
+        `a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)`,
+        honouring the direction of each ordering field.
+        """
+        query = Q()
+        equal = {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            query |= Q(**equal, **{name + lookup: value})
+            equal[name] = value
+        return query
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for field in ordering:
+            name = field.lstrip('-')
+            attr = instance[name] if isinstance(instance, dict) else getattr(instance, name)
+            values.append(str(attr))
+        return json.dumps(values, separators=(',', ':'))
+
+    def _decode_position(self, position, queryset):
+        """
+        Parses a cursor position back into ordering values of the right
+        types. Anything that does not fit raises NotFound, as DRF does for
+        a malformed cursor.
+        """
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        # A cursor issued for a different ordering cannot be resumed
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        decoded = []
+        for field, value in zip(self.ordering, values):
+            # Positions are written with str(), so they never hold nulls
+            if not isinstance(value, str):
+                raise NotFound(self.invalid_cursor_message)
+            try:
+                decoded.append(self._ordering_field(queryset, field).to_python(value))
+            except (DjangoValidationError, FieldDoesNotExist, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        return decoded
+
+    @staticmethod
+    def _ordering_field(queryset, field):
+        name = field.lstrip('-')
+        if name in queryset.query.annotations:
+            # e.g. the search rank
+            return queryset.query.annotations[name].output_field
+        model = queryset.model
+        *path, name = name.split(LOOKUP_SEP)
+        for part in path:
+            model = model._meta.get_field(part).related_model
+        return model._meta.pk if name == 'pk' else model._meta.get_field(name)
@@ -0,0 +1,42 @@
+import asyncio
+import weakref
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """
+    Returns a shared Redis client for ``settings.REDIS_URL``.
+
+    Clients are kept per URL so each one reuses its own connection pool.
+    """
+    url = settings.REDIS_URL
+    client = _clients.get(url)
+    if client is None:
+        client = _clients[url] = redis.Redis.from_url(url, decode_responses=True)
+    return client
+
+
+def get_async_redis():
+    """
+    The asyncio counterpart of ``get_redis()``. Async connections belong to
+    the event loop that opened them, so clients are kept per loop and URL.
+    """
+    url = settings.REDIS_URL
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(url)
+    if client is None:
+        client = clients[url] = redis.asyncio.Redis.from_url(url, decode_responses=True)
+    return client
+
+
+def redis_available():
+    try:
+        return get_redis().ping()
+    except redis.RedisError:
+        return False
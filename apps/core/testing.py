@@ -0,0 +1,52 @@
+from unittest import skipUnless
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from .redis import get_redis, redis_available
+
+# Tests run against this unless they need Redis (see uses_test_redis), so
+# they never touch the REDIS_URL database
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class QueryCountGuardMixin:
+    """
+    Test mixin that catches N+1 regressions on paginated list endpoints.
+    """
+    def assertQueriesDoNotScaleWithPageSize(self, path, page_sizes=(1, 5, 10)):
+        counts = {}
+        for page_size in page_sizes:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(path, {'page_size': page_size})
+            self.assertEqual(response.status_code, 200)
+            counts[page_size] = len(ctx)
+
+        self.assertEqual(
+            len(set(counts.values())), 1,
+            f"Query count for {path} grows with page size: {counts}"
+        )
+
+
+def uses_test_redis(test_class):
+    """
+    Class decorator for tests that need Redis. Points get_redis() at
+    settings.REDIS_TEST_URL, empties that database before each test and
+    skips the class when it cannot be reached.
+    """
+    if settings.REDIS_TEST_URL == settings.REDIS_URL:
+        raise ImproperlyConfigured('REDIS_TEST_URL must not be the REDIS_URL database; tests flush it.')
+    with override_settings(REDIS_URL=settings.REDIS_TEST_URL):
+        available = redis_available()
+
+    set_up = test_class.setUp
+
+    def setUp(self):
+        get_redis().flushdb()
+        set_up(self)
+
+    test_class.setUp = setUp
+    test_class = override_settings(REDIS_URL=settings.REDIS_TEST_URL)(test_class)
+    return skipUnless(available, 'Redis is not reachable')(test_class)
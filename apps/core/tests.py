@@ -1,3 +1,168 @@
-from django.test import TestCase
+import io
+import smtplib
+from datetime import timedelta
 
-# Create your tests here.
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.mail.backends import locmem
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from . import locks
+from .models import OutgoingEmail
+from .outbox import enqueue_email, send_batch
+from .testing import LOCMEM_CACHES, uses_test_redis
+
+
+class RecordingBackend(locmem.EmailBackend):
+    """
+    locmem backend that counts connections, can refuse recipients and can
+    drop the session before a given recipient.
+    """
+    opened = 0
+    refuse = set()
+    disconnect = set()
+    on_send = None
+
+    def open(self):
+        type(self).opened += 1
+        return True
+
+    def send_messages(self, messages):
+        for message in messages:
+            if set(message.to) & self.refuse:
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, b'mailbox unavailable')})
+            if set(message.to) & self.disconnect:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            if type(self).on_send:
+                type(self).on_send(message)
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='apps.core.tests.RecordingBackend')
+class OutboxTests(TestCase):
+    def setUp(self):
+        RecordingBackend.opened = 0
+        RecordingBackend.refuse = set()
+        RecordingBackend.disconnect = set()
+        RecordingBackend.on_send = None
+
+    def test_batch_shares_one_connection(self):
+        for index in range(5):
+            enqueue_email('Hi', 'Body', [f'user{index}@example.com'])
+        self.assertEqual(send_batch(), (5, 0))
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(RecordingBackend.opened, 1)
+
+    def test_each_email_is_marked_sent_before_the_next_goes_out(self):
+        first = enqueue_email('Hi', 'Body', ['first@example.com'])
+        enqueue_email('Hi', 'Body', ['second@example.com'])
+        seen = []
+        RecordingBackend.on_send = lambda message: seen.append(OutgoingEmail.objects.get(pk=first.pk).status)
+
+        self.assertEqual(send_batch(), (2, 0))
+        self.assertEqual(seen, ['sending', 'sent'])
+
+    def test_sent_email_keeps_no_body(self):
+        email = enqueue_email('Your code', 'Your OTP for verification is: 123456.', ['user@example.com'])
+        self.assertEqual(send_batch(), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.body), ('sent', ''))
+        self.assertIn('123456', mail.outbox[0].body)
+
+    @override_settings(EMAIL_OUTBOX_RETENTION=60)
+    def test_old_sent_and_parked_emails_are_purged(self):
+        old = timezone.now() - timedelta(minutes=5)
+        sent = enqueue_email('Hi', 'Body', ['sent@example.com'])
+        parked = enqueue_email('Hi', 'Body', ['parked@example.com'])
+        OutgoingEmail.objects.filter(pk=sent.pk).update(status='sent', sent_at=old, created_at=old)
+        OutgoingEmail.objects.filter(pk=parked.pk).update(status='failed', created_at=old)
+        fresh = enqueue_email('Hi', 'Body', ['fresh@example.com'])
+        OutgoingEmail.objects.filter(pk=fresh.pk).update(status='sent', sent_at=timezone.now())
+        pending = enqueue_email('Hi', 'Body', ['pending@example.com'])
+        OutgoingEmail.objects.filter(pk=pending.pk).update(created_at=old)
+
+        out = io.StringIO()
+        call_command('send_emails', stdout=out)
+        self.assertIn('Purged 2 old email(s).', out.getvalue())
+        self.assertEqual(
+            set(OutgoingEmail.objects.values_list('pk', 'status')), {(fresh.pk, 'sent'), (pending.pk, 'sent')}
+        )
+
+    def test_failed_email_is_retried_with_backoff(self):
+        RecordingBackend.refuse = {'bounce@example.com'}
+        enqueue_email('Hi', 'Body', ['ok@example.com'])
+        bounced = enqueue_email('Hi', 'Body', ['bounce@example.com'])
+
+        with self.assertLogs('apps.core.outbox', 'WARNING'):
+            self.assertEqual(send_batch(), (1, 1))
+        bounced.refresh_from_db()
+        self.assertEqual((bounced.status, bounced.attempts), ('pending', 1))
+        self.assertGreater(bounced.next_attempt_at, timezone.now() + timedelta(seconds=20))
+        # Not due yet
+        self.assertEqual(send_batch(), (0, 0))
+
+        RecordingBackend.refuse = set()
+        OutgoingEmail.objects.filter(pk=bounced.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(send_batch(), (1, 0))
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_refused_recipient_keeps_the_session(self):
+        RecordingBackend.refuse = {'bounce@example.com'}
+        enqueue_email('Hi', 'Body', ['bounce@example.com'])
+        enqueue_email('Hi', 'Body', ['ok@example.com'])
+        with self.assertLogs('apps.core.outbox', 'WARNING'):
+            self.assertEqual(send_batch(), (1, 1))
+        self.assertEqual(RecordingBackend.opened, 1)
+
+    def test_dropped_session_is_reopened_for_the_rest(self):
+        RecordingBackend.disconnect = {'drop@example.com'}
+        enqueue_email('Hi', 'Body', ['drop@example.com'])
+        enqueue_email('Hi', 'Body', ['ok@example.com'])
+        with self.assertLogs('apps.core.outbox', 'WARNING'):
+            self.assertEqual(send_batch(), (1, 1))
+        self.assertEqual(RecordingBackend.opened, 2)
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=1)
+    def test_email_is_parked_after_max_attempts(self):
+        RecordingBackend.refuse = {'bounce@example.com'}
+        bounced = enqueue_email('Hi', 'Body', ['bounce@example.com'])
+        with self.assertLogs('apps.core.outbox', 'WARNING'):
+            send_batch()
+        bounced.refresh_from_db()
+        self.assertEqual(bounced.status, 'failed')
+        self.assertIn('550', bounced.last_error)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class LockTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_release_keeps_a_lock_taken_after_expiry(self):
+        mine = locks.acquire('jobs:lock', 10)
+        self.assertIsNotNone(mine)
+        self.assertIsNone(locks.acquire('jobs:lock', 10))
+
+        # The lock timed out and another worker took it
+        cache.delete('jobs:lock')
+        theirs = locks.acquire('jobs:lock', 10)
+        locks.release('jobs:lock', mine)
+        self.assertEqual(cache.get('jobs:lock'), theirs)
+
+        locks.release('jobs:lock', theirs)
+        self.assertIsNone(cache.get('jobs:lock'))
+
+
+@uses_test_redis
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django_redis.cache.RedisCache',
+    'LOCATION': settings.REDIS_TEST_URL,
+    'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'},
+}})
+class RedisLockTests(LockTests):
+    """
+    The same checks through the compare-and-delete script, on the
+    REDIS_TEST_URL database that uses_test_redis empties.
+    """
@@ -10,6 +10,7 @@ class OrderItemInline(admin.TabularInline):
 class OrderAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'total', 'status', 'payment_status', 'created_at']
     list_filter = ['status', 'payment_status', 'payment_provider', 'created_at']
+    list_select_related = ['user']
     search_fields = ['id', 'user__username', 'transaction_id', 'city', 'country']
     readonly_fields = ['id', 'user', 'total', 'payment_provider', 'created_at', 'updated_at']
     inlines = [OrderItemInline]
@@ -0,0 +1,113 @@
+"""
+Live order status over Server-Sent Events.
+
+The payment handlers publish an order's status to Redis once a transition
+commits. Each ASGI worker holds a single pattern subscription
+(``OrderEventHub``) and fans messages out to in-process queues, one per
+open stream, so a waiting browser costs a socket and a queue rather than a
+Redis connection or a polling request.
+"""
+import asyncio
+import json
+import logging
+import weakref
+
+import redis
+from apps.core.redis import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = 'orders:events:'
+
+
+def order_channel(order_id):
+    return f"{CHANNEL_PREFIX}{order_id}"
+
+
+def order_state(order):
+    return {'id': str(order.pk), 'status': order.status, 'payment_status': order.payment_status}
+
+
+def publish_order_status(order):
+    try:
+        get_redis().publish(order_channel(order.pk), json.dumps(order_state(order)))
+    except redis.RedisError:
+        # Streams re-read the order when they reconnect; a payment never fails over this
+        logger.warning("Could not publish status for order %s", order.pk, exc_info=True)
+
+
+class OrderEventHub:
+    """
+    One Redis subscription per event loop, shared by every open stream.
+    The listener starts with the first stream and stops with the last.
+    """
+    def __init__(self):
+        self._waiters = {}
+        self._task = None
+        self._ready = None
+
+    async def subscribe(self, order_id):
+        """
+        Returns a queue that receives the order's state as JSON, or None
+        when the subscription is lost. Returns once Redis is listening.
+        """
+        # Only the latest state matters, so a slow reader just skips ahead
+        queue = asyncio.Queue(maxsize=1)
+        self._waiters.setdefault(str(order_id), set()).add(queue)
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._listen(self._ready))
+        ready = self._ready
+        await ready.wait()
+        return queue
+
+    def unsubscribe(self, order_id, queue):
+        waiters = self._waiters.get(str(order_id))
+        if waiters is not None:
+            waiters.discard(queue)
+            if not waiters:
+                del self._waiters[str(order_id)]
+
+    def _deliver(self, order_id, message):
+        for queue in self._waiters.get(order_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def _listen(self, ready):
+        pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+            ready.set()
+            while True:
+                if not self._waiters:
+                    # No await between the check and the reset, so a new
+                    # stream either sees this task or starts a fresh one
+                    self._task = None
+                    break
+                message = await pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    self._deliver(message['channel'][len(CHANNEL_PREFIX):], message['data'])
+        except (redis.RedisError, OSError):
+            logger.warning("Order event subscription lost", exc_info=True)
+            self._task = None
+            # End every open stream; EventSource clients reconnect on their own
+            for waiters in self._waiters.values():
+                for queue in waiters:
+                    if queue.full():
+                        queue.get_nowait()
+                    queue.put_nowait(None)
+            ready.set()
+        finally:
+            await pubsub.aclose()
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = OrderEventHub()
+    return hub
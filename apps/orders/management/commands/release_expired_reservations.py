@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from apps.orders.models import Order
+from apps.products.services import release_order_stock
+
+
+class Command(BaseCommand):
+    help = 'Returns stock held by unpaid orders whose reservation has expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl', type=int, default=settings.STOCK_RESERVATION_TTL,
+            help='Seconds an unpaid order may hold its stock (default: STOCK_RESERVATION_TTL)'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['ttl'])
+        expired = Order.objects.filter(
+            stock_status='reserved',
+            payment_status__in=['pending', 'failed'],
+            created_at__lt=cutoff,
+        ).only('pk', 'stock_status')
+
+        released = 0
+        for order in expired.iterator():
+            release_order_stock(order)
+            if order.stock_status == 'released':
+                released += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired reservation(s)'))
@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-18 17:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_existing_orders_committed(apps, schema_editor):
+    # Orders placed before reservations existed already had their stock taken
+    Order = apps.get_model('orders', 'Order')
+    Order.objects.update(stock_status='committed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_order_orders_orde_created_0fb29d_idx_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='stock_status',
+            field=models.CharField(choices=[('unreserved', 'Unreserved'), ('reserved', 'Reserved'), ('committed', 'Committed'), ('released', 'Released')], default='unreserved', max_length=20),
+        ),
+        migrations.RunPython(mark_existing_orders_committed, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['stock_status', 'created_at'], name='orders_orde_stock_s_745e0b_idx'),
+        ),
+    ]
@@ -23,6 +23,13 @@ class Order(models.Model):
         ('failed', 'Failed'),
     )
 
+    STOCK_STATUS_CHOICES = (
+        ('unreserved', 'Unreserved'),
+        ('reserved', 'Reserved'),
+        ('committed', 'Committed'),
+        ('released', 'Released'),
+    )
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='orders')
     
@@ -34,6 +41,8 @@ class Order(models.Model):
     payment_provider = models.CharField(max_length=20, choices=PAYMENT_PROVIDER_CHOICES)
     payment_status = models.CharField(max_length=20, choices=PAYMENT_STATUS_CHOICES, default='pending')
     transaction_id = models.CharField(max_length=100, blank=True, null=True)
+    # Where the order's stock reservation stands; guards against double takes/releases
+    stock_status = models.CharField(max_length=20, choices=STOCK_STATUS_CHOICES, default='unreserved')
     
     # Shipping Address (structured fields to match frontend)
     street = models.CharField(max_length=255)
@@ -51,10 +60,18 @@ class Order(models.Model):
             models.Index(fields=['created_at']),
             models.Index(fields=['status']),
             models.Index(fields=['user']),
+            # Keyset pagination seeks on (created_at, id)
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['user', 'created_at', 'id']),
+            # Expired reservation sweeps
+            models.Index(fields=['stock_status', 'created_at']),
         ]
 
     def __str__(self):
-        return f"Order {self.id} by {self.user.username}"
+        # Only name the user when already loaded, so labelling an order never queries
+        if self._meta.get_field('user').is_cached(self):
+            return f"Order {self.id} by {self.user.username}"
+        return f"Order {self.id}"
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
@@ -73,5 +90,5 @@ class OrderItem(models.Model):
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"{self.quantity} x {self.product_name} in {self.order.id}"
+        return f"{self.quantity} x {self.product_name} in {self.order_id}"
 
@@ -1,6 +1,9 @@
+from django.db import transaction
 from rest_framework import serializers
 from .models import Order, OrderItem
+from apps.products.models import Product
 from apps.products.serializers import ProductSerializer
+from apps.products.services import reserve_stock, release_sharded_stock, InsufficientStock
 
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
@@ -11,7 +14,7 @@ class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     
     # CamelCase for frontend
-    userId = serializers.ReadOnlyField(source='user.id')
+    userId = serializers.ReadOnlyField(source='user_id')
     paymentProvider = serializers.CharField(source='payment_provider')
     paymentStatus = serializers.CharField(source='payment_status', read_only=True)
     transactionId = serializers.CharField(source='transaction_id', read_only=True)
@@ -38,8 +41,24 @@ class OrderSerializer(serializers.ModelSerializer):
             'country': obj.country,
         }
 
+class OrderListSerializer(OrderSerializer):
+    """
+    Compact order for history pages; line items are left out unless the
+    client asks for them with ?expand=items.
+    """
+    items = None
+
+    class Meta(OrderSerializer.Meta):
+        fields = [field for field in OrderSerializer.Meta.fields if field != 'items']
+
+class OrderItemCreateSerializer(serializers.Serializer):
+    # Name, price and subtotal come from the catalog, never from the client
+    product = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+    product_image = serializers.URLField(max_length=500, required=False, allow_blank=True, allow_null=True)
+
 class OrderCreateSerializer(serializers.ModelSerializer):
-    items = OrderItemSerializer(many=True)
+    items = OrderItemCreateSerializer(many=True, allow_empty=False)
     
     # Frontend sends shippingAddress as an object
     shippingAddress = serializers.JSONField(write_only=True)
@@ -48,6 +67,32 @@ class OrderCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ['items', 'total', 'paymentProvider', 'shippingAddress']
+        read_only_fields = ['total']
+
+    def validate_items(self, items):
+        # One id__in query for every line instead of a lookup per line
+        ids = {item['product'] for item in items}
+        products = Product.objects.only('id', 'name', 'price', 'image').in_bulk(ids)
+        missing = sorted(ids - products.keys())
+        if missing:
+            raise serializers.ValidationError(f"Unknown product(s): {', '.join(map(str, missing))}.")
+        for item in items:
+            item['product'] = products[item['product']]
+        return items
+
+    def _build_item(self, item_data):
+        product = item_data['product']
+        image = item_data.get('product_image')
+        if not image and product.image:
+            image = self.context['request'].build_absolute_uri(product.image.url)
+        return OrderItem(
+            product=product,
+            product_name=product.name,
+            product_image=image,
+            quantity=item_data['quantity'],
+            price=product.price,
+            subtotal=product.price * item_data['quantity'],
+        )
 
     def create(self, validated_data):
         items_data = validated_data.pop('items')
@@ -60,16 +105,39 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         validated_data['zip_code'] = shipping_address.get('zip')
         validated_data['country'] = shipping_address.get('country')
         
-        order = Order.objects.create(user=self.context['request'].user, **validated_data)
-        
-        for item_data in items_data:
-            product = item_data.get('product')
-            if product:
-                # Basic stock reduction
-                if product.stock >= item_data['quantity']:
-                    product.stock -= item_data['quantity']
-                    product.save()
-            OrderItem.objects.create(order=order, **item_data)
-            
-        return order
+        items = [self._build_item(item_data) for item_data in items_data]
+        validated_data['total'] = sum(item.subtotal for item in items)
+
+        quantities = {}
+        for item in items:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+        reserved = False
+        try:
+            with transaction.atomic():
+                # Take stock for every line at once; nothing is written if any line is short
+                try:
+                    reserve_stock(quantities)
+                except InsufficientStock as exc:
+                    raise serializers.ValidationError({'items': [
+                        f"Insufficient stock for {line['sku']}: requested {line['requested']}, available {line['available']}."
+                        for line in exc.shortages
+                    ]})
+                reserved = True
 
+                order = Order.objects.create(
+                    user=self.context['request'].user,
+                    stock_status='reserved',
+                    **validated_data
+                )
+                for item in items:
+                    item.order = order
+                # bulk_create skips OrderItem.save, so subtotals are set above
+                OrderItem.objects.bulk_create(items)
+        except Exception:
+            # Stock held in Redis does not roll back with the transaction
+            if reserved:
+                release_sharded_stock(quantities)
+            raise
+
+        return order
@@ -1,3 +1,394 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+from datetime import timedelta
+from unittest import skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from apps.core.redis import get_redis
+from apps.core.testing import LOCMEM_CACHES, uses_test_redis
+from apps.payments.handlers import mark_payment_succeeded
+from apps.products.models import Category, Product
+from apps.products.services import reserve_stock, commit_order_stock, release_order_stock, InsufficientStock
+from .events import get_hub, publish_order_status
+from .models import Order, OrderItem
+from .views import OrderEventStreamView
+
+User = get_user_model()
+
+
+def create_order(user, **kwargs):
+    fields = {
+        'user': user,
+        'total': 100,
+        'payment_provider': 'stripe',
+        'street': '123 Main St',
+        'city': 'City',
+        'state': 'State',
+        'zip_code': '12345',
+        'country': 'Country',
+    }
+    fields.update(kwargs)
+    return Order.objects.create(**fields)
+
+
+def create_product(sku, stock, price=10):
+    category, _ = Category.objects.get_or_create(name='General')
+    return Product.objects.create(
+        category=category, name=f'Product {sku}', sku=sku,
+        description='Product', price=price, stock=stock, image='products/item.jpg'
+    )
+
+
+def order_payload(*lines):
+    return {
+        'items': [
+            {'product': product.pk, 'product_name': product.name, 'quantity': quantity, 'price': str(product.price)}
+            for product, quantity in lines
+        ],
+        'total': sum(product.price * quantity for product, quantity in lines),
+        'paymentProvider': 'stripe',
+        'shippingAddress': {
+            'street': '123 Main St', 'city': 'City', 'state': 'State', 'zip': '12345', 'country': 'Country'
+        },
+    }
+
+
+class OrderPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.staff = User.objects.create_user(username='staff', password='password', is_staff=True)
+        self.client.force_authenticate(user=self.staff)
+        for _ in range(5):
+            create_order(self.staff)
+
+    def test_staff_listing_is_paginated_without_count(self):
+        response = self.client.get('/api/orders/?page_size=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.data)
+        self.assertEqual(len(response.data['results']), 2)
+
+        seen = []
+        url = '/api/orders/?page_size=2'
+        while url:
+            data = self.client.get(url).data
+            seen.extend(item['id'] for item in data['results'])
+            url = data['next']
+        expected = [str(pk) for pk in Order.objects.order_by('-created_at', '-pk').values_list('pk', flat=True)]
+        self.assertEqual(seen, expected)
+
+
+class OrderConditionalGetTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.order = create_order(self.user)
+
+    def test_list_returns_304_for_unchanged_history(self):
+        etag = self.client.get('/api/orders/').headers['ETag']
+        response = self.client.get('/api/orders/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.order.status = 'shipped'
+        self.order.save()
+        response = self.client.get('/api/orders/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_retrieve_skips_serialization_when_unchanged(self):
+        url = f'/api/orders/{self.order.id}/'
+        etag = self.client.get(url).headers['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_retrieve_unknown_order_is_404(self):
+        self.assertEqual(self.client.get('/api/orders/not-a-uuid/').status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='shopper', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.phone = create_product('PH-1', stock=5)
+        self.case = create_product('CS-1', stock=1)
+
+    def test_order_reserves_every_line(self):
+        response = self.client.post('/api/orders/', order_payload((self.phone, 2), (self.case, 1)), format='json')
+        self.assertEqual(response.status_code, 201)
+
+        order = Order.objects.get()
+        self.assertEqual(order.stock_status, 'reserved')
+        self.phone.refresh_from_db()
+        self.case.refresh_from_db()
+        self.assertEqual((self.phone.stock, self.case.stock), (3, 0))
+
+    def test_short_line_rejects_whole_order(self):
+        response = self.client.post('/api/orders/', order_payload((self.phone, 2), (self.case, 3)), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('CS-1', response.data['items'][0])
+
+        self.assertFalse(Order.objects.exists())
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock, 5)
+
+    def test_release_is_idempotent_and_commit_retakes(self):
+        self.client.post('/api/orders/', order_payload((self.phone, 2),), format='json')
+        order = Order.objects.get()
+
+        release_order_stock(order)
+        release_order_stock(order)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock, 5)
+
+        # A payment that succeeds after the release takes the stock again
+        commit_order_stock(order)
+        commit_order_stock(order)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock, 3)
+        self.assertEqual(Order.objects.get().stock_status, 'committed')
+
+    def test_expired_reservations_are_released(self):
+        self.client.post('/api/orders/', order_payload((self.phone, 4),), format='json')
+        Order.objects.update(created_at=timezone.now() - timedelta(hours=2))
+
+        call_command('release_expired_reservations', ttl=3600, stdout=io.StringIO())
+
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock, 5)
+        self.assertEqual(Order.objects.get().stock_status, 'released')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BulkOrderCreateTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='bulk', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.products = [create_product(f'B-{i}', stock=10, price=i + 1) for i in range(50)]
+
+    def _create(self, products):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post('/api/orders/', order_payload(*[(p, 2) for p in products]), format='json')
+        self.assertEqual(response.status_code, 201)
+        return len(ctx)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        self.assertEqual(self._create(self.products[:5]), self._create(self.products[5:]))
+
+    def test_prices_and_total_come_from_the_catalog(self):
+        payload = order_payload((self.products[0], 3), (self.products[1], 1))
+        payload['total'] = '0.01'
+        payload['items'][0]['price'] = '0.01'
+        response = self.client.post('/api/orders/', payload, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        order = Order.objects.get()
+        self.assertEqual(order.total, 5)
+        self.assertEqual(
+            list(order.items.order_by('price').values_list('product_name', 'price', 'subtotal')),
+            [('Product B-0', 1, 3), ('Product B-1', 2, 2)]
+        )
+
+    def test_unknown_product_is_rejected(self):
+        payload = order_payload((self.products[0], 1))
+        payload['items'].append({'product': 999999, 'quantity': 1})
+        response = self.client.post('/api/orders/', payload, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('999999', str(response.data['items']))
+        self.assertFalse(OrderItem.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrderReadPathTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='reader', password='password')
+        self.client.force_authenticate(user=self.user)
+        product = create_product('R-1', stock=100)
+        for _ in range(12):
+            order = create_order(self.user)
+            OrderItem.objects.create(order=order, product=product, product_name=product.name, quantity=1, price=10)
+            OrderItem.objects.create(order=order, product=product, product_name=product.name, quantity=2, price=10)
+
+    def test_history_page_costs_two_queries_without_items(self):
+        # The validator aggregate plus the page itself
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/orders/', {'page_size': 10})
+        first = response.json()['results'][0]
+        self.assertNotIn('items', first)
+        self.assertEqual(first['userId'], self.user.pk)
+
+    def test_expand_items_prefetches_in_one_query(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/orders/', {'page_size': 10, 'expand': 'items'})
+        results = response.json()['results']
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(len(order['items']) == 2 for order in results))
+
+    def test_retrieve_includes_items(self):
+        order = Order.objects.first()
+        response = self.client.get(f'/api/orders/{order.pk}/')
+        self.assertEqual(len(response.json()['items']), 2)
+
+    def test_str_does_not_fetch_user(self):
+        order = Order.objects.only('id', 'user').first()
+        with self.assertNumQueries(0):
+            self.assertEqual(str(order), f'Order {order.pk}')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrderIdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='retrier', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.product = create_product('ID-1', stock=5)
+
+    def test_retry_replays_without_creating_a_duplicate(self):
+        payload = order_payload((self.product, 1))
+        first = self.client.post('/api/orders/', payload, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(first.status_code, 201)
+
+        with self.assertNumQueries(0):
+            retry = self.client.post('/api/orders/', payload, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['id'], first.json()['id'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 4)
+
+    def test_key_reused_with_other_body_is_rejected(self):
+        self.client.post('/api/orders/', order_payload((self.product, 1)), format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        response = self.client.post('/api/orders/', order_payload((self.product, 2)), format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, 422)
+
+    def test_failed_request_can_be_retried(self):
+        payload = order_payload((self.product, 9))
+        self.assertEqual(
+            self.client.post('/api/orders/', payload, format='json', HTTP_IDEMPOTENCY_KEY='abc').status_code, 400
+        )
+        Product.objects.filter(pk=self.product.pk).update(stock=10)
+        self.assertEqual(
+            self.client.post('/api/orders/', payload, format='json', HTTP_IDEMPOTENCY_KEY='abc').status_code, 201
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StockReservationConcurrencyTests(TransactionTestCase):
+    """
+    Hammers one product from many threads; the stock must never oversell.
+    """
+    def _hammer(self, retry_on=()):
+        product = create_product('HOT-1', stock=20)
+        results = []
+
+        def checkout():
+            try:
+                while True:
+                    try:
+                        reserve_stock({product.pk: 1})
+                        results.append(True)
+                        return
+                    except retry_on:
+                        time.sleep(random.uniform(0.01, 0.05))
+                    except InsufficientStock:
+                        results.append(False)
+                        return
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(results.count(True), 20)
+        self.assertEqual(product.stock, 0)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_checkouts_never_oversell(self):
+        self._hammer()
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite specific')
+    def test_concurrent_checkouts_never_oversell_on_sqlite(self):
+        # No row locks here: writers are serialized and the conditional
+        # UPDATE alone guards the stock. Lock conflicts are retried.
+        self._hammer(retry_on=OperationalError)
+
+
+@uses_test_redis
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrderEventStreamTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = User.objects.create_user(username='waiter', password='password')
+        self.order = create_order(self.user)
+        self.token = str(AccessToken.for_user(self.user))
+
+    async def _open(self, order, token=None):
+        request = self.factory.get(f'/api/orders/{order.pk}/events/', {'token': token or self.token})
+        return await OrderEventStreamView.as_view()(request, pk=order.pk)
+
+    def _pay(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_payment_succeeded(self.order.pk, 'pi_Stream1')
+
+    async def test_stream_pushes_payment_outcome(self):
+        response = await self._open(self.order)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+
+        first = (await anext(chunks)).decode()
+        self.assertIn('"payment_status": "pending"', first)
+
+        await sync_to_async(self._pay)()
+        second = (await asyncio.wait_for(anext(chunks), 5)).decode()
+        self.assertEqual(json.loads(second.split('data: ', 1)[1])['payment_status'], 'success')
+        # A paid order has nothing more to report
+        with self.assertRaises(StopAsyncIteration):
+            await anext(chunks)
+
+    async def test_waiters_share_one_subscription(self):
+        streams = [aiter((await self._open(self.order)).streaming_content) for _ in range(50)]
+        await asyncio.gather(*[anext(stream) for stream in streams])
+        self.assertEqual(get_redis().execute_command('PUBSUB', 'NUMPAT'), 1)
+
+        await sync_to_async(publish_order_status)(
+            Order(pk=self.order.pk, status='processing', payment_status='success')
+        )
+        updates = await asyncio.wait_for(asyncio.gather(*[anext(stream) for stream in streams]), 5)
+        self.assertTrue(all(b'"payment_status": "success"' in update for update in updates))
+
+        # Every stream ends and lets go of its queue
+        for stream in streams:
+            with self.assertRaises(StopAsyncIteration):
+                await anext(stream)
+        self.assertEqual(get_hub()._waiters, {})
+
+    async def test_requires_token_and_ownership(self):
+        response = await self._open(self.order, token='not-a-token')
+        self.assertEqual(response.status_code, 401)
+
+        other = await sync_to_async(User.objects.create_user)(username='stranger', password='password')
+        response = await self._open(self.order, token=str(AccessToken.for_user(other)))
+        self.assertEqual(response.status_code, 404)
@@ -1,11 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import OrderViewSet
+from .views import OrderViewSet, OrderEventStreamView
 
 router = DefaultRouter()
 router.register(r'', OrderViewSet, basename='order')
 
 urlpatterns = [
+    path('<uuid:pk>/events/', OrderEventStreamView.as_view(), name='order-events'),
     path('', include(router.urls)),
 ]
-
@@ -1,22 +1,90 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max, Prefetch
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
 from rest_framework import viewsets, permissions, status
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.response import Response
-from .models import Order
-from .serializers import OrderSerializer, OrderCreateSerializer
+from apps.authentication.authentication import CachedJWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from apps.core.idempotency import idempotent
+from apps.core.http import normalize_query, make_etag, add_validators, not_modified_response
+from apps.core.pagination import KeysetPagination
+from .events import get_hub, order_state
+from .models import Order, OrderItem
+from .serializers import OrderSerializer, OrderListSerializer, OrderCreateSerializer
+
+# Columns the read serializers actually render
+ORDER_READ_FIELDS = (
+    'id', 'user', 'total', 'status', 'payment_provider', 'payment_status', 'transaction_id',
+    'street', 'city', 'state', 'zip_code', 'country', 'created_at', 'updated_at',
+)
+ORDER_ITEM_READ_FIELDS = ('id', 'order', 'product', 'product_name', 'product_image', 'quantity', 'price')
 
 class OrderViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_serializer_class(self):
         if self.action == 'create':
             return OrderCreateSerializer
+        if self.action == 'list' and not self.expand_items:
+            return OrderListSerializer
         return OrderSerializer
 
+    @property
+    def expand_items(self):
+        return 'items' in self.request.query_params.get('expand', '').split(',')
+
     def get_queryset(self):
         user = self.request.user
-        if user.is_staff:
-            return Order.objects.all()
-        return Order.objects.filter(user=user)
+        queryset = Order.objects.all() if user.is_staff else Order.objects.filter(user=user)
+        if self.action in ('list', 'retrieve'):
+            # One query for the orders, plus one for all their items when shown
+            queryset = queryset.only(*ORDER_READ_FIELDS)
+            if self.action == 'retrieve' or self.expand_items:
+                queryset = queryset.prefetch_related(
+                    Prefetch('items', queryset=OrderItem.objects.only(*ORDER_ITEM_READ_FIELDS))
+                )
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        # Validators come from one aggregate over the filtered rows, so an
+        # unchanged history is answered with a 304 before serialization
+        queryset = self.filter_queryset(self.get_queryset())
+        state = queryset.order_by().aggregate(last_modified=Max('updated_at'), count=Count('pk'))
+        last_modified = int(state['last_modified'].timestamp()) if state['last_modified'] else None
+        etag = make_etag(
+            request.user.pk, request.path, normalize_query(request.query_params),
+            state['last_modified'], state['count']
+        )
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        return add_validators(super().list(request, *args, **kwargs), etag, last_modified)
 
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            updated_at = self.get_queryset().filter(pk=kwargs['pk']).values_list('updated_at', flat=True).first()
+        except ValidationError:
+            updated_at = None
+        if updated_at is None:
+            # Let the regular lookup produce the 404
+            return super().retrieve(request, *args, **kwargs)
+        etag = make_etag(kwargs['pk'], updated_at)
+        last_modified = int(updated_at.timestamp())
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        return add_validators(super().retrieve(request, *args, **kwargs), etag, last_modified)
+
+    @idempotent('orders.create')
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -25,3 +93,82 @@ class OrderViewSet(viewsets.ModelViewSet):
         # After saving, return the full serialized order
         return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
 
+
+
+def _stream_user(request):
+    """
+    Resolves the JWT from the Authorization header, or from `?token=`
+    since browsers' EventSource cannot send headers.
+    """
+    authenticator = CachedJWTAuthentication()
+    header = authenticator.get_header(request)
+    raw_token = authenticator.get_raw_token(header) if header else request.GET.get('token')
+    if not raw_token:
+        return None
+    try:
+        return authenticator.get_user(authenticator.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+def _sse(data, event='order'):
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+class OrderEventStreamView(View):
+    """
+    Server-Sent Events stream of one order's status. Sends the current
+    state, then every change published by the payment handlers, and ends
+    once the order is paid or after ORDER_EVENTS_MAX_AGE seconds.
+    Needs an ASGI server.
+    """
+    http_method_names = ['get']
+
+    async def get(self, request, pk):
+        user = await sync_to_async(_stream_user)(request)
+        if user is None:
+            return JsonResponse(
+                {'detail': 'Authentication credentials were not provided.'},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        orders = Order.objects.only('id', 'status', 'payment_status')
+        if not user.is_staff:
+            orders = orders.filter(user=user)
+        if not await orders.filter(pk=pk).aexists():
+            return JsonResponse({'detail': 'No Order matches the given query.'}, status=status.HTTP_404_NOT_FOUND)
+
+        response = StreamingHttpResponse(self.stream(orders, pk), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Keep nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream(self, orders, pk):
+        hub = get_hub()
+        queue = await hub.subscribe(pk)
+        try:
+            # Read after subscribing so no change can slip in between
+            order = await orders.filter(pk=pk).afirst()
+            if order is None:
+                return
+            yield f"retry: {settings.ORDER_EVENTS_RETRY_MS}\n" + _sse(json.dumps(order_state(order)))
+            if order.payment_status == 'success':
+                return
+
+            deadline = time.monotonic() + settings.ORDER_EVENTS_MAX_AGE
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    message = await asyncio.wait_for(
+                        queue.get(), min(remaining, settings.ORDER_EVENTS_HEARTBEAT)
+                    )
+                except asyncio.TimeoutError:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield _sse(message)
+                if json.loads(message)['payment_status'] == 'success':
+                    return
+        finally:
+            hub.unsubscribe(pk, queue)
@@ -1,3 +1,9 @@
 from django.contrib import admin
+from .models import WebhookEvent
 
-# Register your models here.
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'provider', 'event_type', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('provider', 'status', 'event_type')
+    search_fields = ('event_id', 'order_key')
+    readonly_fields = ('received_at', 'locked_at', 'processed_at')
@@ -0,0 +1,88 @@
+"""
+Payment state transitions shared by the webhook worker and the views.
+
+Each transition locks the order row and is safe to apply more than once, so
+a redelivered webhook or a confirm racing a webhook changes nothing twice.
+Settled states are published to the payment status cache, and order
+status changes to the order event streams, after commit.
+"""
+from django.db import transaction
+from django.utils import timezone
+from apps.orders.events import publish_order_status
+from apps.orders.models import Order
+from apps.products.services import commit_order_stock, release_order_stock
+from . import status_cache
+from .models import Payment
+
+
+def mark_payment_succeeded(order_id, transaction_id, raw_response=None, payment_reference=None):
+    """
+    Marks the order paid, commits its stock and settles the Payment row
+    identified by `payment_reference` (defaults to `transaction_id`).
+    Returns the order, or None if it does not exist.
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(pk=order_id).first()
+        if order is None:
+            return None
+
+        if order.payment_status != 'success':
+            order.payment_status = 'success'
+            order.status = 'processing'
+            order.transaction_id = transaction_id
+            order.save(update_fields=['payment_status', 'status', 'transaction_id', 'updated_at'])
+            transaction.on_commit(lambda: publish_order_status(order))
+
+        # Commit the stock reservation
+        commit_order_stock(order)
+
+        reference = payment_reference or transaction_id
+        payments = Payment.objects.filter(order_id=order.pk, transaction_id=reference)
+        payments.exclude(status='success').update(
+            status='success', raw_response=raw_response or {}, updated_at=timezone.now()
+        )
+        _remember_on_commit(payments, reference, 'success', order.pk)
+    return order
+
+
+def mark_payment_failed(order_id, payment_reference=None, raw_response=None):
+    """
+    Marks an unpaid order's payment failed and gives its stock back.
+    A late failure never overrides a success.
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(pk=order_id).first()
+        if order is None or order.payment_status == 'success':
+            return order
+
+        if order.payment_status != 'failed':
+            order.payment_status = 'failed'
+            order.save(update_fields=['payment_status', 'updated_at'])
+            transaction.on_commit(lambda: publish_order_status(order))
+
+        # Give the reserved stock back to other shoppers
+        release_order_stock(order)
+
+        if payment_reference:
+            payments = Payment.objects.filter(order_id=order.pk, transaction_id=payment_reference)
+            payments.filter(status='pending').update(
+                status='failed', raw_response=raw_response or {}, updated_at=timezone.now()
+            )
+            _remember_on_commit(payments, payment_reference, 'failed', order.pk)
+    return order
+
+
+def release_payment_reservation(order_id):
+    """
+    Gives an unpaid order's reserved stock back after a declined attempt.
+    The order itself stays open: the customer may try again, and a later
+    success takes the stock again.
+    """
+    release_order_stock(Order(pk=order_id))
+
+
+def _remember_on_commit(payments, reference, status, order_id):
+    # Publish to the status cache only once the new state is durable
+    provider = payments.values_list('provider', flat=True).first()
+    if provider:
+        transaction.on_commit(lambda: status_cache.remember(reference, provider, status, order_id))
@@ -0,0 +1,174 @@
+"""
+Webhook inbox: durable intake and batched processing of provider events.
+
+The webhook views only verify and store the delivery, then acknowledge it.
+``process_webhooks`` claims pending rows in arrival order, applies them
+through the shared payment handlers and records the outcome. Duplicate
+deliveries are dropped by the unique (provider, event_id) constraint, and
+events for the same order are applied one at a time, oldest first.
+"""
+import json
+import logging
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .handlers import mark_payment_succeeded, mark_payment_failed
+from .models import Payment, WebhookEvent
+from .services.bkash import BkashProvider
+from .services.http import http_client
+
+logger = logging.getLogger(__name__)
+
+STRIPE_SUCCEEDED = 'payment_intent.succeeded'
+STRIPE_FAILED = 'payment_intent.payment_failed'
+
+# bKash transactionStatus values that settle a payment
+BKASH_SUCCEEDED = {'Completed'}
+BKASH_FAILED = {'Failed', 'Cancelled', 'Expired', 'Declined'}
+
+
+def record_event(provider, event_id, payload, event_type='', order_key=''):
+    """
+    Stores a delivery unless the same event is already in the inbox.
+    Returns True when it was new.
+    """
+    _, created = WebhookEvent.objects.get_or_create(
+        provider=provider, event_id=event_id,
+        defaults={'event_type': event_type, 'order_key': str(order_key or ''), 'payload': payload},
+    )
+    return created
+
+
+def release_stale_claims():
+    """
+    Returns rows claimed by a worker that died mid-batch to the queue.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.WEBHOOK_CLAIM_TIMEOUT)
+    return WebhookEvent.objects.filter(status='processing', locked_at__lt=cutoff).update(status='pending')
+
+
+def claim_batch(batch_size):
+    with transaction.atomic():
+        ids = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(status='pending')
+            .order_by('received_at', 'id')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        WebhookEvent.objects.filter(pk__in=ids).update(status='processing', locked_at=timezone.now())
+    return list(WebhookEvent.objects.filter(pk__in=ids).order_by('received_at', 'id'))
+
+
+def process_batch(batch_size=100):
+    """
+    Claims and applies one batch. Returns ``(done, failed)`` counts.
+    """
+    release_stale_claims()
+    events = claim_batch(batch_size)
+
+    groups = {}
+    for event in events:
+        groups.setdefault(event.order_key or f'event:{event.pk}', []).append(event)
+
+    done = failed = 0
+    for order_key, group in groups.items():
+        if event_blocked(group[0], [event.pk for event in group]):
+            # An older event for this order is queued elsewhere; apply it first
+            WebhookEvent.objects.filter(pk__in=[event.pk for event in group]).update(status='pending')
+            continue
+        for index, event in enumerate(group):
+            if apply_event(event):
+                done += 1
+                continue
+            failed += 1
+            # Keep later events for the same order behind the failed one
+            WebhookEvent.objects.filter(pk__in=[later.pk for later in group[index + 1:]]).update(status='pending')
+            break
+    return done, failed
+
+
+def event_blocked(event, claimed_ids):
+    if not event.order_key:
+        return False
+    return WebhookEvent.objects.filter(
+        order_key=event.order_key, status__in=['pending', 'processing'], received_at__lt=event.received_at
+    ).exclude(pk__in=claimed_ids).exists()
+
+
+def apply_event(event):
+    """
+    Applies one event and records the outcome. Returns True on success.
+    """
+    try:
+        if event.provider == 'stripe':
+            apply_stripe_event(event)
+        elif event.provider == 'bkash':
+            apply_bkash_event(event)
+    except Exception as exc:
+        logger.exception("Webhook event %s failed", event.pk)
+        event.attempts += 1
+        event.last_error = str(exc)
+        event.status = 'failed' if event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS else 'pending'
+        event.save(update_fields=['attempts', 'last_error', 'status'])
+        return False
+
+    event.status = 'done'
+    event.processed_at = timezone.now()
+    event.save(update_fields=['status', 'processed_at'])
+    return True
+
+
+def apply_stripe_event(event):
+    intent = event.payload.get('data', {}).get('object', {})
+    order_id = intent.get('metadata', {}).get('order_id')
+    if not order_id:
+        return
+    if event.event_type == STRIPE_SUCCEEDED:
+        mark_payment_succeeded(order_id, intent['id'], raw_response=intent)
+    elif event.event_type == STRIPE_FAILED:
+        mark_payment_failed(order_id, payment_reference=intent['id'], raw_response=intent)
+
+
+def apply_bkash_event(event):
+    """
+    bKash notifications arrive as SNS messages. They are treated as hints:
+    the payment status is read back from bKash before anything changes.
+    """
+    payload = event.payload
+    if payload.get('Type') == 'SubscriptionConfirmation':
+        subscribe_url = payload.get('SubscribeURL', '')
+        # Only ever follow confirmation links that point at SNS
+        if (urlsplit(subscribe_url).hostname or '').endswith('.amazonaws.com'):
+            http_client.get(subscribe_url, 'bkash.webhook.subscribe').raise_for_status()
+        return
+
+    message = bkash_message(payload)
+    payment_id = message.get('paymentID')
+    if not payment_id:
+        return
+    payment = Payment.objects.filter(provider='bkash', transaction_id=payment_id).only('order_id').first()
+    if payment is None:
+        return
+
+    status = BkashProvider().query_payment(payment_id)
+    transaction_status = status.get('transactionStatus')
+    if transaction_status in BKASH_SUCCEEDED:
+        mark_payment_succeeded(
+            payment.order_id, status.get('trxID') or payment_id,
+            raw_response=status, payment_reference=payment_id
+        )
+    elif transaction_status in BKASH_FAILED:
+        mark_payment_failed(payment.order_id, payment_reference=payment_id, raw_response=status)
+
+
+def bkash_message(payload):
+    message = payload.get('Message', payload)
+    if isinstance(message, str):
+        try:
+            message = json.loads(message)
+        except ValueError:
+            return {}
+    return message if isinstance(message, dict) else {}
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from apps.payments.inbox import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Applies pending webhook events from the inbox in arrival order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events claimed per batch')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep running, polling every N seconds when the inbox is empty (default: drain once)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            done, failed = process_batch(options['batch_size'])
+            if done or failed:
+                self.stdout.write(f'Processed {done} event(s), {failed} failed.')
+            if done:
+                continue
+            # Idle, or only failures left: wait before retrying them
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.payments.reconcile import reconcile_payments
+
+
+class Command(BaseCommand):
+    help = 'Settles pending payments by asking Stripe and bKash where they stand'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=15 * 60, help='Only payments pending this many seconds')
+        parser.add_argument(
+            '--abandon-after', type=int, default=None,
+            help='Mark payments still open after this many seconds failed (default: PAYMENT_ABANDON_AFTER)'
+        )
+        parser.add_argument('--page-size', type=int, default=500, help='Payments read and written per batch')
+        parser.add_argument('--workers', type=int, default=16, help='Concurrent provider lookups')
+        parser.add_argument(
+            '--rate', action='append', default=[], metavar='PROVIDER=N',
+            help='Requests per second for a provider, e.g. --rate stripe=50 --rate bkash=10'
+        )
+
+    def handle(self, *args, **options):
+        rates = {}
+        for rate in options['rate']:
+            provider, _, value = rate.partition('=')
+            try:
+                rates[provider] = float(value)
+            except ValueError:
+                raise CommandError(f'Invalid --rate {rate!r}; expected PROVIDER=N')
+
+        totals = reconcile_payments(
+            older_than=options['older_than'],
+            page_size=options['page_size'],
+            workers=options['workers'],
+            rates=rates,
+            abandon_after=options['abandon_after'],
+        )
+        self.stdout.write(
+            f"Checked {totals['checked']} payment(s): {totals['succeeded']} succeeded, "
+            f"{totals['failed']} failed, {totals['errors']} error(s)."
+        )
@@ -28,5 +28,51 @@ class Payment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Confirm, webhook and reconcile lookups go by provider reference
+            models.Index(fields=['transaction_id']),
+            # reconcile_payments pages through pending rows by (created_at, id)
+            models.Index(fields=['status', 'created_at', 'id']),
+        ]
+
     def __str__(self):
         return f"{self.provider} - {self.amount} - {self.status}"
+
+
+class WebhookEvent(models.Model):
+    """
+    Inbox of provider webhook deliveries. Rows are written and acknowledged
+    by the webhook views and applied later by the process_webhooks command.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    provider = models.CharField(max_length=20, choices=Payment.PROVIDER_CHOICES)
+    event_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=100, blank=True)
+    # Events for the same order are applied in the order they arrived
+    order_key = models.CharField(max_length=64, blank=True, db_index=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['received_at', 'id']
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'event_id'], name='payments_webhook_event_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'received_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} {self.event_type or 'event'} {self.event_id}"
@@ -0,0 +1,173 @@
+"""
+Settles payments that stayed pending because the shopper walked away or a
+webhook never arrived.
+
+Pending rows are read in (created_at, id) pages. Each page's provider
+lookups run on a bounded thread pool behind per-provider rate limits, and
+the outcomes are written back in one transaction per page, each row in its
+own savepoint. Provider calls never hold a database connection.
+
+A payment the provider still reports as open (Stripe requires_action,
+bKash Initiated, ...) once it is older than the abandon cutoff is marked
+failed, which gives its reserved stock back.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .handlers import mark_payment_succeeded, mark_payment_failed
+from .inbox import BKASH_SUCCEEDED, BKASH_FAILED
+from .models import Payment
+from .services.bkash import BkashProvider
+from .services.stripe import StripeProvider
+
+logger = logging.getLogger(__name__)
+
+STRIPE_FAILED = {'canceled'}
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the worker threads of one provider.
+    """
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self._tokens = per_second
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.per_second:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.per_second, self._tokens + (now - self._updated) * self.per_second)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.per_second
+            time.sleep(delay)
+
+
+def lookup(payment, limiters, abandoned_before=None):
+    """
+    Asks the provider where a payment stands. Returns
+    ``(payment, outcome, transaction_id, raw)`` where outcome is
+    'succeeded', 'failed' or None when it is still open. An open payment
+    created before `abandoned_before` counts as failed.
+    """
+    payment, outcome, transaction_id, data = _provider_state(payment, limiters)
+    if outcome is None and abandoned_before is not None and payment.created_at < abandoned_before:
+        outcome = 'failed'
+    return payment, outcome, transaction_id, data
+
+
+def _provider_state(payment, limiters):
+    limiters[payment.provider].wait()
+    if payment.provider == 'bkash':
+        data = BkashProvider().query_payment(payment.transaction_id)
+        state = data.get('transactionStatus')
+        if state in BKASH_SUCCEEDED:
+            return payment, 'succeeded', data.get('trxID') or payment.transaction_id, data
+        if state in BKASH_FAILED:
+            return payment, 'failed', None, data
+        return payment, None, None, data
+
+    intent = StripeProvider().query_payment(payment.transaction_id)
+    data = intent.to_dict()
+    if intent.status == 'succeeded':
+        return payment, 'succeeded', intent.id, data
+    if intent.status in STRIPE_FAILED:
+        return payment, 'failed', None, data
+    return payment, None, None, data
+
+
+def pending_pages(older_than, page_size):
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    queryset = (
+        Payment.objects.filter(status='pending', created_at__lt=cutoff)
+        .exclude(transaction_id__isnull=True).exclude(transaction_id='')
+        .only('id', 'order_id', 'provider', 'transaction_id', 'created_at')
+        .order_by('created_at', 'id')
+    )
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(Q(created_at__gt=last.created_at) | Q(created_at=last.created_at, id__gt=last.id))
+        page = list(page[:page_size])
+        if not page:
+            return
+        yield page
+        last = page[-1]
+
+
+def apply_outcomes(results):
+    """
+    Writes a page of lookups back. A row that fails is rolled back to its
+    savepoint and logged; the rest of the page still commits.
+    Returns counts of succeeded, failed and errored payments.
+    """
+    succeeded = failed = errors = 0
+    with transaction.atomic():
+        for payment, outcome, transaction_id, raw in results:
+            if outcome is None:
+                continue
+            try:
+                with transaction.atomic():
+                    if outcome == 'succeeded':
+                        mark_payment_succeeded(
+                            payment.order_id, transaction_id, raw_response=raw,
+                            payment_reference=payment.transaction_id
+                        )
+                        succeeded += 1
+                    else:
+                        mark_payment_failed(
+                            payment.order_id, payment_reference=payment.transaction_id, raw_response=raw
+                        )
+                        failed += 1
+            except Exception:
+                logger.warning("Could not settle payment %s", payment.pk, exc_info=True)
+                errors += 1
+    return succeeded, failed, errors
+
+
+def reconcile_payments(older_than=15 * 60, page_size=500, workers=16, rates=None, abandon_after=None):
+    """
+    Walks every pending payment older than `older_than` seconds. `rates`
+    maps provider name to requests per second (0 or missing: unlimited).
+    Payments still open after `abandon_after` seconds (default
+    PAYMENT_ABANDON_AFTER) are marked failed.
+    Returns counts of checked, succeeded, failed and errored payments.
+    """
+    rates = rates or {}
+    if abandon_after is None:
+        abandon_after = settings.PAYMENT_ABANDON_AFTER
+    abandoned_before = timezone.now() - timedelta(seconds=abandon_after)
+    limiters = {provider: RateLimiter(rates.get(provider, 0)) for provider, _ in Payment.PROVIDER_CHOICES}
+    totals = {'checked': 0, 'succeeded': 0, 'failed': 0, 'errors': 0}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in pending_pages(older_than, page_size):
+            futures = [pool.submit(lookup, payment, limiters, abandoned_before) for payment in page]
+            results = []
+            for payment, future in zip(page, futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    logger.warning("Could not reconcile payment %s", payment.pk, exc_info=True)
+                    totals['errors'] += 1
+            succeeded, failed, errors = apply_outcomes(results)
+            totals['checked'] += len(page)
+            totals['succeeded'] += succeeded
+            totals['failed'] += failed
+            totals['errors'] += errors
+    return totals
@@ -1,13 +1,30 @@
 from abc import ABC, abstractmethod
 
+from asgiref.sync import sync_to_async
+
 class PaymentProvider(ABC):
+    # `deadline` is a time.monotonic() value the provider's calls must
+    # finish by; see services.http.request_deadline.
     @abstractmethod
-    def create_payment_intent(self, amount, currency='usd', metadata=None):
+    def create_payment_intent(self, amount, currency='usd', metadata=None, deadline=None):
         pass
     
     @abstractmethod
-    def confirm_payment(self, payment_intent_id):
+    def confirm_payment(self, payment_intent_id, deadline=None):
         pass
 
-    def query_payment(self, payment_intent_id):
+    def query_payment(self, payment_intent_id, deadline=None):
         pass
+
+    # Async counterparts for ASGI views. By default they run the blocking
+    # method in a worker thread; providers override them with native I/O.
+    async def acreate_payment_intent(self, amount, currency='usd', metadata=None, deadline=None):
+        return await sync_to_async(self.create_payment_intent)(
+            amount, currency=currency, metadata=metadata, deadline=deadline
+        )
+
+    async def aconfirm_payment(self, payment_intent_id, deadline=None):
+        return await sync_to_async(self.confirm_payment)(payment_intent_id, deadline=deadline)
+
+    async def aquery_payment(self, payment_intent_id, deadline=None):
+        return await sync_to_async(self.query_payment)(payment_intent_id, deadline=deadline)
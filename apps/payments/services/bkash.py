@@ -1,7 +1,13 @@
 from .base import PaymentProvider
+import httpx
 import requests
 import json
+from asgiref.sync import sync_to_async
+from .http import http_client, async_http_client, raise_if_past_deadline, request_deadline, time_left
+from apps.core import locks
 from django.conf import settings
+from django.core.cache import cache
+import hashlib
 import uuid
 import time
 
@@ -19,28 +25,111 @@ class BkashProvider(PaymentProvider):
             'password': self.password
         }
 
+    @property
+    def _token_cache_key(self):
+        # One token per bKash merchant account, shared by every worker
+        return f"bkash:token:{hashlib.sha256(f'{self.base_url}|{self.app_key}'.encode('utf-8')).hexdigest()}"
+
     def _get_token(self):
-        url = f"{self.base_url}/tokenized/checkout/token/grant"
+        """
+        Returns a valid id_token from the shared cache.
+
+        Tokens are renewed BKASH_TOKEN_REFRESH_MARGIN seconds before they
+        expire, through token/refresh while the refresh_token is valid and
+        token/grant otherwise. A cache lock makes sure only one worker talks
+        to bKash at a time; the others keep using the current token or wait
+        briefly for the new one.
+        """
+        cache_key = self._token_cache_key
+        lock_key = f"{cache_key}:lock"
+        state = cache.get(cache_key)
+        if self._is_fresh(state):
+            return state['id_token']
+
+        lock = locks.acquire(lock_key, settings.BKASH_TOKEN_LOCK_TIMEOUT)
+        if lock is not None:
+            try:
+                # Another worker may have renewed it while we took the lock
+                state = cache.get(cache_key)
+                if self._is_fresh(state):
+                    return state['id_token']
+                state = self._renew_token(state)
+                cache.set(cache_key, state, max(int(state['refresh_expires_at'] - time.time()), 1))
+                return state['id_token']
+            finally:
+                locks.release(lock_key, lock)
+
+        # Someone else is renewing; the current token is still usable until it expires
+        if state and state['expires_at'] > time.time():
+            return state['id_token']
+        # Never wait past the caller's own deadline
+        give_up = time.monotonic() + min(settings.BKASH_TOKEN_LOCK_TIMEOUT, time_left() or settings.BKASH_TOKEN_LOCK_TIMEOUT)
+        while time.monotonic() < give_up:
+            time.sleep(0.05)
+            state = cache.get(cache_key)
+            if state and state['expires_at'] > time.time():
+                return state['id_token']
+        # A wait cut short by the caller's deadline is reported as that
+        raise_if_past_deadline(None)
+        raise Exception("bKash Token Error: timed out waiting for token renewal")
+
+    @staticmethod
+    def _is_fresh(state):
+        return bool(state) and state['expires_at'] - settings.BKASH_TOKEN_REFRESH_MARGIN > time.time()
+
+    def _renew_token(self, state):
+        if state and state.get('refresh_token') and state['refresh_expires_at'] > time.time():
+            try:
+                return self._request_token('refresh', {'refresh_token': state['refresh_token']})
+            except Exception:
+                # A revoked refresh token falls back to a fresh grant
+                pass
+        return self._request_token('grant')
+
+    def _request_token(self, action, extra=None):
+        url = f"{self.base_url}/tokenized/checkout/token/{action}"
         payload = {
             "app_key": self.app_key,
-            "app_secret": self.app_secret
+            "app_secret": self.app_secret,
+            **(extra or {})
         }
         
         try:
-            response = requests.post(url, json=payload, headers=self.headers)
+            # Token calls only mint credentials, so they are safe to retry
+            response = http_client.post(url, f'bkash.token.{action}', idempotent=True, json=payload, headers=self.headers)
             response.raise_for_status()
             data = response.json()
-            return data.get('id_token')
         except requests.exceptions.RequestException as e:
             raise Exception(f"bKash Token Error: {str(e)}")
 
-    def create_payment_intent(self, amount, currency='BDT', metadata=None):
-        token = self._get_token()
-        if not token:
-            raise Exception("Failed to get bKash token")
+        if not data.get('id_token'):
+            raise Exception(f"bKash Token Error: {data.get('statusMessage') or data.get('msg') or 'no id_token'}")
 
-        url = f"{self.base_url}/tokenized/checkout/create"
-        
+        now = time.time()
+        return {
+            'id_token': data['id_token'],
+            'refresh_token': data.get('refresh_token'),
+            'expires_at': now + int(data.get('expires_in') or 3600),
+            # bKash refresh tokens live for 28 days
+            'refresh_expires_at': now + settings.BKASH_REFRESH_TOKEN_LIFETIME,
+        }
+
+    async def _aget_token(self):
+        # The cached token is read without blocking; renewal is rare and
+        # reuses the locked sync path in a worker thread
+        state = await cache.aget(self._token_cache_key)
+        if self._is_fresh(state):
+            return state['id_token']
+        return await sync_to_async(self._get_token)()
+
+    def _auth_headers(self, token):
+        return {
+            'Authorization': token,
+            'X-APP-Key': self.app_key,
+            'Content-Type': 'application/json'
+        }
+
+    def _create_payload(self, amount, currency, metadata):
         # Ensure metadata exists
         metadata = metadata or {}
         order_id = metadata.get('order_id', str(uuid.uuid4()))
@@ -49,13 +138,7 @@ class BkashProvider(PaymentProvider):
         # This prevents "Duplicate Invoice" errors if the user retries payment
         invoice_number = f"{order_id}_{int(time.time())}"
         
-        headers = {
-            'Authorization': token,
-            'X-APP-Key': self.app_key,
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
+        return {
             "mode": "0011",
             "payerReference": "01711111111", # Sandbox requirement or user phone
             "callbackURL": "http://localhost:8080/payment/bkash/callback", # Frontend callback
@@ -65,80 +148,139 @@ class BkashProvider(PaymentProvider):
             "merchantInvoiceNumber": invoice_number
         }
 
-        try:
-            response = requests.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('statusCode') != '0000':
-                 raise Exception(f"bKash Create Error: {data.get('statusMessage')}")
+    @staticmethod
+    def _create_result(data, token):
+        if data.get('statusCode') != '0000':
+             raise Exception(f"bKash Create Error: {data.get('statusMessage')}")
 
+        return {
+            'client_secret': token, # Storing token as client_secret for reuse if needed
+            'id': data.get('paymentID'),
+            'status': 'pending',
+            'payment_url': data.get('bkashURL'),
+            'raw_response': data
+        }
+
+    @staticmethod
+    def _execute_result(data):
+        if data.get('statusCode') != '0000':
+            # bKash declined the execution, e.g. cancelled or insufficient balance
             return {
-                'client_secret': token, # Storing token as client_secret for reuse if needed
                 'id': data.get('paymentID'),
-                'status': 'pending',
-                'payment_url': data.get('bkashURL'),
+                'status': 'failed',
+                'error': data.get('statusMessage'),
                 'raw_response': data
             }
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"bKash Create Request Error: {str(e)}")
 
-    def confirm_payment(self, payment_intent_id):
-        # For bKash, confirmation usually happens via Execute API after user interaction
-        # This method might be called with the paymentID
-        
-        # We need the token again. In a real app, we might cache it.
-        token = self._get_token()
-        
-        url = f"{self.base_url}/tokenized/checkout/execute"
-        
-        headers = {
-            'Authorization': token,
-            'X-APP-Key': self.app_key,
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            "paymentID": payment_intent_id
+        return {
+            'id': data.get('paymentID'),
+            'status': 'succeeded', # Mapped to our internal status
+            'transaction_id': data.get('trxID'),
+            'raw_response': data
         }
 
-        try:
-            response = requests.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('statusCode') != '0000':
-                 raise Exception(f"bKash Execute Error: {data.get('statusMessage')}")
+    def create_payment_intent(self, amount, currency='BDT', metadata=None, deadline=None):
+        with request_deadline(deadline):
+            token = self._get_token()
+            if not token:
+                raise Exception("Failed to get bKash token")
 
-            return {
-                'id': data.get('paymentID'),
-                'status': 'succeeded', # Mapped to our internal status
-                'transaction_id': data.get('trxID'),
-                'raw_response': data
+            url = f"{self.base_url}/tokenized/checkout/create"
+            payload = self._create_payload(amount, currency, metadata)
+
+            try:
+                response = http_client.post(url, 'bkash.checkout.create', json=payload, headers=self._auth_headers(token))
+                response.raise_for_status()
+                data = response.json()
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"bKash Create Request Error: {str(e)}")
+            return self._create_result(data, token)
+
+    async def acreate_payment_intent(self, amount, currency='BDT', metadata=None, deadline=None):
+        with request_deadline(deadline):
+            token = await self._aget_token()
+            if not token:
+                raise Exception("Failed to get bKash token")
+
+            url = f"{self.base_url}/tokenized/checkout/create"
+            payload = self._create_payload(amount, currency, metadata)
+
+            try:
+                response = await async_http_client.post(
+                    url, 'bkash.checkout.create', json=payload, headers=self._auth_headers(token)
+                )
+                response.raise_for_status()
+                data = response.json()
+            except httpx.HTTPError as e:
+                raise Exception(f"bKash Create Request Error: {str(e)}")
+            return self._create_result(data, token)
+
+    def confirm_payment(self, payment_intent_id, deadline=None):
+        with request_deadline(deadline):
+            # For bKash, confirmation usually happens via Execute API after user interaction
+            # This method might be called with the paymentID
+            token = self._get_token()
+            url = f"{self.base_url}/tokenized/checkout/execute"
+            payload = {
+                "paymentID": payment_intent_id
             }
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"bKash Execute Request Error: {str(e)}")
 
-    def query_payment(self, payment_intent_id):
-        token = self._get_token()
-        url = f"{self.base_url}/tokenized/checkout/payment/status"
-        
-        headers = {
-            'Authorization': token,
-            'X-APP-Key': self.app_key,
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            "paymentID": payment_intent_id
-        }
+            try:
+                response = http_client.post(url, 'bkash.checkout.execute', json=payload, headers=self._auth_headers(token))
+                response.raise_for_status()
+                data = response.json()
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"bKash Execute Request Error: {str(e)}")
+            return self._execute_result(data)
 
-        try:
-            response = requests.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            
-            return data
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"bKash Query Request Error: {str(e)}")
+    async def aconfirm_payment(self, payment_intent_id, deadline=None):
+        with request_deadline(deadline):
+            token = await self._aget_token()
+            url = f"{self.base_url}/tokenized/checkout/execute"
+            payload = {
+                "paymentID": payment_intent_id
+            }
+
+            try:
+                response = await async_http_client.post(
+                    url, 'bkash.checkout.execute', json=payload, headers=self._auth_headers(token)
+                )
+                response.raise_for_status()
+                data = response.json()
+            except httpx.HTTPError as e:
+                raise Exception(f"bKash Execute Request Error: {str(e)}")
+            return self._execute_result(data)
+
+    def query_payment(self, payment_intent_id, deadline=None):
+        with request_deadline(deadline):
+            token = self._get_token()
+            url = f"{self.base_url}/tokenized/checkout/payment/status"
+            payload = {
+                "paymentID": payment_intent_id
+            }
+
+            try:
+                response = http_client.post(
+                    url, 'bkash.checkout.status', idempotent=True, json=payload, headers=self._auth_headers(token)
+                )
+                response.raise_for_status()
+                return response.json()
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"bKash Query Request Error: {str(e)}")
+
+    async def aquery_payment(self, payment_intent_id, deadline=None):
+        with request_deadline(deadline):
+            token = await self._aget_token()
+            url = f"{self.base_url}/tokenized/checkout/payment/status"
+            payload = {
+                "paymentID": payment_intent_id
+            }
 
+            try:
+                response = await async_http_client.post(
+                    url, 'bkash.checkout.status', idempotent=True, json=payload, headers=self._auth_headers(token)
+                )
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPError as e:
+                raise Exception(f"bKash Query Request Error: {str(e)}")
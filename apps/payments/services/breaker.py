@@ -0,0 +1,123 @@
+"""
+Per-provider circuit breakers, shared by every worker through the cache.
+
+Calls are counted in PAYMENT_BREAKER_BUCKET-second buckets. When the last
+PAYMENT_BREAKER_WINDOW seconds hold at least PAYMENT_BREAKER_MIN_CALLS
+calls and too many of them failed or were slow, the breaker opens: calls
+to that provider fail at once with ProviderUnavailable for
+PAYMENT_BREAKER_COOLDOWN seconds. After that one probe call at a time is
+let through. A good probe closes the breaker, a bad one opens it again;
+calls that were already in flight are counted but decide nothing.
+"""
+import logging
+import math
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderUnavailable(Exception):
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider} is temporarily unavailable")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, provider):
+        self.provider = provider
+        prefix = f"payments:breaker:{provider}"
+        self.open_key = f"{prefix}:open"
+        self.half_open_key = f"{prefix}:half_open"
+        self.probe_key = f"{prefix}:probe"
+        self.bucket_prefix = f"{prefix}:bucket"
+
+    def _bucket_key(self, bucket, field):
+        return f"{self.bucket_prefix}:{bucket}:{field}"
+
+    def _window_keys(self):
+        current = int(time.time() // settings.PAYMENT_BREAKER_BUCKET)
+        buckets = range(current - settings.PAYMENT_BREAKER_WINDOW // settings.PAYMENT_BREAKER_BUCKET + 1, current + 1)
+        return {
+            field: [self._bucket_key(bucket, field) for bucket in buckets]
+            for field in ('calls', 'errors', 'slow')
+        }
+
+    def allow(self):
+        """
+        Raises ProviderUnavailable unless a call may go out now. Returns
+        True when the call is the half-open probe; pass that on to record().
+        """
+        state = cache.get_many([self.open_key, self.half_open_key])
+        reopens_at = state.get(self.open_key)
+        if reopens_at is not None:
+            raise ProviderUnavailable(self.provider, max(math.ceil(reopens_at - time.time()), 1))
+        if self.half_open_key not in state:
+            return False
+        probe_timeout = math.ceil(settings.PAYMENT_HTTP_CONNECT_TIMEOUT + settings.PAYMENT_HTTP_READ_TIMEOUT)
+        if not cache.add(self.probe_key, 1, probe_timeout):
+            # Another request is already probing
+            raise ProviderUnavailable(self.provider, 1)
+        return True
+
+    def record(self, seconds, ok, probe=False):
+        slow = seconds >= settings.PAYMENT_BREAKER_SLOW_CALL
+        bucket = int(time.time() // settings.PAYMENT_BREAKER_BUCKET)
+        for field, hit in (('calls', True), ('errors', not ok), ('slow', slow)):
+            if hit:
+                key = self._bucket_key(bucket, field)
+                cache.add(key, 0, settings.PAYMENT_BREAKER_WINDOW + settings.PAYMENT_BREAKER_BUCKET)
+                cache.incr(key)
+
+        if probe:
+            if ok and not slow:
+                self.reset()
+            else:
+                self.trip()
+            return
+        if cache.get(self.half_open_key) is not None:
+            # A straggler from before the trip; only the probe decides
+            return
+        if (not ok or slow) and self._unhealthy():
+            self.trip()
+
+    def _unhealthy(self):
+        keys = self._window_keys()
+        counts = cache.get_many([key for field_keys in keys.values() for key in field_keys])
+        totals = {field: sum(counts.get(key, 0) for key in field_keys) for field, field_keys in keys.items()}
+        if totals['calls'] < settings.PAYMENT_BREAKER_MIN_CALLS:
+            return False
+        return (
+            totals['errors'] / totals['calls'] >= settings.PAYMENT_BREAKER_ERROR_RATE
+            or totals['slow'] / totals['calls'] >= settings.PAYMENT_BREAKER_SLOW_RATE
+        )
+
+    def trip(self):
+        logger.warning("Circuit breaker for %s opened", self.provider)
+        cache.set(self.open_key, time.time() + settings.PAYMENT_BREAKER_COOLDOWN, settings.PAYMENT_BREAKER_COOLDOWN)
+        # Half-open outlives the cooldown and holds until a probe succeeds
+        cache.set(self.half_open_key, 1, None)
+        cache.delete(self.probe_key)
+
+    def reset(self):
+        logger.info("Circuit breaker for %s closed", self.provider)
+        keys = self._window_keys()
+        cache.delete_many([
+            self.open_key, self.half_open_key, self.probe_key,
+            *[key for field_keys in keys.values() for key in field_keys],
+        ])
+
+    async def aallow(self):
+        return await sync_to_async(self.allow)()
+
+    async def arecord(self, seconds, ok, probe=False):
+        await sync_to_async(self.record)(seconds, ok, probe)
+
+
+def breaker_for(endpoint):
+    # Endpoint names start with the provider, e.g. "bkash.checkout.create"
+    return CircuitBreaker(endpoint.split('.', 1)[0])
@@ -0,0 +1,279 @@
+"""
+Shared HTTP plumbing for the payment providers.
+
+Every outbound provider call goes through one process-wide client
+(``http_client``, or ``async_http_client`` from async code):
+
+* one ``requests.Session`` per host, so connections are kept alive and pooled;
+* connect/read timeouts on every request, so a slow provider cannot pin a
+  worker;
+* bounded retries with full jitter, only for calls marked idempotent (and
+  for connection failures, where the request never reached the provider);
+* per-endpoint latency metrics, readable through ``get_metrics()``;
+* a per-provider circuit breaker (see ``breaker``);
+* the caller's deadline (see ``request_deadline``), which caps timeouts and
+  retries so one slow provider cannot outlast the request that needs it.
+"""
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from .breaker import breaker_for
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class EndpointMetrics:
+    """
+    Thread-safe call counts and latency totals keyed by endpoint name.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0
+            })
+            ms = seconds * 1000
+            stats['calls'] += 1
+            stats['errors'] += not ok
+            stats['total_ms'] += ms
+            stats['max_ms'] = max(stats['max_ms'], ms)
+        logger.debug("%s took %.1fms (%s)", endpoint, seconds * 1000, 'ok' if ok else 'error')
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {**stats, 'avg_ms': stats['total_ms'] / stats['calls']}
+                for endpoint, stats in self._endpoints.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+metrics = EndpointMetrics()
+
+
+def get_metrics():
+    return metrics.snapshot()
+
+
+class DeadlineExceeded(Exception):
+    """
+    The request's time budget for provider calls ran out.
+    """
+
+
+_deadline = contextvars.ContextVar('payment_deadline', default=None)
+
+
+@contextmanager
+def request_deadline(deadline):
+    """
+    Applies a ``time.monotonic()`` deadline to the provider calls made
+    inside the block. None leaves the current deadline in place.
+    """
+    if deadline is None:
+        yield
+        return
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left():
+    """
+    Seconds until the current deadline, or None without one. Raises
+    DeadlineExceeded once it has passed.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Payment provider deadline exceeded")
+    return remaining
+
+
+def capped_timeout(connect, read):
+    remaining = time_left()
+    if remaining is None:
+        return connect, read
+    return min(connect, remaining), min(read, remaining)
+
+
+def raise_if_past_deadline(exc):
+    # A timeout cut short by the deadline is reported as the deadline
+    deadline = _deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded("Payment provider deadline exceeded") from exc
+
+
+def _pause(attempt):
+    delay = backoff(attempt)
+    remaining = time_left()
+    return delay if remaining is None else min(delay, remaining)
+
+
+def backoff(attempt):
+    # Full jitter keeps retrying workers from hitting the provider in lockstep
+    cap = min(settings.PAYMENT_HTTP_BACKOFF_MAX, settings.PAYMENT_HTTP_BACKOFF_BASE * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def _never_sent(exc):
+    """
+    True when the connection was never opened, so even a non-idempotent
+    request is safe to send again.
+    """
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(exc, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+class ProviderHTTPClient:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    @property
+    def timeout(self):
+        return (settings.PAYMENT_HTTP_CONNECT_TIMEOUT, settings.PAYMENT_HTTP_READ_TIMEOUT)
+
+    def session_for(self, url):
+        """
+        Returns the pooled session for the URL's host.
+        """
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.PAYMENT_HTTP_POOL_SIZE)
+                session.mount(host, adapter)
+                self._sessions[host] = session
+            return session
+
+    def request(self, method, url, endpoint, idempotent=False, **kwargs):
+        """
+        Sends a request and records its latency under `endpoint`.
+
+        Idempotent calls are retried on timeouts and 429/5xx gateway errors;
+        any call is retried when the connection could not be opened. Raises
+        ProviderUnavailable while the provider's breaker is open and
+        DeadlineExceeded once the caller's deadline has passed.
+        """
+        breaker = breaker_for(endpoint)
+        timeout = kwargs.pop('timeout', self.timeout)
+        session = self.session_for(url)
+        attempts = settings.PAYMENT_HTTP_MAX_RETRIES + 1
+
+        for attempt in range(attempts):
+            # Checked before every attempt so retries stop once the breaker trips
+            probe = breaker.allow()
+            started = time.monotonic()
+            try:
+                response = session.request(method, url, timeout=capped_timeout(*timeout), **kwargs)
+            except requests.exceptions.RequestException as exc:
+                elapsed = time.monotonic() - started
+                metrics.record(endpoint, elapsed, ok=False)
+                breaker.record(elapsed, ok=False, probe=probe)
+                if attempt == attempts - 1 or not (idempotent or _never_sent(exc)):
+                    raise_if_past_deadline(exc)
+                    raise
+            else:
+                elapsed, ok = time.monotonic() - started, response.status_code < 500
+                metrics.record(endpoint, elapsed, ok=ok)
+                breaker.record(elapsed, ok=ok, probe=probe)
+                if attempt == attempts - 1 or not (idempotent and response.status_code in RETRY_STATUSES):
+                    return response
+            time.sleep(_pause(attempt))
+
+    def post(self, url, endpoint, **kwargs):
+        return self.request('POST', url, endpoint, **kwargs)
+
+    def get(self, url, endpoint, **kwargs):
+        return self.request('GET', url, endpoint, idempotent=True, **kwargs)
+
+
+http_client = ProviderHTTPClient()
+
+
+class AsyncProviderHTTPClient:
+    """
+    The async counterpart of ProviderHTTPClient, on a pooled
+    ``httpx.AsyncClient`` per event loop, with the same timeouts, retry
+    rules and metrics.
+    """
+    def __init__(self):
+        self._clients = weakref.WeakKeyDictionary()
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(settings.PAYMENT_HTTP_READ_TIMEOUT, connect=settings.PAYMENT_HTTP_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.PAYMENT_HTTP_ASYNC_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.PAYMENT_HTTP_POOL_SIZE,
+                ),
+            )
+        return client
+
+    async def request(self, method, url, endpoint, idempotent=False, **kwargs):
+        breaker = breaker_for(endpoint)
+        client = self.client()
+        attempts = settings.PAYMENT_HTTP_MAX_RETRIES + 1
+
+        for attempt in range(attempts):
+            probe = await breaker.aallow()
+            connect, read = capped_timeout(settings.PAYMENT_HTTP_CONNECT_TIMEOUT, settings.PAYMENT_HTTP_READ_TIMEOUT)
+            started = time.monotonic()
+            try:
+                response = await client.request(method, url, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+            except httpx.TransportError as exc:
+                elapsed = time.monotonic() - started
+                metrics.record(endpoint, elapsed, ok=False)
+                await breaker.arecord(elapsed, ok=False, probe=probe)
+                never_sent = isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+                if attempt == attempts - 1 or not (idempotent or never_sent):
+                    raise_if_past_deadline(exc)
+                    raise
+            else:
+                elapsed, ok = time.monotonic() - started, response.status_code < 500
+                metrics.record(endpoint, elapsed, ok=ok)
+                await breaker.arecord(elapsed, ok=ok, probe=probe)
+                if attempt == attempts - 1 or not (idempotent and response.status_code in RETRY_STATUSES):
+                    return response
+            await asyncio.sleep(_pause(attempt))
+
+    async def post(self, url, endpoint, **kwargs):
+        return await self.request('POST', url, endpoint, **kwargs)
+
+    async def get(self, url, endpoint, **kwargs):
+        return await self.request('GET', url, endpoint, idempotent=True, **kwargs)
+
+
+async_http_client = AsyncProviderHTTPClient()
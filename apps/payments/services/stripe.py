@@ -1,37 +1,159 @@
+import re
+import time
+
+import httpx
 import stripe
 
 from django.conf import settings
 from .base import PaymentProvider
+from .breaker import breaker_for
+from .http import http_client, metrics, capped_timeout, request_deadline, raise_if_past_deadline
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
+# Object ids such as pi_3Nx... are collapsed so metrics group by endpoint
+STRIPE_ID_RE = re.compile(r'/[a-z]+_(?=[A-Za-z0-9]*[A-Z0-9])[A-Za-z0-9]+')
 
-class StripeProvider(PaymentProvider):
-    def create_payment_intent(self, amount, currency='usd', metadata=None):
+
+def _endpoint(method, url):
+    return f"stripe.{method.upper()} {STRIPE_ID_RE.sub('/:id', url.split('?')[0].split('stripe.com', 1)[-1])}"
+
+
+class MeteredStripeClient(stripe.RequestsClient):
+    """
+    Stripe's requests client on a pooled session, recording per-endpoint
+    latency alongside the other provider calls, behind the Stripe circuit
+    breaker and within the caller's deadline.
+    """
+    # The SDK reads self._timeout on every request; cap it to the deadline
+    @property
+    def _timeout(self):
+        return capped_timeout(*self._base_timeout)
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._base_timeout = value
+
+    def request(self, method, url, headers, post_data=None):
+        endpoint = _endpoint(method, url)
+        breaker = breaker_for(endpoint)
+        probe = breaker.allow()
+        started = time.monotonic()
         try:
-            # Stripe expects amount in cents
-            amount_cents = int(amount * 100)
-            intent = stripe.PaymentIntent.create(
-                amount=amount_cents,
-                currency=currency,
-                metadata=metadata or {},
-                automatic_payment_methods={
-                    'enabled': True,
-                },
-            )
-            return {
-                'client_secret': intent.client_secret,
-                'id': intent.id,
-                'status': intent.status
-            }
-        except stripe.error.StripeError as e:
-            raise Exception(f"Stripe error: {str(e)}")
-
-    def confirm_payment(self, payment_intent_id):
+            content, status_code, response_headers = super().request(method, url, headers, post_data)
+        except stripe.error.APIConnectionError as exc:
+            elapsed = time.monotonic() - started
+            metrics.record(endpoint, elapsed, ok=False)
+            breaker.record(elapsed, ok=False, probe=probe)
+            raise_if_past_deadline(exc)
+            raise
+        elapsed, ok = time.monotonic() - started, status_code < 500
+        metrics.record(endpoint, elapsed, ok=ok)
+        breaker.record(elapsed, ok=ok, probe=probe)
+        return content, status_code, response_headers
+
+    async def request_async(self, method, url, headers, post_data=None):
+        endpoint = _endpoint(method, url)
+        breaker = breaker_for(endpoint)
+        probe = await breaker.aallow()
+        started = time.monotonic()
         try:
-            intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-            return intent
-        except stripe.error.StripeError as e:
-            raise Exception(f"Stripe error: {str(e)}")
+            content, status_code, response_headers = await super().request_async(method, url, headers, post_data)
+        except stripe.error.APIConnectionError as exc:
+            elapsed = time.monotonic() - started
+            metrics.record(endpoint, elapsed, ok=False)
+            await breaker.arecord(elapsed, ok=False, probe=probe)
+            raise_if_past_deadline(exc)
+            raise
+        elapsed, ok = time.monotonic() - started, status_code < 500
+        metrics.record(endpoint, elapsed, ok=ok)
+        await breaker.arecord(elapsed, ok=ok, probe=probe)
+        return content, status_code, response_headers
+
+
+class DeadlineHTTPXClient(stripe.HTTPXClient):
+    """
+    The httpx client behind the SDK's *_async methods, with timeouts capped
+    to the caller's deadline.
+    """
+    @property
+    def _timeout(self):
+        connect, read = capped_timeout(self._base_timeout.connect, self._base_timeout.read)
+        return httpx.Timeout(read, connect=connect)
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._base_timeout = value
+
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.default_http_client = MeteredStripeClient(
+    timeout=http_client.timeout,
+    session=http_client.session_for('https://api.stripe.com'),
+    # The *_async SDK methods go through httpx
+    async_fallback_client=DeadlineHTTPXClient(
+        timeout=httpx.Timeout(settings.PAYMENT_HTTP_READ_TIMEOUT, connect=settings.PAYMENT_HTTP_CONNECT_TIMEOUT)
+    ),
+)
+# The SDK retries with jittered backoff and adds idempotency keys to retried POSTs
+stripe.max_network_retries = settings.PAYMENT_HTTP_MAX_RETRIES
+
+class StripeProvider(PaymentProvider):
+    def create_payment_intent(self, amount, currency='usd', metadata=None, deadline=None):
+        with request_deadline(deadline):
+            try:
+                # Stripe expects amount in cents
+                amount_cents = int(amount * 100)
+                intent = stripe.PaymentIntent.create(
+                    amount=amount_cents,
+                    currency=currency,
+                    metadata=metadata or {},
+                    automatic_payment_methods={
+                        'enabled': True,
+                    },
+                )
+                return {
+                    'client_secret': intent.client_secret,
+                    'id': intent.id,
+                    'status': intent.status
+                }
+            except stripe.error.StripeError as e:
+                raise Exception(f"Stripe error: {str(e)}")
+
+    def confirm_payment(self, payment_intent_id, deadline=None):
+        with request_deadline(deadline):
+            try:
+                intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+                return intent
+            except stripe.error.StripeError as e:
+                raise Exception(f"Stripe error: {str(e)}")
+
+    def query_payment(self, payment_intent_id, deadline=None):
+        return self.confirm_payment(payment_intent_id, deadline=deadline)
+
+    async def acreate_payment_intent(self, amount, currency='usd', metadata=None, deadline=None):
+        with request_deadline(deadline):
+            try:
+                intent = await stripe.PaymentIntent.create_async(
+                    amount=int(amount * 100),
+                    currency=currency,
+                    metadata=metadata or {},
+                    automatic_payment_methods={
+                        'enabled': True,
+                    },
+                )
+                return {
+                    'client_secret': intent.client_secret,
+                    'id': intent.id,
+                    'status': intent.status
+                }
+            except stripe.error.StripeError as e:
+                raise Exception(f"Stripe error: {str(e)}")
+
+    async def aconfirm_payment(self, payment_intent_id, deadline=None):
+        with request_deadline(deadline):
+            try:
+                return await stripe.PaymentIntent.retrieve_async(payment_intent_id)
+            except stripe.error.StripeError as e:
+                raise Exception(f"Stripe error: {str(e)}")
 
-    def query_payment(self, payment_intent_id):
-        return self.confirm_payment(payment_intent_id)
+    async def aquery_payment(self, payment_intent_id, deadline=None):
+        return await self.aconfirm_payment(payment_intent_id, deadline=deadline)
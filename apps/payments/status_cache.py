@@ -0,0 +1,57 @@
+"""
+Settled payment states, keyed by provider reference.
+
+The payment handlers write here once a transition commits, whether it came
+from a webhook, the reconciler or a confirm call. Confirm answers from this
+cache (then from the Payment row) and only asks the provider while the
+payment is still open.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+# A failed Stripe attempt can still be retried on the same intent, so only
+# a success is final there; bKash payments cannot be re-executed
+TERMINAL_STATUSES = {
+    'stripe': {'success'},
+    'bkash': {'success', 'failed'},
+}
+
+
+def status_cache_key(reference):
+    return f"payments:status:{reference}"
+
+
+def is_terminal(provider, status):
+    return status in TERMINAL_STATUSES.get(provider, ())
+
+
+def remember(reference, provider, status, order_id):
+    if not reference or not is_terminal(provider, status):
+        return
+    cache.set(
+        status_cache_key(reference),
+        {'provider': provider, 'status': status, 'order_id': str(order_id)},
+        settings.PAYMENT_STATUS_CACHE_TTL
+    )
+
+
+def settled(reference):
+    """
+    Returns ``{'provider', 'status', 'order_id'}`` for a settled payment,
+    or None while it is open or unknown.
+    """
+    return cache.get(status_cache_key(reference))
+
+
+async def asettled(reference):
+    return await cache.aget(status_cache_key(reference))
+
+
+def settled_from_payment(payment):
+    """
+    Falls back to the Payment row and backfills the cache from it.
+    """
+    if payment is None or not is_terminal(payment.provider, payment.status):
+        return None
+    remember(payment.transaction_id, payment.provider, payment.status, payment.order_id)
+    return {'provider': payment.provider, 'status': payment.status, 'order_id': str(payment.order_id)}
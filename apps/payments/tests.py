@@ -1,13 +1,39 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import hmac
+import io
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.utils import timezone
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from apps.orders.models import Order
+from apps.orders.models import Order, OrderItem
+from apps.products.models import Category, Product
 from rest_framework_api_key.models import APIKey
-from unittest.mock import patch
+from rest_framework_simplejwt.tokens import AccessToken
+from unittest.mock import AsyncMock, patch
+import stripe
+from asgiref.sync import sync_to_async
+from apps.core.testing import LOCMEM_CACHES
+from .models import Payment, WebhookEvent
+from .handlers import mark_payment_failed, mark_payment_succeeded
+from .reconcile import RateLimiter, reconcile_payments
+from .services.bkash import BkashProvider
+from .services.breaker import CircuitBreaker, ProviderUnavailable
+from .services.http import DeadlineExceeded, get_metrics, metrics, request_deadline
+from .views import AsyncConfirmPaymentView, AsyncCreatePaymentIntentView
 
 User = get_user_model()
 
+@override_settings(CACHES=LOCMEM_CACHES)
 class PaymentAPITests(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -62,3 +88,728 @@ class PaymentAPITests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['id'], 'bkash_123')
         self.assertEqual(response.data['payment_url'], 'http://bkash.com/pay')
+
+    @patch('apps.payments.services.stripe.StripeProvider.confirm_payment')
+    def test_confirm_stripe_payment(self, mock_confirm):
+        mock_confirm.return_value = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_789', 'status': 'succeeded', 'metadata': {'order_id': str(self.order.id)}}, 'sk_test'
+        )
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/api/payments/confirm-payment/', {'payment_intent_id': 'pi_789'})
+
+        self.assertEqual(response.data['status'], 'success')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'success')
+        self.assertEqual(self.order.payments.get().status, 'success')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaymentIntentIdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='retrier', password='password')
+        self.order = Order.objects.create(
+            user=self.user, total=100.00, street='123 Main St', city='City',
+            state='State', zip_code='12345', country='Country'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    @patch('apps.payments.services.stripe.StripeProvider.create_payment_intent')
+    def test_retry_does_not_call_provider_again(self, mock_create_intent):
+        mock_create_intent.return_value = {'id': 'pi_123', 'client_secret': 'secret', 'status': 'pending'}
+        data = {'order_id': str(self.order.id)}
+
+        first = self.client.post('/api/payments/create-payment-intent/', data, HTTP_IDEMPOTENCY_KEY='k1')
+        retry = self.client.post('/api/payments/create-payment-intent/', data, HTTP_IDEMPOTENCY_KEY='k1')
+
+        self.assertEqual(first.data, retry.data)
+        self.assertEqual(mock_create_intent.call_count, 1)
+        self.assertEqual(self.order.payments.count(), 1)
+
+    @patch('apps.payments.services.stripe.StripeProvider.create_payment_intent')
+    def test_in_flight_duplicate_gets_conflict(self, mock_create_intent):
+        client = self.client
+
+        def create_intent(**kwargs):
+            # A second delivery of the same request while the first is running
+            duplicate = client.post('/api/payments/create-payment-intent/', data, HTTP_IDEMPOTENCY_KEY='k2')
+            self.assertEqual(duplicate.status_code, status.HTTP_409_CONFLICT)
+            return {'id': 'pi_456', 'client_secret': 'secret', 'status': 'pending'}
+
+        mock_create_intent.side_effect = create_intent
+        data = {'order_id': str(self.order.id)}
+        response = self.client.post('/api/payments/create-payment-intent/', data, HTTP_IDEMPOTENCY_KEY='k2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(mock_create_intent.call_count, 1)
+
+
+class StubBkashHandler(BaseHTTPRequestHandler):
+    """
+    Just enough of the bKash tokenized checkout API for the provider tests.
+    `server.failures` maps an action to HTTP statuses to answer first and
+    `server.delays` to seconds to stall before answering.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        action = self.path.rsplit('/', 1)[-1]
+        server = self.server
+        with server.lock:
+            server.calls.append(action)
+            server.ports.add(self.client_address[1])
+            serial = len(server.calls)
+            failures = server.failures.get(action)
+            failure = failures.pop(0) if failures else None
+
+        time.sleep(server.delays.get(action, 0))
+        if failure:
+            data = {'statusCode': '9999', 'statusMessage': 'Unavailable'}
+        elif action == 'grant':
+            time.sleep(server.grant_delay)
+            data = {'statusCode': '0000', 'id_token': f'grant-{serial}', 'refresh_token': f'refresh-{serial}', 'expires_in': 3600}
+        elif action == 'status':
+            data = {
+                'statusCode': '0000', 'paymentID': body['paymentID'], 'trxID': f"TRX-{body['paymentID']}",
+                'transactionStatus': server.bkash_statuses.get(body['paymentID'], 'Initiated'),
+            }
+        elif action == 'refresh':
+            data = {'statusCode': '0000', 'id_token': f'refreshed-{serial}', 'refresh_token': body['refresh_token'], 'expires_in': 3600}
+        else:
+            data = {'statusCode': '0000', 'paymentID': f'P{serial}', 'bkashURL': 'http://pay', 'token': self.headers['Authorization']}
+
+        payload = json.dumps(data).encode('utf-8')
+        try:
+            self.send_response(failure or 200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up first, e.g. in the timeout test
+            pass
+
+    def do_GET(self):
+        # Stripe: GET /v1/payment_intents/<id>
+        intent_id = self.path.rsplit('/', 1)[-1]
+        with self.server.lock:
+            self.server.calls.append('intent')
+        payload = json.dumps({
+            'id': intent_id, 'object': 'payment_intent',
+            'status': self.server.stripe_statuses.get(intent_id, 'requires_payment_method'),
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubBkashServerMixin:
+    def start_stub_bkash(self):
+        cache.clear()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubBkashHandler)
+        self.server.calls = []
+        self.server.ports = set()
+        self.server.failures = {}
+        self.server.delays = {}
+        self.server.bkash_statuses = {}
+        self.server.stripe_statuses = {}
+        self.server.lock = threading.Lock()
+        self.server.grant_delay = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        settings_override = override_settings(BKASH_BASE_URL=f'http://127.0.0.1:{self.server.server_port}')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BkashTokenCacheTests(StubBkashServerMixin, TestCase):
+    def setUp(self):
+        self.start_stub_bkash()
+
+    def test_token_is_granted_once_across_workers(self):
+        for _ in range(3):
+            # A new provider per call, as separate requests/workers would have
+            BkashProvider().create_payment_intent(100, metadata={'order_id': 'o1'})
+        self.assertEqual(self.server.calls.count('grant'), 1)
+        self.assertEqual(self.server.calls.count('create'), 3)
+
+    def test_expiring_token_is_refreshed_not_regranted(self):
+        provider = BkashProvider()
+        first = provider._get_token()
+        state = cache.get(provider._token_cache_key)
+        state['expires_at'] = time.time() + 60
+        cache.set(provider._token_cache_key, state)
+
+        second = BkashProvider()._get_token()
+        self.assertNotEqual(first, second)
+        self.assertTrue(second.startswith('refreshed-'))
+        self.assertEqual(self.server.calls, ['grant', 'refresh'])
+
+    def test_concurrent_workers_share_one_grant(self):
+        self.server.grant_delay = 0.2
+        tokens = []
+
+        def worker():
+            tokens.append(BkashProvider()._get_token())
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.calls, ['grant'])
+        self.assertEqual(len(set(tokens)), 1)
+
+    def test_waiting_for_renewal_stops_at_the_deadline(self):
+        provider = BkashProvider()
+        # Another worker holds the renewal lock and no usable token is cached
+        cache.set(f'{provider._token_cache_key}:lock', 1)
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded), request_deadline(started + 0.2):
+            provider._get_token()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.server.calls, [])
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    PAYMENT_HTTP_BACKOFF_BASE=0,
+    PAYMENT_HTTP_READ_TIMEOUT=0.3,
+)
+class ProviderHTTPClientTests(StubBkashServerMixin, TestCase):
+    def setUp(self):
+        self.start_stub_bkash()
+        metrics.reset()
+
+    def test_calls_reuse_pooled_connections(self):
+        provider = BkashProvider()
+        for _ in range(3):
+            provider.query_payment('P1')
+        self.assertEqual(len(self.server.ports), 1)
+
+    def test_idempotent_call_retries_gateway_errors(self):
+        self.server.failures['status'] = [503]
+        BkashProvider().query_payment('P1')
+        self.assertEqual(self.server.calls.count('status'), 2)
+        self.assertEqual(get_metrics()['bkash.checkout.status']['errors'], 1)
+
+    def test_payment_creation_is_not_retried(self):
+        self.server.failures['create'] = [503]
+        with self.assertRaises(Exception):
+            BkashProvider().create_payment_intent(100, metadata={'order_id': 'o1'})
+        self.assertEqual(self.server.calls.count('create'), 1)
+
+    def test_slow_provider_times_out(self):
+        self.server.delays['execute'] = 1
+        started = time.monotonic()
+        with self.assertRaisesMessage(Exception, 'bKash Execute Request Error'):
+            BkashProvider().confirm_payment('P1')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.server.calls.count('execute'), 1)
+
+
+WEBHOOK_SECRET = 'whsec_test'
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+)
+class WebhookInboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='payer', password='password')
+        self.order = Order.objects.create(
+            user=self.user, total=100.00, street='123 Main St', city='City',
+            state='State', zip_code='12345', country='Country'
+        )
+        Payment.objects.create(
+            order=self.order, user=self.user, amount=100, provider='stripe', transaction_id='pi_1'
+        )
+
+    def _stripe(self, event_id, event_type):
+        payload = json.dumps({
+            'id': event_id,
+            'type': event_type,
+            'data': {'object': {'id': 'pi_1', 'metadata': {'order_id': str(self.order.id)}}},
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(WEBHOOK_SECRET.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            '/api/payments/webhook/stripe/', payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}'
+        )
+
+    def _drain(self):
+        call_command('process_webhooks', stdout=open('/dev/null', 'w'))
+
+    def test_webhook_is_stored_once_and_applied_by_worker(self):
+        self.assertEqual(self._stripe('evt_1', 'payment_intent.succeeded').status_code, 200)
+        self.assertEqual(self._stripe('evt_1', 'payment_intent.succeeded').status_code, 200)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+        # Acknowledged, not yet applied
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'pending')
+
+        self._drain()
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.stock_status), ('success', 'committed'))
+        self.assertEqual(Payment.objects.get().status, 'success')
+        self.assertEqual(WebhookEvent.objects.get().status, 'done')
+
+    def test_events_for_an_order_apply_in_arrival_order(self):
+        self._stripe('evt_1', 'payment_intent.payment_failed')
+        self._stripe('evt_2', 'payment_intent.succeeded')
+        self._stripe('evt_3', 'payment_intent.payment_failed')
+        self._drain()
+
+        # The retry succeeded; the stale failure after it cannot undo that
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'success')
+        self.assertEqual(set(WebhookEvent.objects.values_list('status', flat=True)), {'done'})
+
+    def test_bad_signature_is_rejected(self):
+        response = self.client.post(
+            '/api/payments/webhook/stripe/', '{}', content_type='application/json', HTTP_STRIPE_SIGNATURE='t=1,v1=bad'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    @patch('apps.payments.services.bkash.BkashProvider.query_payment')
+    def test_bkash_notification_is_verified_with_bkash(self, mock_query):
+        Payment.objects.create(
+            order=self.order, user=self.user, amount=100, provider='bkash', transaction_id='BK1'
+        )
+        mock_query.return_value = {'paymentID': 'BK1', 'transactionStatus': 'Completed', 'trxID': 'TRX9'}
+        message = {'paymentID': 'BK1', 'transactionStatus': 'Completed', 'merchantInvoiceNumber': f'{self.order.id}_1'}
+        payload = {'Type': 'Notification', 'MessageId': 'm-1', 'Message': json.dumps(message)}
+
+        response = self.client.post('/api/payments/webhook/bkash/', payload, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WebhookEvent.objects.get().order_key, str(self.order.id))
+
+        self._drain()
+        mock_query.assert_called_once_with('BK1')
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.transaction_id), ('success', 'TRX9'))
+        self.assertEqual(Payment.objects.get(transaction_id='BK1').status, 'success')
+
+    def test_bkash_notification_with_oversized_fields_is_stored_without_order_key(self):
+        message = {'paymentID': 'BK3', 'merchantInvoiceNumber': 'x' * 300 + '_1'}
+        payload = {'Type': 'Notification', 'MessageId': 'm-3', 'Message': json.dumps(message)}
+
+        response = self.client.post('/api/payments/webhook/bkash/', payload, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WebhookEvent.objects.get().order_key, '')
+
+        payload['MessageId'] = 'm' * 300
+        response = self.client.post('/api/payments/webhook/bkash/', payload, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @patch('apps.payments.services.bkash.BkashProvider.query_payment', side_effect=Exception('bKash down'))
+    def test_failed_event_stays_queued_for_retry(self, mock_query):
+        payload = {'Type': 'Notification', 'MessageId': 'm-2', 'Message': json.dumps({'paymentID': 'BK2'})}
+        Payment.objects.create(
+            order=self.order, user=self.user, amount=100, provider='bkash', transaction_id='BK2'
+        )
+        self.client.post('/api/payments/webhook/bkash/', payload, format='json')
+        with self.assertLogs('apps.payments.inbox', 'ERROR'):
+            self._drain()
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts, event.last_error), ('pending', 1, 'bKash down'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ReconcilePaymentsTests(StubBkashServerMixin, TestCase):
+    def setUp(self):
+        self.start_stub_bkash()
+        stub_url = f'http://127.0.0.1:{self.server.server_port}'
+        for name, value in (('api_base', stub_url), ('api_key', 'sk_test_stub'), ('max_network_retries', 0)):
+            patcher = patch.object(stripe, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user(username='payer', password='password')
+        self.payments = {}
+        for provider, reference in [
+            ('stripe', 'pi_Paid1'), ('stripe', 'pi_Gone2'), ('stripe', 'pi_Open3'),
+            ('bkash', 'BKPAID'), ('bkash', 'BKFAIL'), ('bkash', 'BKOPEN'),
+        ]:
+            order = Order.objects.create(
+                user=self.user, total=10, payment_provider=provider, street='1 St', city='City',
+                state='State', zip_code='1', country='Country'
+            )
+            self.payments[reference] = Payment.objects.create(
+                order=order, user=self.user, amount=10, provider=provider, transaction_id=reference
+            )
+        self.server.stripe_statuses.update({'pi_Paid1': 'succeeded', 'pi_Gone2': 'canceled'})
+        self.server.bkash_statuses.update({'BKPAID': 'Completed', 'BKFAIL': 'Failed'})
+
+    def _status(self, reference):
+        payment = Payment.objects.select_related('order').get(transaction_id=reference)
+        return payment.status, payment.order.payment_status
+
+    def test_pending_payments_are_settled_from_the_providers(self):
+        out = io.StringIO()
+        call_command(
+            'reconcile_payments', older_than=0, page_size=2, workers=4,
+            rate=['stripe=100', 'bkash=100'], stdout=out
+        )
+
+        self.assertEqual(self._status('pi_Paid1'), ('success', 'success'))
+        self.assertEqual(self._status('pi_Gone2'), ('failed', 'failed'))
+        self.assertEqual(self._status('pi_Open3'), ('pending', 'pending'))
+        self.assertEqual(self._status('BKPAID'), ('success', 'success'))
+        self.assertEqual(self._status('BKFAIL'), ('failed', 'failed'))
+        self.assertEqual(self._status('BKOPEN'), ('pending', 'pending'))
+        self.assertIn('Checked 6 payment(s): 2 succeeded, 2 failed, 0 error(s).', out.getvalue())
+        self.assertEqual(self.server.calls.count('intent'), 3)
+        self.assertEqual(self.server.calls.count('status'), 3)
+
+    def test_recent_payments_are_left_alone(self):
+        totals = reconcile_payments(older_than=3600)
+        self.assertEqual(totals['checked'], 0)
+        self.assertEqual(self.server.calls, [])
+
+    @patch('apps.payments.handlers.release_order_stock')
+    def test_payments_open_past_the_cutoff_are_failed(self, mock_release):
+        stale = timezone.now() - timedelta(days=2)
+        Payment.objects.filter(transaction_id__in=['pi_Open3', 'BKOPEN']).update(created_at=stale)
+
+        totals = reconcile_payments(older_than=0, abandon_after=24 * 60 * 60)
+
+        self.assertEqual(self._status('pi_Open3'), ('failed', 'failed'))
+        self.assertEqual(self._status('BKOPEN'), ('failed', 'failed'))
+        self.assertEqual((totals['succeeded'], totals['failed']), (2, 4))
+        released = {call.args[0].pk for call in mock_release.call_args_list}
+        self.assertIn(self.payments['pi_Open3'].order_id, released)
+        self.assertIn(self.payments['BKOPEN'].order_id, released)
+
+    def test_a_failing_row_does_not_roll_back_its_page(self):
+        def settle(order_id, payment_reference=None, raw_response=None):
+            if payment_reference == 'BKFAIL':
+                raise RuntimeError('lock timeout')
+            return mark_payment_failed(order_id, payment_reference=payment_reference, raw_response=raw_response)
+
+        with patch('apps.payments.reconcile.mark_payment_failed', side_effect=settle), \
+                self.assertLogs('apps.payments.reconcile', 'WARNING'):
+            totals = reconcile_payments(older_than=0)
+
+        self.assertEqual(self._status('BKFAIL'), ('pending', 'pending'))
+        self.assertEqual(self._status('pi_Gone2'), ('failed', 'failed'))
+        self.assertEqual(self._status('BKPAID'), ('success', 'success'))
+        self.assertEqual((totals['succeeded'], totals['failed'], totals['errors']), (2, 1, 1))
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = RateLimiter(20)
+        started = time.monotonic()
+        for _ in range(30):
+            limiter.wait()
+        # The first 20 come from the full bucket, the other 10 at 20/s
+        self.assertGreaterEqual(time.monotonic() - started, 0.45)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AsyncPaymentViewTests(StubBkashServerMixin, TestCase):
+    def setUp(self):
+        self.start_stub_bkash()
+        self.factory = AsyncRequestFactory()
+        self.user = User.objects.create_user(username='async-payer', password='password')
+        self.orders = [
+            Order.objects.create(
+                user=self.user, total=100, street='1 St', city='City', state='State', zip_code='1', country='Country'
+            )
+            for _ in range(5)
+        ]
+        self.auth = f'Bearer {AccessToken.for_user(self.user)}'
+
+    def _post(self, view, data, **headers):
+        request = self.factory.post(
+            '/api/payments/', data, content_type='application/json',
+            headers={'Authorization': self.auth, **headers}
+        )
+        return view.as_view()(request)
+
+    async def test_checkouts_wait_on_bkash_concurrently(self):
+        self.server.delays['create'] = 0.3
+        started = time.monotonic()
+        responses = await asyncio.gather(*[
+            self._post(AsyncCreatePaymentIntentView, {'order_id': order.pk, 'provider': 'bkash'})
+            for order in self.orders
+        ])
+        elapsed = time.monotonic() - started
+
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+        self.assertEqual(await Payment.objects.filter(provider='bkash', status='pending').acount(), 5)
+        # Five 0.3s provider calls overlap instead of queueing
+        self.assertLess(elapsed, 1.2)
+        self.assertEqual(self.server.calls.count('grant'), 1)
+
+    async def test_confirm_settles_bkash_payment(self):
+        created = await self._post(AsyncCreatePaymentIntentView, {'order_id': self.orders[0].pk, 'provider': 'bkash'})
+        payment_id = json.loads(created.content)['id']
+
+        response = await self._post(AsyncConfirmPaymentView, {'payment_intent_id': payment_id})
+
+        self.assertEqual(json.loads(response.content), {'status': 'success', 'order_id': str(self.orders[0].pk)})
+        payment = await Payment.objects.select_related('order').aget(transaction_id=payment_id)
+        self.assertEqual((payment.status, payment.order.payment_status), ('success', 'success'))
+
+    @patch('apps.payments.services.stripe.StripeProvider.aconfirm_payment', new_callable=AsyncMock)
+    async def test_confirm_settles_stripe_intent(self, mock_confirm):
+        order = self.orders[0]
+        mock_confirm.return_value = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_Async1', 'status': 'succeeded', 'metadata': {'order_id': str(order.pk)}}, 'sk_test'
+        )
+
+        response = await self._post(AsyncConfirmPaymentView, {'payment_intent_id': 'pi_Async1'})
+
+        self.assertEqual(response.status_code, 200)
+        payment = await Payment.objects.select_related('order').aget(transaction_id='pi_Async1')
+        self.assertEqual((payment.status, payment.order.payment_status), ('success', 'success'))
+        self.assertEqual(payment.raw_response['metadata'], {'order_id': str(order.pk)})
+
+    @patch('apps.payments.services.stripe.StripeProvider.acreate_payment_intent', new_callable=AsyncMock)
+    async def test_retry_is_replayed(self, mock_create_intent):
+        mock_create_intent.return_value = {'id': 'pi_Async2', 'client_secret': 'secret', 'status': 'pending'}
+        data = {'order_id': self.orders[0].pk}
+
+        first = await self._post(AsyncCreatePaymentIntentView, data, **{'Idempotency-Key': 'a1'})
+        retry = await self._post(AsyncCreatePaymentIntentView, data, **{'Idempotency-Key': 'a1'})
+
+        self.assertEqual(json.loads(first.content), json.loads(retry.content))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(mock_create_intent.await_count, 1)
+
+    async def test_requires_credentials(self):
+        self.auth = ''
+        response = await self._post(AsyncCreatePaymentIntentView, {'order_id': self.orders[0].pk})
+        self.assertEqual(response.status_code, 401)
+
+        _, key = await sync_to_async(APIKey.objects.create_key)(name='Async Key')
+        self.auth = f'Api-Key {key}'
+        with patch('apps.payments.services.stripe.StripeProvider.acreate_payment_intent', new_callable=AsyncMock) as mock:
+            mock.return_value = {'id': 'pi_Async3', 'client_secret': 'secret', 'status': 'pending'}
+            response = await self._post(AsyncCreatePaymentIntentView, {'order_id': self.orders[0].pk})
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaymentStatusCacheTests(StubBkashServerMixin, TestCase):
+    def setUp(self):
+        self.start_stub_bkash()
+        stub_url = f'http://127.0.0.1:{self.server.server_port}'
+        for name, value in (('api_base', stub_url), ('api_key', 'sk_test_stub'), ('max_network_retries', 0)):
+            patcher = patch.object(stripe, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='confirmer', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.order = Order.objects.create(
+            user=self.user, total=100, street='1 St', city='City', state='State', zip_code='1', country='Country'
+        )
+
+    def _payment(self, provider, reference):
+        return Payment.objects.create(
+            order=self.order, user=self.user, amount=100, provider=provider, transaction_id=reference
+        )
+
+    def _confirm(self, reference):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/payments/confirm-payment/', {'payment_intent_id': reference})
+
+    def test_webhook_settled_payment_skips_provider(self):
+        self._payment('bkash', 'BKHOOK')
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_payment_succeeded(self.order.pk, 'TRX1', payment_reference='BKHOOK')
+
+        with self.assertNumQueries(0):
+            response = self._confirm('BKHOOK')
+        self.assertEqual(response.data, {'status': 'success', 'order_id': str(self.order.pk)})
+        self.assertEqual(self.server.calls, [])
+
+    def test_confirm_reaches_provider_at_most_once(self):
+        self._payment('bkash', 'BKOPEN')
+        for _ in range(3):
+            response = self._confirm('BKOPEN')
+            self.assertEqual(response.data['status'], 'success')
+        self.assertEqual(self.server.calls.count('execute'), 1)
+
+    def test_evicted_entry_is_answered_from_payment_row(self):
+        self._payment('bkash', 'BKFAIL')
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_payment_failed(self.order.pk, payment_reference='BKFAIL')
+        cache.clear()
+
+        self.assertEqual(self._confirm('BKFAIL').data['status'], 'failed')
+        self.assertEqual(self.server.calls, [])
+        self.assertIsNotNone(cache.get('payments:status:BKFAIL'))
+
+    def test_declined_bkash_execute_releases_stock(self):
+        category = Category.objects.create(name='Stubbed')
+        product = Product.objects.create(
+            category=category, name='Kettle', sku='KT-1', description='Kettle',
+            price=100, stock=4, image='products/kettle.jpg'
+        )
+        OrderItem.objects.create(order=self.order, product=product, product_name='Kettle', quantity=1, price=100)
+        Order.objects.filter(pk=self.order.pk).update(stock_status='reserved')
+        self._payment('bkash', 'BKDECLINE')
+        self.server.failures['execute'] = [200]
+        self.server.bkash_statuses['BKDECLINE'] = 'Failed'
+
+        self.assertEqual(self._confirm('BKDECLINE').data['status'], 'failed')
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 5)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual((order.stock_status, order.payment_status), ('released', 'pending'))
+
+    def test_retried_bkash_execute_that_already_went_through_settles(self):
+        Order.objects.filter(pk=self.order.pk).update(stock_status='reserved')
+        self._payment('bkash', 'BKDONE')
+        # bKash answers a repeated execute with an error, but the payment completed
+        self.server.failures['execute'] = [200]
+        self.server.bkash_statuses['BKDONE'] = 'Completed'
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self._confirm('BKDONE')
+        self.assertEqual(response.data, {'status': 'success', 'order_id': self.order.pk})
+        self.assertEqual(self.server.calls[-2:], ['execute', 'status'])
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(
+            (order.stock_status, order.payment_status, order.transaction_id), ('committed', 'success', 'TRX-BKDONE')
+        )
+
+    def test_undecided_bkash_execute_keeps_the_reservation(self):
+        Order.objects.filter(pk=self.order.pk).update(stock_status='reserved')
+        self._payment('bkash', 'BKOPEN')
+        self.server.failures['execute'] = [200]
+
+        self.assertEqual(self._confirm('BKOPEN').data['status'], 'pending')
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual((order.stock_status, order.payment_status), ('reserved', 'pending'))
+
+    def test_failed_stripe_attempt_is_still_checked(self):
+        self._payment('stripe', 'pi_Retry1')
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_payment_failed(self.order.pk, payment_reference='pi_Retry1')
+
+        self.assertEqual(self._confirm('pi_Retry1').data, {'status': 'requires_payment_method'})
+        self.assertEqual(self.server.calls, ['intent'])
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    PAYMENT_HTTP_MAX_RETRIES=0, PAYMENT_BREAKER_MIN_CALLS=4, PAYMENT_BREAKER_SLOW_CALL=0.2,
+)
+class CircuitBreakerTests(StubBkashServerMixin, TestCase):
+    def setUp(self):
+        self.start_stub_bkash()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='breaker', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.order = Order.objects.create(
+            user=self.user, total=100, street='1 St', city='City', state='State', zip_code='1', country='Country'
+        )
+        self.breaker = CircuitBreaker('bkash')
+
+    def _create(self):
+        return self.client.post(
+            '/api/payments/create-payment-intent/', {'order_id': str(self.order.id), 'provider': 'bkash'}
+        )
+
+    def test_failing_provider_is_cut_off(self):
+        self.server.failures['create'] = [503] * 3
+        # With the token grant that is 4 calls, 3 of them failed
+        with self.assertLogs('apps.payments.services.breaker', 'WARNING'):
+            for _ in range(3):
+                self.assertEqual(self._create().status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self._create()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(self.server.calls.count('create'), 3)
+
+    def test_slow_provider_is_cut_off(self):
+        self.server.delays['create'] = 0.3
+        with self.assertLogs('apps.payments.services.breaker', 'WARNING'):
+            for _ in range(3):
+                self.assertEqual(self._create().status_code, status.HTTP_200_OK)
+        self.assertEqual(self._create().status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_one_probe_after_cooldown_closes_the_breaker(self):
+        with self.assertLogs('apps.payments.services.breaker'):
+            self.breaker.trip()
+        with self.assertRaises(ProviderUnavailable):
+            self.breaker.allow()
+
+        # Cooldown over: one caller probes, the rest still fail fast
+        cache.delete(self.breaker.open_key)
+        self.assertTrue(self.breaker.allow())
+        with self.assertRaises(ProviderUnavailable):
+            self.breaker.allow()
+
+        with self.assertLogs('apps.payments.services.breaker', 'INFO'):
+            self.breaker.record(0.01, ok=True, probe=True)
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_failed_probe_reopens_the_breaker(self):
+        with self.assertLogs('apps.payments.services.breaker', 'WARNING') as logs:
+            self.breaker.trip()
+            cache.delete(self.breaker.open_key)
+            probe = self.breaker.allow()
+            self.breaker.record(0.01, ok=False, probe=probe)
+        self.assertEqual(len(logs.output), 2)
+        with self.assertRaises(ProviderUnavailable):
+            self.breaker.allow()
+
+    def test_calls_in_flight_before_the_trip_do_not_decide_the_probe(self):
+        with self.assertLogs('apps.payments.services.breaker', 'WARNING') as logs:
+            self.breaker.trip()
+        cache.delete(self.breaker.open_key)
+        self.assertTrue(self.breaker.allow())
+
+        # Stragglers finishing while half-open neither close nor re-open it
+        self.breaker.record(0.01, ok=True)
+        self.breaker.record(0.01, ok=False)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIsNotNone(cache.get(self.breaker.half_open_key))
+        with self.assertRaises(ProviderUnavailable):
+            self.breaker.allow()
+
+    @override_settings(PAYMENT_HTTP_MAX_RETRIES=3)
+    def test_retries_stop_once_the_breaker_trips(self):
+        self.server.failures['status'] = [503] * 4
+        provider = BkashProvider()
+        provider._get_token()
+        with self.assertLogs('apps.payments.services.breaker', 'WARNING'):
+            self.breaker.trip()
+        cache.delete(self.breaker.open_key)
+
+        # The probe fails and re-opens the breaker; the query is not retried
+        with self.assertLogs('apps.payments.services.breaker', 'WARNING'), self.assertRaises(ProviderUnavailable):
+            provider.query_payment('BK1')
+        self.assertEqual(self.server.calls.count('status'), 1)
+
+    @override_settings(PAYMENT_REQUEST_DEADLINE=0.3)
+    def test_request_deadline_caps_provider_calls(self):
+        self.server.delays['create'] = 2
+        started = time.monotonic()
+        response = self._create()
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+        self.assertLess(time.monotonic() - started, 1)
@@ -1,9 +1,20 @@
+from django.conf import settings
 from django.urls import path
-from .views import CreatePaymentIntentView, StripeWebhookView, ConfirmPaymentView, BkashWebhookView
+from .views import (
+    CreatePaymentIntentView, StripeWebhookView, ConfirmPaymentView, BkashWebhookView,
+    AsyncCreatePaymentIntentView, AsyncConfirmPaymentView,
+)
+
+if settings.PAYMENT_ASYNC_VIEWS:
+    create_payment_intent = AsyncCreatePaymentIntentView.as_view()
+    confirm_payment = AsyncConfirmPaymentView.as_view()
+else:
+    create_payment_intent = CreatePaymentIntentView.as_view()
+    confirm_payment = ConfirmPaymentView.as_view()
 
 urlpatterns = [
-    path('create-payment-intent/', CreatePaymentIntentView.as_view(), name='create-payment-intent'),
-    path('confirm-payment/', ConfirmPaymentView.as_view(), name='confirm-payment'),
+    path('create-payment-intent/', create_payment_intent, name='create-payment-intent'),
+    path('confirm-payment/', confirm_payment, name='confirm-payment'),
     path('webhook/stripe/', StripeWebhookView.as_view(), name='stripe-webhook'),
     path('webhook/bkash/', BkashWebhookView.as_view(), name='bkash-webhook'),
 ]
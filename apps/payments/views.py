@@ -1,23 +1,56 @@
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.settings import api_settings
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.views import View
 from apps.orders.models import Order
-from .models import Payment
+from . import status_cache
+from .handlers import mark_payment_succeeded, release_payment_reservation
+from .models import Payment, WebhookEvent
 from .services.stripe import StripeProvider
 from .services.bkash import BkashProvider
+from .services.breaker import ProviderUnavailable
+from .services.http import DeadlineExceeded
 from .serializers import CreatePaymentIntentSerializer
-from apps.products.services import reduce_order_stock
+from .inbox import BKASH_FAILED, BKASH_SUCCEEDED, record_event, bkash_message
+from apps.core.idempotency import idempotent
+import json
 import stripe
+import time
+import uuid
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from rest_framework_api_key.permissions import HasAPIKey
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
+
+def _deadline():
+    return time.monotonic() + settings.PAYMENT_REQUEST_DEADLINE
+
+
+def _provider_failure(exc):
+    """
+    Response arguments for a provider that is cut off by its breaker (503)
+    or did not answer within the request's deadline (504).
+    """
+    if isinstance(exc, ProviderUnavailable):
+        return {
+            'data': {'error': f'{exc.provider} is temporarily unavailable, please retry shortly'},
+            'status': status.HTTP_503_SERVICE_UNAVAILABLE,
+            'headers': {'Retry-After': str(exc.retry_after)},
+        }
+    return {'data': {'error': 'The payment provider did not respond in time'}, 'status': status.HTTP_504_GATEWAY_TIMEOUT}
+
 
 class CreatePaymentIntentView(APIView):
     permission_classes = [HasAPIKey | IsAuthenticated]
 
+    @idempotent('payments.create_intent')
     def post(self, request):
         serializer = CreatePaymentIntentSerializer(data=request.data)
         if serializer.is_valid():
@@ -49,7 +82,8 @@ class CreatePaymentIntentView(APIView):
                 intent_data = provider.create_payment_intent(
                     amount=order.total,
                     currency=currency,
-                    metadata={'order_id': str(order.id)}
+                    metadata={'order_id': str(order.id)},
+                    deadline=_deadline()
                 )
                 
                 # Create Payment record
@@ -64,12 +98,18 @@ class CreatePaymentIntentView(APIView):
                 )
                 
                 return Response(intent_data)
+            except (ProviderUnavailable, DeadlineExceeded) as e:
+                return Response(**_provider_failure(e))
             except Exception as e:
                 return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class StripeWebhookView(APIView):
+    # Providers authenticate by signature, not by user credentials
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
     def post(self, request):
         payload = request.body
         sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
@@ -84,54 +124,112 @@ class StripeWebhookView(APIView):
         except stripe.error.SignatureVerificationError as e:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        if event['type'] == 'payment_intent.succeeded':
-            payment_intent = event['data']['object']
-            self.handle_payment_success(payment_intent)
-        elif event['type'] == 'payment_intent.payment_failed':
-            payment_intent = event['data']['object']
-            self.handle_payment_failure(payment_intent)
-
+        # Store and acknowledge; process_webhooks applies the event
+        data = json.loads(payload)
+        intent = data['data']['object']
+        record_event(
+            'stripe', data['id'], data,
+            event_type=data['type'],
+            order_key=(intent.get('metadata') or {}).get('order_id', ''),
+        )
         return Response(status=status.HTTP_200_OK)
 
-    def handle_payment_success(self, payment_intent):
-        order_id = payment_intent['metadata'].get('order_id')
-        if order_id:
-            try:
-                order = Order.objects.get(id=order_id)
-                order.payment_status = 'success'
-                order.status = 'processing' # Or whatever next status
-                order.transaction_id = payment_intent['id']
-                order.save()
-                
-                # Reduce Stock
-                reduce_order_stock(order)
-                
-                # Update Payment record
-                payment = Payment.objects.filter(transaction_id=payment_intent['id']).first()
-                if payment:
-                    payment.status = 'success'
-                    payment.raw_response = payment_intent
-                    payment.save()
-            except Order.DoesNotExist:
-                pass
-
-    def handle_payment_failure(self, payment_intent):
-        order_id = payment_intent['metadata'].get('order_id')
-        if order_id:
-            try:
-                order = Order.objects.get(id=order_id)
-                order.payment_status = 'failed'
-                order.save()
-            except Order.DoesNotExist:
-                pass
-
 @method_decorator(csrf_exempt, name='dispatch')
 class BkashWebhookView(APIView):
+    # Providers authenticate by signature, not by user credentials
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
     def post(self, request):
-        # Placeholder for bKash webhook
-        # Implement signature verification and status updates here
+        # bKash delivers SNS messages. They are only stored here; the worker
+        # reads the payment back from bKash before trusting them.
+        try:
+            payload = json.loads(request.body)
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(payload, dict):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        message = bkash_message(payload)
+        event_id = payload.get('MessageId')
+        if not event_id and message.get('paymentID'):
+            event_id = f"{message['paymentID']}:{message.get('transactionStatus', '')}"
+        if not event_id or len(str(event_id)) > WebhookEvent._meta.get_field('event_id').max_length:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        record_event(
+            'bkash', event_id, payload,
+            event_type=str(payload.get('Type', message.get('transactionStatus', '')))[:100],
+            order_key=_invoice_order_key(message.get('merchantInvoiceNumber')),
+        )
         return Response(status=status.HTTP_200_OK)
 
+def _invoice_order_key(invoice):
+    """
+    Returns the order id from a bKash invoice number, or '' when it does
+    not look like one. The SNS message is unsigned, so anything else is
+    dropped rather than stored as the ordering key.
+    """
+    # Invoice numbers are "<order id>_<timestamp>" (see BkashProvider)
+    order_id = str(invoice or '').rpartition('_')[0]
+    try:
+        return str(uuid.UUID(order_id)) if len(order_id) <= 36 else ''
+    except ValueError:
+        return ''
+
+
+def _settled_data(settled):
+    return {'status': settled['status'], 'order_id': settled['order_id']}
+
+
+def _bkash_execution_outcome(result, state):
+    """
+    Decides a failed execute from the payment's state at bKash. A retried
+    confirm gets an error for an execute that already went through, so only
+    a payment bKash reports as failed gives its stock back; one still open
+    is left to the webhook and the reconcile sweep.
+    """
+    transaction_status = state.get('transactionStatus')
+    if transaction_status in BKASH_SUCCEEDED:
+        return {
+            **result, 'status': 'succeeded',
+            'transaction_id': state.get('trxID') or state.get('paymentID'), 'raw_response': state,
+        }
+    if transaction_status in BKASH_FAILED:
+        return result
+    return {**result, 'status': 'pending'}
+
+
+def _settle_bkash_execution(payment, result):
+    # Keep the paymentID as the Payment's transaction_id to allow lookups/idempotency
+    mark_payment_succeeded(
+        payment.order_id, result['transaction_id'],
+        raw_response=result['raw_response'], payment_reference=payment.transaction_id
+    )
+
+
+def _settle_stripe_intent(intent, payment):
+    """
+    Applies a succeeded Stripe intent and returns the order id. Raises
+    Http404 for an unknown order.
+    """
+    order = Order.objects.filter(id=intent['metadata']['order_id']).only('id', 'user_id', 'total').first()
+    if order is None:
+        raise Http404('No Order matches the given query.')
+    if payment is None:
+        # Create if not exists (edge case)
+        Payment.objects.create(
+            order=order,
+            user_id=order.user_id,
+            amount=order.total,
+            provider='stripe',
+            transaction_id=intent['id'],
+            status='pending',
+        )
+    mark_payment_succeeded(order.pk, intent['id'], raw_response=intent)
+    return order.pk
+
+
 class ConfirmPaymentView(APIView):
     permission_classes = [HasAPIKey | IsAuthenticated]
 
@@ -142,83 +240,193 @@ class ConfirmPaymentView(APIView):
         if not payment_intent_id:
              return Response({'error': 'payment_intent_id is required'}, status=status.HTTP_400_BAD_REQUEST)
         
+        # A settled payment is answered locally without asking the provider
+        settled = status_cache.settled(payment_intent_id)
+        if settled is not None:
+            return Response(_settled_data(settled))
+
         # Try to find existing payment record to determine provider
-        payment = Payment.objects.filter(transaction_id=payment_intent_id).first()
+        payment = Payment.objects.filter(transaction_id=payment_intent_id).only(
+            'id', 'order_id', 'provider', 'transaction_id', 'status'
+        ).first()
+        settled = status_cache.settled_from_payment(payment)
+        if settled is not None:
+            return Response(_settled_data(settled))
         if payment:
             provider_name = payment.provider
         
         try:
             if provider_name == 'bkash':
-                provider = BkashProvider()
+                if payment is None:
+                    # Should not happen if flow is correct, but handle just in case
+                    return Response({'error': 'Payment record not found'}, status=status.HTTP_404_NOT_FOUND)
+
                 # Confirm (Execute) Payment
-                result = provider.confirm_payment(payment_intent_id)
-                
-                # Update Order and Payment
+                provider = BkashProvider()
+                result = provider.confirm_payment(payment_intent_id, deadline=_deadline())
+                if result['status'] == 'failed':
+                    state = provider.query_payment(payment_intent_id, deadline=_deadline())
+                    result = _bkash_execution_outcome(result, state)
                 if result['status'] == 'succeeded':
-                    if payment:
-                        order = payment.order
-                        order.payment_status = 'success'
-                        order.status = 'processing'
-                        # Reduce Stock
-                        reduce_order_stock(order)
-                        
-                        order.transaction_id = result['transaction_id']
-                        order.save()
-                        
-                        payment.status = 'success'
-                        # Keep transaction_id as paymentID for bKash to allow lookups/idempotency
-                        # payment.transaction_id = result['transaction_id'] 
-                        payment.raw_response = result['raw_response']
-                        payment.save()
-                        
-                        return Response({'status': 'success', 'order_id': order.id})
-                    else:
-                         # Should not happen if flow is correct, but handle just in case
-                         return Response({'error': 'Payment record not found'}, status=status.HTTP_404_NOT_FOUND)
-                else:
-                    return Response({'status': 'failed', 'details': result})
+                    _settle_bkash_execution(payment, result)
+                    return Response({'status': 'success', 'order_id': payment.order_id})
+                if result['status'] == 'failed':
+                    release_payment_reservation(payment.order_id)
+                return Response({'status': result['status'], 'details': result})
 
-            else:
-                # Stripe Logic
-                stripe.api_key = settings.STRIPE_SECRET_KEY
-                intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-                
-                if intent.status == 'succeeded':
-                    order_id = intent.metadata.get('order_id')
-                    if order_id:
-                        order = get_object_or_404(Order, id=order_id)
-                        
-                        # Update Order
-                        if order.payment_status != 'success':
-                            order.payment_status = 'success'
-                            order.status = 'processing'
-                            order.transaction_id = intent.id
-                            order.save()
-                            
-                            # Reduce Stock
-                            reduce_order_stock(order)
-                            
-                            # Update Payment record
-                            if payment:
-                                payment.status = 'success'
-                                payment.raw_response = intent
-                                payment.save()
-                            else:
-                                 # Create if not exists (edge case)
-                                 Payment.objects.create(
-                                    order=order,
-                                    user=order.user,
-                                    amount=order.total,
-                                    provider='stripe',
-                                    transaction_id=intent.id,
-                                    status='success',
-                                    raw_response=intent
-                                )
-                        
-                        return Response({'status': 'success', 'order_id': order.id})
-                
-                return Response({'status': intent.status})
-            
+            # Stripe Logic
+            intent = StripeProvider().confirm_payment(payment_intent_id, deadline=_deadline()).to_dict()
+            if intent['status'] == 'succeeded' and intent.get('metadata', {}).get('order_id'):
+                order_id = _settle_stripe_intent(intent, payment)
+                return Response({'status': 'success', 'order_id': order_id})
+            return Response({'status': intent['status']})
+        except Http404:
+            raise
+        except (ProviderUnavailable, DeadlineExceeded) as e:
+            return Response(**_provider_failure(e))
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+
+async def _authorize(request):
+    """
+    Applies `HasAPIKey | IsAuthenticated` for the async views, using the
+    configured DRF authentication classes. Sets `request.user`.
+    """
+    request.user = AnonymousUser()
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            result = await sync_to_async(authentication_class().authenticate)(request)
+        except AuthenticationFailed:
+            return False
+        if result is not None:
+            request.user = result[0]
+            return True
+    return await sync_to_async(HasAPIKey().has_permission)(request, None)
+
+
+def _request_data(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+    return request.POST
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncPaymentView(View):
+    """
+    Base for the ASGI payment views: provider calls are awaited, so one
+    worker can hold many checkouts in flight instead of one per thread.
+    """
+    http_method_names = ['post']
+
+    async def dispatch(self, request, *args, **kwargs):
+        if not await _authorize(request):
+            return JsonResponse(
+                {'detail': 'Authentication credentials were not provided.'},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncCreatePaymentIntentView(AsyncPaymentView):
+    @idempotent('payments.create_intent')
+    async def post(self, request):
+        serializer = CreatePaymentIntentSerializer(data=_request_data(request))
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        orders = Order.objects.only('id', 'user_id', 'total', 'payment_status')
+        if request.user.is_authenticated:
+            orders = orders.filter(user=request.user)
+        order = await orders.filter(id=serializer.validated_data['order_id']).afirst()
+        if order is None:
+            return JsonResponse({'detail': 'No Order matches the given query.'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Check if payment already exists and is successful
+        if order.payment_status == 'success':
+            return JsonResponse({'error': 'Order already paid'}, status=status.HTTP_400_BAD_REQUEST)
+
+        provider_name = serializer.validated_data.get('provider', 'stripe')
+        if provider_name == 'bkash':
+            provider = BkashProvider()
+            currency = 'BDT'
+        else:
+            provider = StripeProvider()
+            currency = 'usd'
+
+        try:
+            intent_data = await provider.acreate_payment_intent(
+                amount=order.total,
+                currency=currency,
+                metadata={'order_id': str(order.id)},
+                deadline=_deadline()
+            )
+            await Payment.objects.acreate(
+                order_id=order.pk,
+                user_id=request.user.pk if request.user.is_authenticated else order.user_id,
+                amount=order.total,
+                provider=provider_name,
+                transaction_id=intent_data['id'],
+                status='pending',
+                raw_response=intent_data
+            )
+            return JsonResponse(intent_data)
+        except (ProviderUnavailable, DeadlineExceeded) as e:
+            return JsonResponse(**_provider_failure(e))
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncConfirmPaymentView(AsyncPaymentView):
+    async def post(self, request):
+        data = _request_data(request)
+        payment_intent_id = data.get('payment_intent_id')
+        provider_name = data.get('provider', 'stripe')
+
+        if not payment_intent_id:
+            return JsonResponse({'error': 'payment_intent_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        settled = await status_cache.asettled(payment_intent_id)
+        if settled is not None:
+            return JsonResponse(_settled_data(settled))
+
+        payment = await Payment.objects.filter(transaction_id=payment_intent_id).only(
+            'id', 'order_id', 'provider', 'transaction_id', 'status'
+        ).afirst()
+        settled = await sync_to_async(status_cache.settled_from_payment)(payment)
+        if settled is not None:
+            return JsonResponse(_settled_data(settled))
+        if payment:
+            provider_name = payment.provider
+
+        try:
+            if provider_name == 'bkash':
+                if payment is None:
+                    return JsonResponse({'error': 'Payment record not found'}, status=status.HTTP_404_NOT_FOUND)
+                provider = BkashProvider()
+                result = await provider.aconfirm_payment(payment_intent_id, deadline=_deadline())
+                if result['status'] == 'failed':
+                    state = await provider.aquery_payment(payment_intent_id, deadline=_deadline())
+                    result = _bkash_execution_outcome(result, state)
+                if result['status'] == 'succeeded':
+                    await sync_to_async(_settle_bkash_execution)(payment, result)
+                    return JsonResponse({'status': 'success', 'order_id': payment.order_id})
+                if result['status'] == 'failed':
+                    await sync_to_async(release_payment_reservation)(payment.order_id)
+                return JsonResponse({'status': result['status'], 'details': result})
+
+            intent = (await StripeProvider().aconfirm_payment(payment_intent_id, deadline=_deadline())).to_dict()
+            if intent['status'] == 'succeeded' and intent.get('metadata', {}).get('order_id'):
+                order_id = await sync_to_async(_settle_stripe_intent)(intent, payment)
+                return JsonResponse({'status': 'success', 'order_id': order_id})
+            return JsonResponse({'status': intent['status']})
+        except Http404 as e:
+            return JsonResponse({'detail': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except (ProviderUnavailable, DeadlineExceeded) as e:
+            return JsonResponse(**_provider_failure(e))
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
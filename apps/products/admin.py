@@ -1,5 +1,7 @@
 from django.contrib import admin
+from django.db.models import Count
 from .models import Category, Product
+from .services import enable_sharded_stock, disable_sharded_stock
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -7,15 +9,31 @@ class CategoryAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ('name',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(product_count=Count('products'))
+
     def product_count(self, obj):
-        return obj.products.count()
+        return obj.product_count
     product_count.short_description = 'Products'
+    product_count.admin_order_field = 'product_count'
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     list_display = ('name', 'category', 'price', 'stock', 'status', 'sku', 'created_at')
     list_filter = ('status', 'category', 'created_at')
+    list_select_related = ('category',)
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ('name', 'sku', 'description')
     list_editable = ('price', 'stock', 'status')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('stock_shards', 'created_at', 'updated_at')
+    actions = ['hold_stock_in_redis', 'hold_stock_in_database']
+
+    @admin.action(description='Hold stock in sharded Redis counters')
+    def hold_stock_in_redis(self, request, queryset):
+        for product in queryset:
+            enable_sharded_stock(product)
+
+    @admin.action(description='Hold stock in the database')
+    def hold_stock_in_database(self, request, queryset):
+        for product in queryset:
+            disable_sharded_stock(product)
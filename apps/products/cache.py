@@ -0,0 +1,185 @@
+"""
+Versioned response cache for the product catalog.
+
+Every cache key embeds the current catalog version. Saving or deleting a
+Product or Category, or a bulk write through their querysets, bumps the
+version, so stale responses are never served again and simply expire out
+of Redis. The same versioned key doubles as the ETag, so conditional
+requests are answered without touching the database.
+
+Stock moves (checkouts, releases, reconciles) do not bump the version.
+Each product has a stock token instead, set from a global stock epoch
+whenever its stock moves. Responses that show stock remember the epoch
+read before they were built and the tokens of the products they list;
+they stop being served once any of those tokens changes, so a checkout
+only invalidates the pages and details showing what it sold.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from apps.core.http import normalize_query, make_etag, add_validators, not_modified_response
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_MODIFIED_KEY = 'catalog:modified'
+STOCK_EPOCH_KEY = 'catalog:stock_epoch'
+
+
+def _read_counter(key):
+    value = cache.get(key)
+    if value is None:
+        # Seed from the clock so a lost counter never reuses an old value
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        value = cache.get(key)
+    return value
+
+
+def _increment(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        _read_counter(key)
+        return cache.incr(key)
+
+
+def get_catalog_version():
+    """
+    Returns the current catalog version, initialising it if missing.
+    """
+    return _read_counter(CATALOG_VERSION_KEY)
+
+
+def get_catalog_state():
+    """
+    Returns ``(version, last_modified)`` in a single cache round-trip.
+    ``last_modified`` is a Unix timestamp, or None if unknown.
+    """
+    state = cache.get_many([CATALOG_VERSION_KEY, CATALOG_MODIFIED_KEY])
+    version = state.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = get_catalog_version()
+    return version, state.get(CATALOG_MODIFIED_KEY)
+
+
+def bump_catalog_version():
+    """
+    Invalidates every cached catalog response by moving to a new version.
+    """
+    cache.set(CATALOG_MODIFIED_KEY, int(time.time()), timeout=None)
+    return _increment(CATALOG_VERSION_KEY)
+
+
+def stock_token_key(product_id):
+    return f"catalog:stock:{product_id}"
+
+
+def bump_product_stock(product_ids):
+    """
+    Invalidates the cached responses that show the stock of `product_ids`.
+    """
+    product_ids = list(product_ids)
+    if product_ids:
+        epoch = _increment(STOCK_EPOCH_KEY)
+        cache.set_many({stock_token_key(pk): epoch for pk in product_ids}, timeout=None)
+
+
+def get_stock_tokens(product_ids):
+    """
+    Returns the stock tokens of the products that have one; products
+    whose stock never moved have none.
+    """
+    tokens = cache.get_many([stock_token_key(pk) for pk in product_ids])
+    return {pk: tokens[stock_token_key(pk)] for pk in product_ids if stock_token_key(pk) in tokens}
+
+
+def _product_ids(data):
+    # Listings wrap their rows in "results"; a detail response is one row
+    rows = data.get('results', [data]) if isinstance(data, dict) else data
+    return [row['id'] for row in rows if isinstance(row, dict) and 'id' in row]
+
+
+def catalog_cache_key(request, version=None):
+    """
+    Builds the cache key for a catalog request from its scheme, host, path
+    and normalized query string. The scheme matters because responses carry
+    absolute image URLs.
+    """
+    if version is None:
+        version = get_catalog_version()
+    raw = f"{request.scheme}|{request.get_host()}|{request.path}|{normalize_query(request.query_params)}"
+    digest = hashlib.md5(raw.encode('utf-8')).hexdigest()
+    return f"catalog:{version}:{digest}"
+
+
+class CatalogCacheMixin:
+    """
+    Serves catalog reads from the versioned response cache.
+
+    Requests whose If-None-Match/If-Modified-Since still match get a 304
+    before anything is serialized. On a cache hit the stored JSON bytes are
+    returned as-is, skipping both the ORM and DRF serialization.
+    """
+    def cached_response(self, request, build_response, shows_stock=False):
+        # Only JSON responses are cached; the browsable API is rendered normally
+        if not isinstance(request.accepted_renderer, JSONRenderer):
+            return build_response()
+
+        version, last_modified = get_catalog_state()
+        key = catalog_cache_key(request, version)
+        if shows_stock:
+            return self._stock_response(request, key, last_modified, build_response)
+
+        etag = make_etag(key)
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        content = cache.get(key)
+        if content is None:
+            response = build_response()
+            if response.status_code != 200:
+                return response
+            content = JSONRenderer().render(response.data)
+            cache.set(key, content, settings.CATALOG_CACHE_TIMEOUT)
+        response = HttpResponse(content, content_type=JSONRenderer.media_type)
+        return add_validators(response, etag, last_modified)
+
+    def _stock_response(self, request, key, last_modified, build_response):
+        """
+        cached_response for payloads that show product stock. The entry also
+        records the stock tokens of its products and is rebuilt once one of
+        them changes. Last-Modified is the later of the catalog change and
+        the build, since stock moves do not touch the catalog timestamp.
+        """
+        entry = cache.get(key)
+        if entry is not None and get_stock_tokens(entry['products']) != entry['stock']:
+            entry = None
+
+        if entry is None:
+            epoch = _read_counter(STOCK_EPOCH_KEY)
+            response = build_response()
+            if response.status_code != 200:
+                return response
+            products = _product_ids(response.data)
+            entry = {
+                'content': JSONRenderer().render(response.data),
+                'products': products,
+                'stock': get_stock_tokens(products),
+                'epoch': epoch,
+                'built_at': int(time.time()),
+            }
+            # A token newer than the epoch belongs to a stock move that may
+            # have committed after the read above, so that build is not kept
+            if all(token <= epoch for token in entry['stock'].values()):
+                cache.set(key, entry, settings.CATALOG_CACHE_TIMEOUT)
+
+        etag = make_etag(key, entry['epoch'])
+        last_modified = max(last_modified or 0, entry['built_at'])
+        not_modified = not_modified_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        response = HttpResponse(entry['content'], content_type=JSONRenderer.media_type)
+        return add_validators(response, etag, last_modified)
@@ -0,0 +1,50 @@
+import django_filters
+from django.db.models import FloatField, Value
+from rest_framework import filters
+from .models import Category, Product
+from .search import SEARCH_RANK, search_products
+
+
+class ProductFilter(django_filters.FilterSet):
+    category__slug = django_filters.CharFilter(method='filter_category_subtree')
+
+    class Meta:
+        model = Product
+        fields = ['category', 'category__slug', 'status']
+
+    def filter_category_subtree(self, queryset, name, value):
+        """
+        Matches products in the category and all of its descendants with a
+        prefix scan on the materialized path.
+        """
+        path = Category.objects.filter(slug=value).values_list('path', flat=True).first()
+        if path is None:
+            return queryset.none()
+        return queryset.filter(category__path__startswith=path)
+
+
+class ProductSearchFilter(filters.SearchFilter):
+    """
+    Ranked full-text search with an exact-SKU fast path.
+    """
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '').strip()
+        if not term:
+            return queryset
+
+        results = search_products(queryset, term)
+        if results is None:
+            # No search index on this backend: DRF's icontains search
+            results = super().filter_queryset(request, queryset, view)
+            results = results.annotate(**{SEARCH_RANK: Value(0.0, output_field=FloatField())})
+        return results
+
+
+class RankedOrderingFilter(filters.OrderingFilter):
+    """
+    Orders search results by relevance unless ``?ordering=`` says otherwise.
+    """
+    def get_ordering(self, request, queryset, view):
+        if self.ordering_param not in request.query_params and SEARCH_RANK in queryset.query.annotations:
+            return ['-' + SEARCH_RANK]
+        return super().get_ordering(request, queryset, view)
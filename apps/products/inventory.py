@@ -0,0 +1,132 @@
+"""
+Sharded Redis stock counters for high-traffic products.
+
+A product with ``stock_shards > 0`` keeps its sellable stock in that many
+Redis hashes instead of behind its database row lock. Each shard holds:
+
+* ``available``: units this shard can still hand out, never below zero.
+* ``delta``: net change not yet written back to ``Product.stock``.
+
+Every script touches a single shard key, so shards can live on different
+cluster slots. A reservation takes from a random shard first and borrows
+from the others when that shard runs dry; if the shards together cannot
+cover it, whatever was taken is given back. The reconciler drains the
+deltas and applies them to the database in batches.
+"""
+import random
+
+from apps.core.redis import get_redis
+
+# Takes up to ARGV[1] units from the shard and returns how many it got
+TAKE_SCRIPT = """
+local available = tonumber(redis.call('HGET', KEYS[1], 'available') or '0')
+local take = math.min(available, tonumber(ARGV[1]))
+if take > 0 then
+    redis.call('HINCRBY', KEYS[1], 'available', -take)
+    redis.call('HINCRBY', KEYS[1], 'delta', -take)
+end
+return take
+"""
+
+# Returns units to the shard
+GIVE_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], 'available', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'delta', ARGV[1])
+return 1
+"""
+
+# Returns the pending delta and resets it; ARGV[1] == '1' also drops the shard
+DRAIN_SCRIPT = """
+local delta = tonumber(redis.call('HGET', KEYS[1], 'delta') or '0')
+if ARGV[1] == '1' then
+    redis.call('DEL', KEYS[1])
+elseif delta ~= 0 then
+    redis.call('HINCRBY', KEYS[1], 'delta', -delta)
+end
+return delta
+"""
+
+
+def shard_keys(product_id, shards):
+    return [f'inventory:{product_id}:{shard}' for shard in range(shards)]
+
+
+def seed(product_id, shards, stock):
+    """
+    Splits `stock` evenly across fresh shards, replacing any existing ones.
+    """
+    base, extra = divmod(stock, shards)
+    pipe = get_redis().pipeline()
+    for index, key in enumerate(shard_keys(product_id, shards)):
+        pipe.delete(key)
+        pipe.hset(key, mapping={'available': base + (index < extra), 'delta': 0})
+    pipe.execute()
+
+
+def take(product_id, shards, quantity):
+    """
+    Reserves `quantity` units, all or nothing. Returns True on success.
+    """
+    client = get_redis()
+    script = client.register_script(TAKE_SCRIPT)
+    keys = shard_keys(product_id, shards)
+    start = random.randrange(shards)
+
+    taken = []
+    remaining = quantity
+    for key in keys[start:] + keys[:start]:
+        got = script(keys=[key], args=[remaining])
+        if got:
+            taken.append((key, got))
+            remaining -= got
+        if not remaining:
+            return True
+
+    # The shards together cannot cover the request: hand back what was taken
+    give_back = client.register_script(GIVE_SCRIPT)
+    for key, got in taken:
+        give_back(keys=[key], args=[got])
+    return False
+
+
+def give(product_id, shards, quantity):
+    """
+    Returns `quantity` units to a random shard.
+    """
+    key = shard_keys(product_id, shards)[random.randrange(shards)]
+    get_redis().register_script(GIVE_SCRIPT)(keys=[key], args=[quantity])
+
+
+def restore_delta(product_id, shards, delta):
+    """
+    Puts back a drained delta whose database write failed.
+    """
+    get_redis().hincrby(shard_keys(product_id, shards)[0], 'delta', delta)
+
+
+def available(product_id, shards):
+    pipe = get_redis().pipeline()
+    for key in shard_keys(product_id, shards):
+        pipe.hget(key, 'available')
+    return sum(int(value or 0) for value in pipe.execute())
+
+
+def drain(products, clear=False):
+    """
+    Collects and resets the pending deltas of many products in one round
+    trip. `products` maps product id to its shard count; returns a dict of
+    product id to net delta, omitting products with nothing pending.
+    """
+    client = get_redis()
+    script = client.register_script(DRAIN_SCRIPT)
+    pipe = client.pipeline()
+    order = []
+    for product_id, shards in products.items():
+        for key in shard_keys(product_id, shards):
+            script(keys=[key], args=['1' if clear else '0'], client=pipe)
+            order.append(product_id)
+
+    deltas = {}
+    for product_id, delta in zip(order, pipe.execute()):
+        deltas[product_id] = deltas.get(product_id, 0) + int(delta)
+    return {product_id: delta for product_id, delta in deltas.items() if delta}
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from apps.products.services import reconcile_sharded_stock
+
+
+class Command(BaseCommand):
+    help = 'Writes the net Redis stock deltas of sharded products back to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Products per UPDATE')
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Keep running, reconciling every N seconds (default: run once)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            changed = reconcile_sharded_stock(batch_size=options['batch_size'])
+            self.stdout.write(f'Reconciled stock for {changed} product(s).')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,47 @@
+# Generated by Django 6.0 on 2026-10-18 17:06
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def build_category_paths(apps, schema_editor):
+    Category = apps.get_model('products', 'Category')
+    children = defaultdict(list)
+    for category in Category.objects.all():
+        children[category.parent_id].append(category)
+
+    stack = [(root, '', 0) for root in children[None]]
+    updated = []
+    while stack:
+        category, prefix, depth = stack.pop()
+        category.path = f"{prefix}{category.pk:08x}/"
+        category.depth = depth
+        updated.append(category)
+        stack.extend((child, category.path, depth + 1) for child in children[category.pk])
+    Category.objects.bulk_update(updated, ['path', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_product_products_pr_price_dbec84_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(build_category_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['path'], name='products_category_path_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
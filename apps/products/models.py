@@ -1,5 +1,36 @@
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.text import slugify
+from .cache import bump_catalog_version
+from . import search
+
+class CatalogQuerySet(models.QuerySet):
+    """
+    Bulk writes skip the model signals, so they bump the catalog version
+    themselves once their transaction commits.
+    """
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        if rows:
+            transaction.on_commit(bump_catalog_version, using=self.db)
+        return rows
+
+    def update_stock(self, **kwargs):
+        """
+        update() for stock moves, which must not flush the whole catalog;
+        callers invalidate just the moved products with bump_product_stock.
+        """
+        return super().update(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        if objs:
+            transaction.on_commit(bump_catalog_version, using=self.db)
+        return objs
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -7,17 +38,81 @@ class Category(models.Model):
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='categories/', blank=True, null=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    # Materialized path of ancestor ids, e.g. "0000000a/0000002f/", so a
+    # subtree is a single prefix scan on an indexed column
+    path = models.CharField(max_length=255, editable=False, default='')
+    depth = models.PositiveSmallIntegerField(editable=False, default=0)
+
+    objects = CatalogQuerySet.as_manager()
 
     class Meta:
         verbose_name_plural = "Categories"
         indexes = [
             models.Index(fields=['name']),
+            models.Index(fields=['path'], name='products_category_path_idx', opclasses=['varchar_pattern_ops']),
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_parent_id = instance.__dict__.get('parent_id')
+        return instance
+
+    def _parent_changed(self):
+        # New categories and moves need the parent's path; other saves do not
+        return not self.path or self.parent_id != getattr(self, '_saved_parent_id', None)
+
+    def clean(self):
+        if not self._parent_changed():
+            return
+        parent_path, _ = self._parent_position()
+        if self.path and parent_path.startswith(self.path):
+            raise ValidationError({'parent': 'A category cannot be moved under itself or one of its descendants.'})
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
+        if not self._parent_changed():
+            super().save(*args, **kwargs)
+            return
+        parent_path, parent_depth = self._parent_position()
+        if self.path and parent_path.startswith(self.path):
+            raise ValueError('A category cannot be moved under itself or one of its descendants.')
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._update_path(parent_path, parent_depth)
+        self._saved_parent_id = self.parent_id
+
+    def _parent_position(self):
+        if not self.parent_id:
+            return '', -1
+        return Category.objects.filter(pk=self.parent_id).values_list('path', 'depth').get()
+
+    def _update_path(self, parent_path, parent_depth):
+        """
+        Recomputes this category's path and, when it moved, rewrites the paths
+        of its whole subtree with one UPDATE.
+        """
+        path = f"{parent_path}{self.pk:08x}/"
+        depth = parent_depth + 1
+        if path == self.path:
+            return
+
+        if self.path:
+            Category.objects.filter(path__startswith=self.path).update(
+                path=Concat(Value(path), Substr('path', len(self.path) + 1)),
+                depth=F('depth') + (depth - self.depth),
+            )
+        else:
+            Category.objects.filter(pk=self.pk).update(path=path, depth=depth)
+        # The update() above bumps the catalog version once this commits
+        self.path, self.depth = path, depth
+
+    def get_descendants(self, include_self=False):
+        descendants = Category.objects.filter(path__startswith=self.path)
+        if not include_self:
+            descendants = descendants.exclude(pk=self.pk)
+        return descendants
 
     def __str__(self):
         return self.name
@@ -35,17 +130,24 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField(default=0)
+    # 0 keeps stock on this row; N > 0 holds it in N Redis counters (see inventory.py)
+    stock_shards = models.PositiveSmallIntegerField(default=0)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
     image = models.ImageField(upload_to='products/')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CatalogQuerySet.as_manager()
+
     class Meta:
         indexes = [
             models.Index(fields=['name']),
             models.Index(fields=['price']),
             models.Index(fields=['created_at']),
             models.Index(fields=['status']),
+            # Keyset pagination seeks on (field, id)
+            models.Index(fields=['price', 'id']),
+            models.Index(fields=['created_at', 'id']),
         ]
 
     def save(self, *args, **kwargs):
@@ -55,3 +157,25 @@ class Product(models.Model):
 
     def __str__(self):
         return self.name
+
+# Any catalog change invalidates the cached product responses
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_catalog_cache(sender, **kwargs):
+    bump_catalog_version()
+
+
+SEARCH_FIELDS = {'name', 'sku', 'description'}
+
+
+# Keep the full-text index in step with product writes
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, update_fields=None, raw=False, using='default', **kwargs):
+    if raw or (update_fields is not None and not SEARCH_FIELDS.intersection(update_fields)):
+        return
+    search.index_product(instance, using=using)
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_search(sender, instance, using='default', **kwargs):
+    search.remove_product(instance.pk, using=using)
@@ -0,0 +1,127 @@
+"""
+Full-text search for products.
+
+Products are tokenized into a dedicated inverted index table that is kept up
+to date on every product save:
+
+* PostgreSQL: ``products_product_search`` holds a weighted ``tsvector`` per
+  product behind a GIN index.
+* SQLite: ``products_product_search`` is an FTS5 virtual table keyed by the
+  product id.
+
+Other backends fall back to DRF's ``icontains`` search (see filters.py).
+Results carry a ``search_rank`` annotation (higher is better) that the
+ordering filter uses when no explicit ``?ordering=`` is given.
+"""
+import re
+
+from django.db import connections
+from django.db.models import Case, Exists, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+SEARCH_TABLE = 'products_product_search'
+SEARCH_RANK = 'search_rank'
+
+# Name and SKU hits weigh more than description hits
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('simple', %s), 'A') || "
+    "setweight(to_tsvector('english', %s), 'A') || "
+    "setweight(to_tsvector('english', %s), 'B')"
+)
+SQLITE_BM25_WEIGHTS = '10.0, 10.0, 1.0'
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(term):
+    return TOKEN_RE.findall(term.lower())
+
+
+def index_product(product, using='default'):
+    """
+    Writes (or rewrites) the search document for a single product.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (product_id, document) "
+                f"VALUES (%s, {POSTGRES_DOCUMENT}) "
+                "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+                [product.pk, product.sku, product.name, product.description],
+            )
+        elif connection.vendor == 'sqlite':
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [product.pk])
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, name, sku, description) VALUES (%s, %s, %s, %s)",
+                [product.pk, product.name, product.sku, product.description],
+            )
+
+
+def remove_product(product_id, using='default'):
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE product_id = %s", [product_id])
+        elif connection.vendor == 'sqlite':
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [product_id])
+
+
+def _postgres_index(tokens):
+    tsquery = ' & '.join(f"{token}:*" for token in tokens)
+    matches = RawSQL(
+        f"SELECT product_id FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('english', %s)",
+        (tsquery,),
+    )
+    rank = RawSQL(
+        f"SELECT ts_rank_cd(document, to_tsquery('english', %s))::float8 FROM {SEARCH_TABLE} "
+        "WHERE product_id = products_product.id",
+        (tsquery,),
+        output_field=FloatField(),
+    )
+    return matches, rank
+
+
+def _sqlite_index(tokens):
+    match = ' '.join(f'"{token}"*' for token in tokens)
+    matches = RawSQL(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s", (match,))
+    # bm25() is lower-is-better, so negate it to share the rank direction
+    rank = RawSQL(
+        f"SELECT -bm25({SEARCH_TABLE}, {SQLITE_BM25_WEIGHTS}) FROM {SEARCH_TABLE} "
+        f"WHERE {SEARCH_TABLE} MATCH %s AND rowid = products_product.id",
+        (match,),
+        output_field=FloatField(),
+    )
+    return matches, rank
+
+
+INDEXES = {'postgresql': _postgres_index, 'sqlite': _sqlite_index}
+
+
+def search_products(queryset, term):
+    """
+    Filters `queryset` to the products matching `term`, annotated with
+    SEARCH_RANK. A lone token that equals a SKU matches that product only;
+    the check runs inside the same query. Returns None when the database
+    has no search index.
+    """
+    index = INDEXES.get(connections[queryset.db].vendor)
+    if index is None:
+        return None
+
+    tokens = tokenize(term)
+    sku = ' ' not in term
+    if not tokens:
+        if not sku:
+            return queryset.none()
+        return queryset.filter(sku=term).annotate(**{SEARCH_RANK: Value(1.0, output_field=FloatField())})
+
+    matches, rank = index(tokens)
+    if not sku:
+        return queryset.filter(pk__in=matches).annotate(**{SEARCH_RANK: rank})
+    # A lone token may be a SKU: answer it from the unique index when it is one
+    return queryset.filter(
+        Q(sku=term) | Q(Q(pk__in=matches), ~Exists(queryset.filter(sku=term)))
+    ).annotate(**{
+        SEARCH_RANK: Case(When(sku=term, then=Value(1.0)), default=rank, output_field=FloatField())
+    })
@@ -2,12 +2,18 @@ from rest_framework import serializers
 from .models import Category, Product
 
 class CategorySerializer(serializers.ModelSerializer):
-    product_count = serializers.IntegerField(source='products.count', read_only=True)
+    product_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Category
         fields = ['id', 'name', 'slug', 'description', 'image', 'product_count']
 
+    def get_product_count(self, obj) -> int:
+        # Viewsets annotate the count; bare instances (e.g. after create) fall back to a query
+        if hasattr(obj, 'product_count'):
+            return obj.product_count
+        return obj.products.count()
+
 class ProductSerializer(serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
     createdAt = serializers.DateTimeField(source='created_at', read_only=True)
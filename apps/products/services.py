@@ -1,64 +1,320 @@
-from django.db.models import F
+import logging
+from functools import partial
+from django.conf import settings
+from django.db.models import F, Case, When, Value, IntegerField, Count
 from django.db import transaction
 from django.core.cache import cache
 from apps.orders.models import Order
-from .models import Category
+from .models import Category, Product
+from .cache import get_catalog_version, bump_product_stock
+from . import inventory
 
-def reduce_order_stock(order: Order):
+logger = logging.getLogger(__name__)
+
+# Lower bounds of the price histogram buckets; the last bucket is open-ended
+PRICE_BUCKETS = (0, 25, 50, 100, 250, 500, 1000)
+
+class InsufficientStock(Exception):
+    """
+    Raised when a reservation cannot be met; `shortages` lists each short
+    line as a dict with `product_id`, `sku`, `requested` and `available`.
+    """
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__('Insufficient stock for ' + ', '.join(s['sku'] for s in shortages))
+
+
+def _quantity_case(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        output_field=IntegerField(),
+    )
+
+
+def _sharded_products(quantities):
+    """
+    Maps each product in `quantities` that holds its stock in Redis to its
+    `(sku, shards)`. This read takes no row locks.
+    """
+    rows = Product.objects.filter(pk__in=quantities, stock_shards__gt=0).values_list('pk', 'sku', 'stock_shards')
+    return {pk: (sku, shards) for pk, sku, shards in rows}
+
+
+def reserve_stock(quantities):
+    """
+    Takes stock for every line of an order, all or nothing.
+
+    `quantities` maps product id to the quantity wanted. Sharded products are
+    taken from their Redis counters; the rest are locked in primary-key order
+    so concurrent checkouts cannot deadlock, and decremented in one
+    conditional UPDATE. Returns the locked database products.
+    """
+    if not quantities:
+        return []
+
+    sharded = _sharded_products(quantities)
+    taken = {}
+    try:
+        shortages = []
+        for pk in sorted(sharded):
+            sku, shards = sharded[pk]
+            if inventory.take(pk, shards, quantities[pk]):
+                taken[pk] = quantities[pk]
+            else:
+                shortages.append({
+                    'product_id': pk,
+                    'sku': sku,
+                    'requested': quantities[pk],
+                    'available': inventory.available(pk, shards),
+                })
+        if shortages:
+            raise InsufficientStock(shortages)
+
+        products = _reserve_row_stock({pk: q for pk, q in quantities.items() if pk not in sharded})
+    except BaseException:
+        # Redis does not roll back with the transaction
+        for pk, quantity in taken.items():
+            inventory.give(pk, sharded[pk][1], quantity)
+        raise
+
+    # Sharded stock is shown from the row, which only the reconciler moves
+    rows = [pk for pk in quantities if pk not in sharded]
+    transaction.on_commit(partial(bump_product_stock, rows))
+    return products
+
+
+def _reserve_row_stock(quantities):
+    if not quantities:
+        return []
+
+    with transaction.atomic():
+        products = list(Product.objects.select_for_update().filter(pk__in=quantities).order_by('pk'))
+        found = {product.pk: product for product in products}
+        shortages = [
+            {
+                'product_id': pk,
+                'sku': found[pk].sku if pk in found else str(pk),
+                'requested': quantity,
+                'available': found[pk].stock if pk in found else 0,
+            }
+            for pk, quantity in sorted(quantities.items())
+            if pk not in found or found[pk].stock < quantity
+        ]
+        if shortages:
+            raise InsufficientStock(shortages)
+
+        requested = _quantity_case(quantities)
+        # stock_shards=0 guards against a product switched to Redis mid-checkout
+        updated = Product.objects.filter(pk__in=quantities, stock_shards=0, stock__gte=requested).update_stock(
+            stock=F('stock') - requested
+        )
+        if updated != len(quantities):
+            raise InsufficientStock([
+                {'product_id': pk, 'sku': found[pk].sku, 'requested': quantity, 'available': found[pk].stock}
+                for pk, quantity in sorted(quantities.items())
+            ])
+        for product in products:
+            product.stock -= quantities[product.pk]
+
+    return products
+
+
+def release_sharded_stock(quantities):
+    """
+    Returns stock to the Redis-held products in `quantities` only, e.g. after
+    the transaction that reserved it rolled back. Returns the products handled.
+    """
+    sharded = _sharded_products(quantities)
+    for pk, (_, shards) in sharded.items():
+        inventory.give(pk, shards, quantities[pk])
+    return sharded
+
+
+def release_stock(quantities):
+    """
+    Returns previously reserved stock, locking rows in primary-key order.
+    """
+    if not quantities:
+        return
+
+    sharded = release_sharded_stock(quantities)
+    rows = {pk: quantity for pk, quantity in quantities.items() if pk not in sharded}
+    if rows:
+        with transaction.atomic():
+            # Lock in primary-key order, the same order reserve_stock uses
+            list(Product.objects.select_for_update().filter(pk__in=rows).order_by('pk').values_list('pk', flat=True))
+            Product.objects.filter(pk__in=rows).update_stock(stock=F('stock') + _quantity_case(rows))
+        transaction.on_commit(partial(bump_product_stock, list(rows)))
+
+
+def enable_sharded_stock(product: Product, shards=None):
+    """
+    Moves a product's stock into Redis counters split across `shards` keys.
+    """
+    shards = shards or settings.INVENTORY_SHARDS
+    with transaction.atomic():
+        locked = Product.objects.select_for_update().get(pk=product.pk)
+        if locked.stock_shards:
+            return
+        inventory.seed(product.pk, shards, locked.stock)
+        Product.objects.filter(pk=product.pk).update_stock(stock_shards=shards)
+    product.stock_shards = shards
+
+
+def disable_sharded_stock(product: Product):
+    """
+    Writes the Redis counters back to the row and returns the product to
+    database-held stock.
+    """
+    shards = Product.objects.filter(pk=product.pk).values_list('stock_shards', flat=True).get()
+    if not shards:
+        return
+    # New reservations go to the row from here on; anything still in flight
+    # lands in the deltas drained below
+    Product.objects.filter(pk=product.pk).update_stock(stock_shards=0)
+    product.stock_shards = 0
+    _apply_sharded_deltas({product.pk: shards})
+    _apply_sharded_deltas({product.pk: shards}, clear=True)
+
+
+def reconcile_sharded_stock(batch_size=500):
+    """
+    Writes the net Redis deltas of every sharded product back to
+    Product.stock, one UPDATE per batch. Returns the number of products
+    whose stock changed.
+    """
+    products = dict(Product.objects.filter(stock_shards__gt=0).values_list('pk', 'stock_shards'))
+    changed = 0
+    items = list(products.items())
+    for start in range(0, len(items), batch_size):
+        changed += _apply_sharded_deltas(dict(items[start:start + batch_size]))
+    return changed
+
+
+def _apply_sharded_deltas(products, clear=False):
+    deltas = inventory.drain(products, clear=clear)
+    if not deltas:
+        return 0
+    try:
+        with transaction.atomic():
+            Product.objects.filter(pk__in=deltas).update_stock(stock=F('stock') + _quantity_case(deltas))
+    except Exception:
+        # Put the deltas back so the next run applies them
+        for pk, delta in deltas.items():
+            inventory.restore_delta(pk, products[pk], delta)
+        raise
+    bump_product_stock(deltas)
+    return len(deltas)
+
+
+def get_order_quantities(order: Order):
+    quantities = {}
+    for product_id, quantity in order.items.filter(product__isnull=False).values_list('product_id', 'quantity'):
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+def commit_order_stock(order: Order):
     """
-    Reduces stock for all products in the order using atomic updates.
+    Finalises the order's stock once payment succeeds.
+
+    A reserved order just flips to committed. Orders that never held a
+    reservation, or whose reservation was released (failed or expired
+    payment that later succeeded), take their stock now.
     """
     with transaction.atomic():
-        for item in order.items.all():
-            if item.product:
-                # Use F expression to avoid race conditions
-                item.product.stock = F('stock') - item.quantity
-                item.product.save(update_fields=['stock'])
+        if Order.objects.filter(pk=order.pk, stock_status='reserved').update(stock_status='committed'):
+            order.stock_status = 'committed'
+            return
+
+        if Order.objects.filter(pk=order.pk, stock_status__in=['unreserved', 'released']).update(stock_status='committed'):
+            order.stock_status = 'committed'
+            try:
+                reserve_stock(get_order_quantities(order))
+            except InsufficientStock as exc:
+                # Payment is already captured; keep the order and flag it for follow-up
+                logger.warning("Order %s paid without enough stock: %s", order.pk, exc.shortages)
+
+
+def release_order_stock(order: Order):
+    """
+    Returns an order's reservation to stock, at most once.
+    """
+    with transaction.atomic():
+        if Order.objects.filter(pk=order.pk, stock_status='reserved').update(stock_status='released'):
+            order.stock_status = 'released'
+            release_stock(get_order_quantities(order))
+
 
 def get_category_tree():
     """
-    Retrieves the category tree using DFS and caches it.
+    Builds the category tree from the materialized path index and caches it
+    under the current catalog version, so any category change invalidates it.
     """
-    cache_key = 'category_tree'
+    cache_key = f'category_tree:{get_catalog_version()}'
     cached_tree = cache.get(cache_key)
-    
-    if cached_tree:
+
+    if cached_tree is not None:
         return cached_tree
-    
-    # Fetch all categories
-    categories = Category.objects.all()
-    
-    # Build adjacency list
-    adj_list = {}
-    roots = []
-    
-    for cat in categories:
-        if cat.parent_id:
-            if cat.parent_id not in adj_list:
-                adj_list[cat.parent_id] = []
-            adj_list[cat.parent_id].append(cat)
-        else:
-            roots.append(cat)
-            
-    # DFS Traversal
-    def dfs(node):
-        tree_node = {
-            'id': node.id,
-            'name': node.name,
-            'slug': node.slug,
+
+    # Path order lists every parent before its children, so one pass suffices
+    nodes = {}
+    tree = []
+    for cat in Category.objects.order_by('path').only('id', 'name', 'slug', 'parent_id'):
+        node = {
+            'id': cat.id,
+            'name': cat.name,
+            'slug': cat.slug,
             'children': []
         }
-        
-        if node.id in adj_list:
-            for child in adj_list[node.id]:
-                tree_node['children'].append(dfs(child))
-        
-        return tree_node
-
-    tree = [dfs(root) for root in roots]
-    
-    # Cache for 1 hour
-    cache.set(cache_key, tree, 3600)
-    
+        nodes[cat.id] = node
+        siblings = nodes[cat.parent_id]['children'] if cat.parent_id else tree
+        siblings.append(node)
+
+    cache.set(cache_key, tree, settings.CATALOG_CACHE_TIMEOUT)
+
     return tree
 
+def get_product_facets(queryset):
+    """
+    Counts products per category, status and price bucket for a filtered
+    queryset using a single grouped query.
+    """
+    price_bucket = Case(
+        *[
+            When(price__gte=low, then=Value(index))
+            for index, low in reversed(list(enumerate(PRICE_BUCKETS)))
+        ],
+        output_field=IntegerField(),
+    )
+    rows = (
+        queryset.order_by()
+        .annotate(price_bucket=price_bucket)
+        .values('category_id', 'category__name', 'category__slug', 'status', 'price_bucket')
+        .annotate(count=Count('id'))
+    )
+
+    categories = {}
+    statuses = {}
+    buckets = [0] * len(PRICE_BUCKETS)
+    for row in rows:
+        category = categories.setdefault(row['category_id'], {
+            'id': row['category_id'],
+            'name': row['category__name'],
+            'slug': row['category__slug'],
+            'count': 0
+        })
+        category['count'] += row['count']
+        statuses[row['status']] = statuses.get(row['status'], 0) + row['count']
+        if row['price_bucket'] is not None:
+            buckets[row['price_bucket']] += row['count']
+
+    bounds = list(PRICE_BUCKETS[1:]) + [None]
+    return {
+        'categories': sorted(categories.values(), key=lambda c: (-c['count'], c['name'])),
+        'status': [{'value': value, 'count': count} for value, count in sorted(statuses.items())],
+        'price': [
+            {'min': low, 'max': high, 'count': count}
+            for low, high, count in zip(PRICE_BUCKETS, bounds, buckets)
+        ],
+    }
@@ -1,3 +1,476 @@
-from django.test import TestCase
+import json
+import threading
+from base64 import b64encode
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.request import Request
+from apps.core.redis import get_redis
+from apps.core.testing import LOCMEM_CACHES, QueryCountGuardMixin, uses_test_redis
+from . import inventory
+from .cache import catalog_cache_key, get_catalog_version
+from .models import Category, Product
+from .services import (
+    reserve_stock, release_stock, enable_sharded_stock, disable_sharded_stock,
+    reconcile_sharded_stock, InsufficientStock
+)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Electronics')
+        self.product = Product.objects.create(
+            category=self.category,
+            name='Phone',
+            sku='PH-1',
+            description='A phone',
+            price=100,
+            stock=5,
+            image='products/phone.jpg'
+        )
+
+    def test_cache_hit_skips_database(self):
+        first = self.client.get('/api/products/')
+        self.assertEqual(first.status_code, 200)
+
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/products/')
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.content, second.content)
+
+    def test_product_save_invalidates_cache(self):
+        version = get_catalog_version()
+        self.client.get(f'/api/products/{self.product.slug}/')
+
+        self.product.price = 150
+        self.product.save()
+
+        self.assertNotEqual(get_catalog_version(), version)
+        response = self.client.get(f'/api/products/{self.product.slug}/')
+        self.assertEqual(response.json()['price'], 150.0)
+
+    def test_equivalent_query_strings_share_key(self):
+        factory = APIRequestFactory()
+        first = Request(factory.get('/api/products/', {'status': 'active', 'category': '1'}))
+        second = Request(factory.get('/api/products/?category=1&status=active&search='))
+        self.assertEqual(catalog_cache_key(first), catalog_cache_key(second))
+
+    def test_scheme_is_part_of_key(self):
+        factory = APIRequestFactory()
+        http = Request(factory.get('/api/products/'))
+        https = Request(factory.get('/api/products/', secure=True))
+        self.assertNotEqual(catalog_cache_key(http), catalog_cache_key(https))
+
+    def test_bulk_update_invalidates_cache(self):
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.product.pk).update(price=120)
+        self.assertNotEqual(get_catalog_version(), version)
+
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.filter(pk=self.category.pk).update(name='Gadgets')
+        self.assertNotEqual(get_catalog_version(), version)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StockInvalidationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        category = Category.objects.create(name='Audio')
+        self.headphones = Product.objects.create(
+            category=category, name='Headphones', sku='HP-1',
+            description='Headphones', price=80, stock=5, image='products/hp.jpg'
+        )
+        self.speaker = Product.objects.create(
+            category=category, name='Speaker', sku='SP-1',
+            description='Speaker', price=60, stock=5, image='products/sp.jpg'
+        )
+
+    def _stock(self, url):
+        data = self.client.get(url).json()
+        rows = data['results'] if 'results' in data else [data]
+        return {row['sku']: row['stock'] for row in rows}
+
+    def test_stock_move_only_invalidates_its_product(self):
+        version = get_catalog_version()
+        self._stock('/api/products/')
+        self._stock(f'/api/products/{self.speaker.slug}/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_stock({self.headphones.pk: 2})
+
+        self.assertEqual(get_catalog_version(), version)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._stock(f'/api/products/{self.speaker.slug}/'), {'SP-1': 5})
+        self.assertEqual(self._stock('/api/products/'), {'HP-1': 3, 'SP-1': 5})
+        self.assertEqual(self._stock(f'/api/products/{self.headphones.slug}/'), {'HP-1': 3})
+
+    def test_stock_move_changes_etag(self):
+        etag = self.client.get('/api/products/').headers['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            release_stock({self.speaker.pk: 1})
+
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=response.headers['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ProductPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        category = Category.objects.create(name='Clothing')
+        # Identical prices force the primary key tiebreaker to do the work
+        for i in range(7):
+            Product.objects.create(
+                category=category,
+                name=f'Shirt {i}',
+                sku=f'SH-{i}',
+                description='A shirt',
+                price=20,
+                image='products/shirt.jpg'
+            )
+
+    def _walk(self, url):
+        seen = []
+        while url:
+            data = self.client.get(url).json()
+            self.assertNotIn('count', data)
+            seen.extend(item['id'] for item in data['results'])
+            url = data['next']
+        return seen
+
+    def test_pages_cover_every_row_once(self):
+        ids = self._walk('/api/products/?ordering=price&page_size=3')
+        expected = list(Product.objects.order_by('price', 'pk').values_list('pk', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_previous_link_returns_prior_page(self):
+        first = self.client.get('/api/products/?page_size=3').json()
+        second = self.client.get(first['next']).json()
+        back = self.client.get(second['previous']).json()
+        self.assertEqual(back['results'], first['results'])
+        self.assertIsNone(back['previous'])
+
+    def test_forged_cursor_is_not_found(self):
+        for position in (['abc', '1'], [None, None], ['20', 'x'], ['20']):
+            cursor = b64encode(urlencode({'p': json.dumps(position)}).encode('ascii')).decode('ascii')
+            response = self.client.get('/api/products/', {'ordering': 'price', 'cursor': cursor})
+            self.assertEqual(response.status_code, 404, position)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogQueryCountTests(QueryCountGuardMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        for c in range(3):
+            category = Category.objects.create(name=f'Category {c}')
+            for p in range(4):
+                Product.objects.create(
+                    category=category,
+                    name=f'Product {c}-{p}',
+                    sku=f'P-{c}-{p}',
+                    description='Product',
+                    price=10 + p,
+                    image='products/item.jpg'
+                )
+
+    def test_product_list_queries_are_constant(self):
+        self.assertQueriesDoNotScaleWithPageSize('/api/products/')
+
+    def test_category_list_uses_single_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/products/categories/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['product_count'] for c in response.json()], [4, 4, 4])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CategoryTreeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.electronics = Category.objects.create(name='Electronics')
+        self.phones = Category.objects.create(name='Phones', parent=self.electronics)
+        self.android = Category.objects.create(name='Android', parent=self.phones)
+        self.clothing = Category.objects.create(name='Clothing')
+        for category in (self.electronics, self.android, self.clothing):
+            Product.objects.create(
+                category=category,
+                name=f'{category.name} item',
+                sku=f'{category.slug}-1',
+                description='Item',
+                price=10,
+                image='products/item.jpg'
+            )
+
+    def test_paths_follow_ancestry(self):
+        self.android.refresh_from_db()
+        self.assertTrue(self.android.path.startswith(self.phones.path))
+        self.assertEqual(self.android.depth, 2)
+        self.assertEqual(
+            set(self.electronics.get_descendants()),
+            {self.phones, self.android}
+        )
+
+    def test_slug_filter_includes_descendants(self):
+        response = self.client.get('/api/products/', {'category__slug': 'electronics'})
+        names = {item['name'] for item in response.json()['results']}
+        self.assertEqual(names, {'Electronics item', 'Android item'})
+
+    def test_move_rewrites_subtree_and_tree(self):
+        self.phones.parent = self.clothing
+        self.phones.save()
+
+        self.android.refresh_from_db()
+        self.assertTrue(self.android.path.startswith(self.clothing.path))
+        self.assertEqual(self.android.depth, 2)
+
+        tree = self.client.get('/api/products/categories/tree/').json()
+        clothing = next(node for node in tree if node['slug'] == 'clothing')
+        self.assertEqual(clothing['children'][0]['slug'], 'phones')
+        self.assertEqual(clothing['children'][0]['children'][0]['slug'], 'android')
+
+    def test_cannot_move_under_own_descendant(self):
+        self.electronics.parent = self.android
+        with self.assertRaises(ValueError):
+            self.electronics.save()
+
+    def test_save_without_move_skips_parent_lookup(self):
+        phones = Category.objects.get(pk=self.phones.pk)
+        phones.description = 'Smartphones'
+        # Just the UPDATE; the parent's path is not read again
+        with self.assertNumQueries(1):
+            phones.save()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        category = Category.objects.create(name='Phones')
+        self.iphone = Product.objects.create(
+            category=category, name='iPhone 15', sku='IP15-128',
+            description='Latest Apple phone', price=999, image='products/iphone.jpg'
+        )
+        self.case = Product.objects.create(
+            category=category, name='Leather case', sku='CASE-1',
+            description='Fits the iPhone 15', price=49, image='products/case.jpg'
+        )
+        Product.objects.create(
+            category=category, name='Charger', sku='CHG-1',
+            description='USB-C charger', price=19, image='products/charger.jpg'
+        )
+
+    def _search(self, term):
+        response = self.client.get('/api/products/', {'search': term})
+        self.assertEqual(response.status_code, 200)
+        return [item['sku'] for item in response.json()['results']]
+
+    def test_name_match_outranks_description_match(self):
+        self.assertEqual(self._search('iphone'), ['IP15-128', 'CASE-1'])
+
+    def test_ranked_results_paginate(self):
+        first = self.client.get('/api/products/', {'search': 'iphone', 'page_size': 1}).json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual(
+            [item['sku'] for item in first['results'] + second['results']],
+            ['IP15-128', 'CASE-1']
+        )
+
+    def test_prefix_terms_match(self):
+        self.assertEqual(self._search('leath'), ['CASE-1'])
+
+    def test_exact_sku_fast_path(self):
+        self.assertEqual(self._search('CHG-1'), ['CHG-1'])
+
+    def test_lone_token_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self._search('CASE-1'), ['CASE-1'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self._search('leath'), ['CASE-1'])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.case.name = 'Silicone sleeve'
+        self.case.description = 'Soft cover'
+        self.case.save()
+        self.assertEqual(self._search('leather'), [])
+        self.assertEqual(self._search('silicone'), ['CASE-1'])
+
+        self.iphone.delete()
+        self.assertEqual(self._search('apple'), [])
+
+    def test_explicit_ordering_overrides_rank(self):
+        response = self.client.get('/api/products/', {'search': 'iphone', 'ordering': 'price'})
+        self.assertEqual([item['sku'] for item in response.json()['results']], ['CASE-1', 'IP15-128'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ProductFacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        phones = Category.objects.create(name='Phones')
+        shirts = Category.objects.create(name='Shirts')
+        for sku, category, price, status in [
+            ('P-1', phones, 999, 'active'),
+            ('P-2', phones, 300, 'inactive'),
+            ('S-1', shirts, 20, 'active'),
+            ('S-2', shirts, 30, 'active'),
+        ]:
+            Product.objects.create(
+                category=category, name=f'Item {sku}', sku=sku,
+                description='Item', price=price, status=status, image='products/item.jpg'
+            )
+
+    def test_facets_use_one_query_and_respect_filters(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/products/facets/', {'status': 'active'})
+        data = response.json()
+
+        self.assertEqual(
+            [(c['slug'], c['count']) for c in data['categories']],
+            [('shirts', 2), ('phones', 1)]
+        )
+        self.assertEqual(data['status'], [{'value': 'active', 'count': 3}])
+        counts = {bucket['min']: bucket['count'] for bucket in data['price']}
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[25], 1)
+        self.assertEqual(counts[500], 1)
+        self.assertIsNone(data['price'][-1]['max'])
+
+    def test_facets_are_cached_per_filter_set(self):
+        self.client.get('/api/products/facets/', {'search': 'item'})
+        with self.assertNumQueries(0):
+            self.client.get('/api/products/facets/', {'search': 'item'})
+        # A new filter set misses: one grouped query, SKU check included
+        with self.assertNumQueries(1):
+            self.client.get('/api/products/facets/', {'search': 'item', 'status': 'inactive'})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Books')
+        self.product = Product.objects.create(
+            category=self.category, name='Novel', sku='BK-1',
+            description='A novel', price=12, image='products/book.jpg'
+        )
+
+    def test_matching_etag_returns_304_without_queries(self):
+        response = self.client.get('/api/products/')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_catalog_change_invalidates_etag(self):
+        etag = self.client.get('/api/products/categories/tree/').headers['ETag']
+        Category.objects.create(name='Comics', parent=self.category)
+        response = self.client.get('/api/products/categories/tree/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+@uses_test_redis
+@override_settings(CACHES=LOCMEM_CACHES)
+class ShardedStockTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Deals')
+        self.product = Product.objects.create(
+            category=category, name='Flash sale TV', sku='TV-1',
+            description='TV', price=300, stock=10, image='products/tv.jpg'
+        )
+        enable_sharded_stock(self.product, shards=4)
+
+    def test_reservation_skips_the_product_row(self):
+        # Only the lock-free mode lookup touches the database
+        with self.assertNumQueries(1):
+            reserve_stock({self.product.pk: 3})
+        self.assertEqual(inventory.available(self.product.pk, 4), 7)
+
+        with self.assertRaises(InsufficientStock) as ctx:
+            reserve_stock({self.product.pk: 8})
+        self.assertEqual(ctx.exception.shortages[0]['available'], 7)
+        self.assertEqual(inventory.available(self.product.pk, 4), 7)
+
+    def test_reconcile_writes_net_delta_back(self):
+        reserve_stock({self.product.pk: 4})
+        release_stock({self.product.pk: 1})
+
+        self.assertEqual(reconcile_sharded_stock(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 7)
+        # Nothing is pending any more
+        self.assertEqual(reconcile_sharded_stock(), 0)
+
+    def test_disable_returns_stock_to_the_row(self):
+        reserve_stock({self.product.pk: 2})
+        disable_sharded_stock(self.product)
+
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.stock_shards), (8, 0))
+        self.assertFalse(get_redis().exists(*inventory.shard_keys(self.product.pk, 4)))
+
+
+@uses_test_redis
+class ShardedStockStressTests(TestCase):
+    """
+    Many threads drain one product's shards at once; no shard may dip
+    below zero and exactly the seeded stock must be handed out.
+    """
+    PRODUCT_ID = 987654321
+    SHARDS = 8
+
+    def test_shards_never_go_negative(self):
+        inventory.seed(self.PRODUCT_ID, self.SHARDS, 200)
+        keys = inventory.shard_keys(self.PRODUCT_ID, self.SHARDS)
+        sold = []
+        lowest = []
+        done = threading.Event()
+
+        def shopper():
+            for quantity in (1, 2, 3) * 10:
+                if inventory.take(self.PRODUCT_ID, self.SHARDS, quantity):
+                    sold.append(quantity)
+
+        def watcher():
+            while not done.is_set():
+                pipe = get_redis().pipeline()
+                for key in keys:
+                    pipe.hget(key, 'available')
+                lowest.append(min(int(value or 0) for value in pipe.execute()))
+
+        observer = threading.Thread(target=watcher)
+        observer.start()
+        threads = [threading.Thread(target=shopper) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        observer.join()
+
+        self.assertEqual(sum(sold), 200)
+        self.assertGreaterEqual(min(lowest), 0)
+        self.assertEqual(inventory.available(self.PRODUCT_ID, self.SHARDS), 0)
+        self.assertEqual(inventory.drain({self.PRODUCT_ID: self.SHARDS}), {self.PRODUCT_ID: -200})
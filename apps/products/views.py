@@ -1,14 +1,19 @@
-from rest_framework import viewsets, filters, status
+from functools import partial
+from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser
+from django.db.models import Count
 from django_filters.rest_framework import DjangoFilterBackend
+from apps.core.pagination import KeysetPagination
 from .models import Category, Product
 from .serializers import CategorySerializer, ProductSerializer, ProductDetailSerializer
-from .services import get_category_tree
+from .services import get_category_tree, get_product_facets
+from .cache import CatalogCacheMixin
+from .filters import ProductFilter, ProductSearchFilter, RankedOrderingFilter
 
-class CategoryViewSet(viewsets.ModelViewSet):
-    queryset = Category.objects.all()
+class CategoryViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
+    queryset = Category.objects.annotate(product_count=Count('products'))
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     lookup_field = 'slug'
@@ -18,16 +23,16 @@ class CategoryViewSet(viewsets.ModelViewSet):
         """
         Returns the category tree structure.
         """
-        tree = get_category_tree()
-        return Response(tree)
+        return self.cached_response(request, lambda: Response(get_category_tree()))
 
-class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all()
+class ProductViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
+    queryset = Product.objects.select_related('category')
     lookup_field = 'slug'
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    filterset_fields = ['category', 'category__slug', 'status']
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, RankedOrderingFilter]
+    filterset_class = ProductFilter
     search_fields = ['name', 'description', 'sku']
     ordering_fields = ['price', 'created_at']
+    pagination_class = KeysetPagination
     
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -38,3 +43,21 @@ class ProductViewSet(viewsets.ModelViewSet):
         if self.action in ['create', 'update', 'partial_update', 'destroy']:
             return [IsAdminUser()]
         return [IsAuthenticatedOrReadOnly()]
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, partial(super().list, request, *args, **kwargs), shows_stock=True)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, partial(super().retrieve, request, *args, **kwargs), shows_stock=True)
+
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        """
+        Returns per-category, status and price-bucket counts for the current
+        filter set, cached under the same key scheme as the listing.
+        """
+        return self.cached_response(request, partial(self._facets_response, request))
+
+    def _facets_response(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(get_product_facets(queryset))
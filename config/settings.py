@@ -14,6 +14,8 @@ import os
 from pathlib import Path
 from datetime import timedelta
 
+from corsheaders.defaults import default_headers
+
 
 def _load_env(env_path: Path) -> None:
     """Minimal .env loader to avoid extra dependencies."""
@@ -131,24 +133,90 @@ STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
 
+# Outbound payment provider HTTP: timeouts in seconds, pooled connections per
+# host, and jittered retries for idempotent calls
+PAYMENT_HTTP_CONNECT_TIMEOUT = float(os.getenv('PAYMENT_HTTP_CONNECT_TIMEOUT', 3.05))
+PAYMENT_HTTP_READ_TIMEOUT = float(os.getenv('PAYMENT_HTTP_READ_TIMEOUT', 20))
+PAYMENT_HTTP_POOL_SIZE = int(os.getenv('PAYMENT_HTTP_POOL_SIZE', 10))
+# An async worker multiplexes many in-flight calls over one pool
+PAYMENT_HTTP_ASYNC_MAX_CONNECTIONS = int(os.getenv('PAYMENT_HTTP_ASYNC_MAX_CONNECTIONS', 200))
+PAYMENT_HTTP_MAX_RETRIES = int(os.getenv('PAYMENT_HTTP_MAX_RETRIES', 2))
+PAYMENT_HTTP_BACKOFF_BASE = float(os.getenv('PAYMENT_HTTP_BACKOFF_BASE', 0.25))
+PAYMENT_HTTP_BACKOFF_MAX = float(os.getenv('PAYMENT_HTTP_BACKOFF_MAX', 2))
+# Seconds a payment request may spend waiting on providers in total
+PAYMENT_REQUEST_DEADLINE = float(os.getenv('PAYMENT_REQUEST_DEADLINE', 10))
+# Circuit breaker: a provider is cut off for PAYMENT_BREAKER_COOLDOWN seconds
+# once, over the last PAYMENT_BREAKER_WINDOW seconds and at least
+# PAYMENT_BREAKER_MIN_CALLS calls, the share of errors or of calls slower than
+# PAYMENT_BREAKER_SLOW_CALL seconds reaches its rate
+PAYMENT_BREAKER_WINDOW = int(os.getenv('PAYMENT_BREAKER_WINDOW', 60))
+PAYMENT_BREAKER_BUCKET = int(os.getenv('PAYMENT_BREAKER_BUCKET', 10))
+PAYMENT_BREAKER_MIN_CALLS = int(os.getenv('PAYMENT_BREAKER_MIN_CALLS', 20))
+PAYMENT_BREAKER_ERROR_RATE = float(os.getenv('PAYMENT_BREAKER_ERROR_RATE', 0.5))
+PAYMENT_BREAKER_SLOW_CALL = float(os.getenv('PAYMENT_BREAKER_SLOW_CALL', 5))
+PAYMENT_BREAKER_SLOW_RATE = float(os.getenv('PAYMENT_BREAKER_SLOW_RATE', 0.5))
+PAYMENT_BREAKER_COOLDOWN = int(os.getenv('PAYMENT_BREAKER_COOLDOWN', 30))
+# Serve create/confirm from the async views (needs an ASGI server)
+PAYMENT_ASYNC_VIEWS = _get_bool('PAYMENT_ASYNC_VIEWS', default=False)
+
 # bKash
 BKASH_APP_KEY = os.getenv('BKASH_APP_KEY', '')
 BKASH_APP_SECRET = os.getenv('BKASH_APP_SECRET', '')
 BKASH_USERNAME = os.getenv('BKASH_USERNAME', '')
 BKASH_PASSWORD = os.getenv('BKASH_PASSWORD', '')
 BKASH_BASE_URL = os.getenv('BKASH_BASE_URL', 'https://tokenized.sandbox.bka.sh/v1.2.0-beta')
+# Tokens are renewed this many seconds before they expire
+BKASH_TOKEN_REFRESH_MARGIN = int(os.getenv('BKASH_TOKEN_REFRESH_MARGIN', 300))
+BKASH_TOKEN_LOCK_TIMEOUT = int(os.getenv('BKASH_TOKEN_LOCK_TIMEOUT', 10))
+BKASH_REFRESH_TOKEN_LIFETIME = int(os.getenv('BKASH_REFRESH_TOKEN_LIFETIME', 28 * 24 * 60 * 60))
 
 # Caching (Redis)
+REDIS_URL = os.getenv('REDIS_URL', "redis://127.0.0.1:6379/1")
+# Tests that need Redis run against this database and empty it; keep it apart from REDIS_URL
+REDIS_TEST_URL = os.getenv('REDIS_TEST_URL', "redis://127.0.0.1:6379/15")
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": os.getenv('REDIS_URL', "redis://127.0.0.1:6379/1"),
+        "LOCATION": REDIS_URL,
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
     }
 }
 
+# Seconds a rendered catalog response stays in the cache
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 300))
+
+# Seconds an unpaid order keeps its stock reserved before it is released
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', 30 * 60))
+
+# Seconds after which a payment the provider still reports as open is treated
+# as abandoned by reconcile_payments and marked failed
+PAYMENT_ABANDON_AFTER = int(os.getenv('PAYMENT_ABANDON_AFTER', 24 * 60 * 60))
+
+# Seconds a completed Idempotency-Key response is replayed for, and how long
+# an in-flight request holds its key
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+
+# Webhook inbox: attempts before an event is parked as failed, and seconds
+# before a claim held by a dead worker is released
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+WEBHOOK_CLAIM_TIMEOUT = int(os.getenv('WEBHOOK_CLAIM_TIMEOUT', 300))
+
+# Seconds a settled payment state is answered from cache by confirm
+PAYMENT_STATUS_CACHE_TTL = int(os.getenv('PAYMENT_STATUS_CACHE_TTL', 24 * 60 * 60))
+
+# Order status streams: seconds between keepalives, seconds before a stream
+# is closed for the client to reconnect, and the reconnect delay sent to it
+ORDER_EVENTS_HEARTBEAT = int(os.getenv('ORDER_EVENTS_HEARTBEAT', 15))
+ORDER_EVENTS_MAX_AGE = int(os.getenv('ORDER_EVENTS_MAX_AGE', 5 * 60))
+ORDER_EVENTS_RETRY_MS = int(os.getenv('ORDER_EVENTS_RETRY_MS', 3000))
+
+# Redis counters a product's stock is split across when sharded stock is enabled
+INVENTORY_SHARDS = int(os.getenv('INVENTORY_SHARDS', 8))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -193,7 +261,7 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # REST Framework Configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'apps.authentication.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -248,6 +316,8 @@ CORS_ALLOWED_ORIGINS = _get_list(
     ],
 )
 CORS_ALLOW_CREDENTIALS = True
+# Browser clients send Idempotency-Key on retried POSTs
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
 
 CSRF_TRUSTED_ORIGINS = _get_list('CSRF_TRUSTED_ORIGINS', default=CORS_ALLOWED_ORIGINS)
 
@@ -260,5 +330,24 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# Seconds a user's auth version is cached for token-only authentication
+AUTH_USER_CACHE_TTL = int(os.getenv('AUTH_USER_CACHE_TTL', 5 * 60))
+
+# One-time codes: seconds a code stays valid and wrong guesses before it is burned
+OTP_TTL = int(os.getenv('OTP_TTL', 10 * 60))
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', 5))
+# Codes one email may be sent per OTP_ISSUE_WINDOW seconds
+OTP_ISSUE_LIMIT = int(os.getenv('OTP_ISSUE_LIMIT', 5))
+OTP_ISSUE_WINDOW = int(os.getenv('OTP_ISSUE_WINDOW', 60 * 60))
+
+# Email outbox (send_emails): attempts before a message is parked as failed,
+# retry backoff in seconds, and seconds before a dead worker's claim is released
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
+EMAIL_OUTBOX_BACKOFF_BASE = int(os.getenv('EMAIL_OUTBOX_BACKOFF_BASE', 30))
+EMAIL_OUTBOX_BACKOFF_MAX = int(os.getenv('EMAIL_OUTBOX_BACKOFF_MAX', 30 * 60))
+EMAIL_OUTBOX_CLAIM_TIMEOUT = int(os.getenv('EMAIL_OUTBOX_CLAIM_TIMEOUT', 300))
+# Seconds sent and parked emails are kept before send_emails deletes them
+EMAIL_OUTBOX_RETENTION = int(os.getenv('EMAIL_OUTBOX_RETENTION', 7 * 24 * 60 * 60))
+
 # Default Auto Field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'